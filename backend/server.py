@@ -1,6 +1,6 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Query, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Query, Request, Header
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import StreamingResponse, HTMLResponse, JSONResponse
+from fastapi.responses import StreamingResponse, HTMLResponse, JSONResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse
 from dotenv import load_dotenv
@@ -10,7 +10,7 @@ import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, validator
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import uuid
 import re
 from datetime import datetime, timezone, timedelta
@@ -19,11 +19,38 @@ import jwt
 import json
 import zipfile
 import io
+import struct
+import tarfile
+import csv
+import socket
+import tempfile
 import random
 import httpx
 import base64
+import binascii
 import asyncio
-
+import html as html_lib
+import time
+import zlib
+import itertools
+import contextlib
+import mmap
+import codecs
+import mimetypes
+import xml.etree.ElementTree as ET
+from email import policy as email_policy
+from email.message import MIMEPart
+from email.parser import BytesParser
+from email.utils import formataddr, format_datetime, parseaddr
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque, OrderedDict
+import shutil
+import anyio
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from bson import Binary
+from pymongo import UpdateOne, ReplaceOne, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 
 # Microsoft Graph SDK imports
@@ -46,6 +73,20 @@ except ImportError as e:
     Folder = None
     MessagesRequestBuilder = Any
 
+# Optional PDF text extraction backend
+try:
+    from pypdf import PdfReader
+    PYPDF_AVAILABLE = True
+except ImportError:
+    PYPDF_AVAILABLE = False
+
+# Optional HTTP/2 support for the outbound HTTP client
+try:
+    import h2  # noqa: F401
+    H2_AVAILABLE = True
+except ImportError:
+    H2_AVAILABLE = False
+
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -55,6 +96,122 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Ek dosyalar için GridFS blob deposu
+attachment_bucket = AsyncIOMotorGridFSBucket(db, bucket_name="attachments")
+
+
+# ============== OUTBOUND HTTP CLIENT ==============
+
+OUTBOUND_HTTP2 = os.environ.get('OUTBOUND_HTTP2', 'true').lower() == 'true'
+OUTBOUND_MAX_CONNECTIONS = int(os.environ.get('OUTBOUND_MAX_CONNECTIONS', '100'))
+OUTBOUND_MAX_KEEPALIVE = int(os.environ.get('OUTBOUND_MAX_KEEPALIVE', '20'))
+OUTBOUND_KEEPALIVE_EXPIRY = float(os.environ.get('OUTBOUND_KEEPALIVE_EXPIRY', '30'))
+OUTBOUND_CONNECT_TIMEOUT = float(os.environ.get('OUTBOUND_CONNECT_TIMEOUT', '10'))
+OUTBOUND_READ_TIMEOUT = float(os.environ.get('OUTBOUND_READ_TIMEOUT', '30'))
+OUTBOUND_POOL_TIMEOUT = float(os.environ.get('OUTBOUND_POOL_TIMEOUT', '10'))
+
+
+class OutboundHTTP:
+    """
+    Graph, Microsoft oturum açma ve reCAPTCHA çağrıları için uygulama genelinde tek, havuzlu
+    httpx istemcisi. Bağlantılar keep-alive ile yeniden kullanılır, böylece her çağrı yeni bir
+    TCP/TLS el sıkışması yapmaz; h2 (httpx[http2]) kuruluysa HTTP/2 açılır.
+    startup'ta açılır, shutdown'da kapanır; bağlantı kurulumları trace olaylarından sayılır.
+    """
+    
+    def __init__(self, http2: bool, limits: httpx.Limits, timeout: httpx.Timeout,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.http2 = http2 and H2_AVAILABLE
+        self.limits = limits
+        self.timeout = timeout
+        self.transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self.in_flight = 0
+        self.stats = {"requests": 0, "failures": 0, "connections_opened": 0, "tls_handshakes": 0,
+                      "request_seconds": 0.0}
+        self.status_classes: Dict[str, int] = {}
+        self.http_versions: Dict[str, int] = {}
+    
+    async def start(self):
+        self.client
+    
+    async def stop(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Lifespan dışında (betikler, testler) ilk kullanımda açılır
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=self.limits,
+                timeout=self.timeout,
+                transport=self.transport
+            )
+        return self._client
+    
+    async def _trace(self, event: str, info: dict):
+        if event == "connection.connect_tcp.complete":
+            self.stats["connections_opened"] += 1
+        elif event == "connection.start_tls.complete":
+            self.stats["tls_handshakes"] += 1
+    
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        self.stats["requests"] += 1
+        self.in_flight += 1
+        started = time.monotonic()
+        try:
+            response = await self.client.request(method, url, extensions={"trace": self._trace}, **kwargs)
+        except Exception:
+            self.stats["failures"] += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.stats["request_seconds"] += time.monotonic() - started
+        status_class = f"{response.status_code // 100}xx"
+        self.status_classes[status_class] = self.status_classes.get(status_class, 0) + 1
+        self.http_versions[response.http_version] = self.http_versions.get(response.http_version, 0) + 1
+        return response
+    
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+    
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+    
+    def pool_connections(self) -> Dict[str, int]:
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        connections = list(getattr(pool, "connections", []) or [])
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return {"open": len(connections), "idle": idle, "active": len(connections) - idle}
+    
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "in_flight": self.in_flight,
+            "pool": self.pool_connections(),
+            "status_classes": dict(self.status_classes),
+            "http_versions": dict(self.http_versions),
+            **{key: round(value, 3) if isinstance(value, float) else value for key, value in self.stats.items()}
+        }
+
+
+outbound_http = OutboundHTTP(
+    http2=OUTBOUND_HTTP2,
+    limits=httpx.Limits(
+        max_connections=OUTBOUND_MAX_CONNECTIONS,
+        max_keepalive_connections=OUTBOUND_MAX_KEEPALIVE,
+        keepalive_expiry=OUTBOUND_KEEPALIVE_EXPIRY
+    ),
+    timeout=httpx.Timeout(
+        OUTBOUND_READ_TIMEOUT, connect=OUTBOUND_CONNECT_TIMEOUT, pool=OUTBOUND_POOL_TIMEOUT
+    )
+)
+
 # Log helper function
 async def add_system_log(log_type: str, message: str, user_email: str = None, user_name: str = None, additional_data: dict = None):
     """Sistem loglarına yeni bir kayıt ekler"""
@@ -220,6 +377,25 @@ class RecaptchaVerificationResponse(BaseModel):
 class BulkUserRequest(BaseModel):
     user_ids: List[str]
 
+class SystemLogExportRequest(BaseModel):
+    format: str = "json"  # json, ndjson, csv
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    log_types: Optional[List[str]] = None
+    user_email: Optional[str] = None
+
+class UploadCreateRequest(BaseModel):
+    filename: str
+    size: int
+
+class AttachmentArchiveRequest(BaseModel):
+    thread_id: Optional[str] = None
+    folder: Optional[str] = None
+    sender: Optional[str] = None
+    query: Optional[str] = None  # konu içinde arama
+    attachment_name: Optional[str] = None  # ek adı içinde arama
+    email_ids: Optional[List[str]] = None
+
 class OAuthConnectRequest(BaseModel):
     code: str
     state: str
@@ -233,7 +409,7 @@ class AccountConnection(BaseModel):
     is_connected: bool = True
     connected_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     last_sync: Optional[datetime] = None
-    sync_token: Optional[str] = None
+    sync_tokens: Dict[str, str] = Field(default_factory=dict)  # klasör adı -> Graph delta/next bağlantısı
 
 class OutlookEmail(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -1261,28 +1437,27 @@ async def verify_recaptcha_token(token: str) -> dict:
     
     verify_url = "https://www.google.com/recaptcha/api/siteverify"
     
-    async with httpx.AsyncClient() as client:
-        try:
-            payload = {
-                "secret": recaptcha_secret,
-                "response": token
-            }
-            
-            response = await client.post(verify_url, data=payload, timeout=10.0)
+    try:
+        payload = {
+            "secret": recaptcha_secret,
+            "response": token
+        }
+        
+        response = await outbound_http.post(verify_url, data=payload, timeout=10.0)
+        
+        if response.status_code == 200:
+            result = response.json()
+            return result
+        else:
+            logging.error(f"reCAPTCHA API returned status {response.status_code}")
+            return {"success": False, "error": "api_error"}
             
-            if response.status_code == 200:
-                result = response.json()
-                return result
-            else:
-                logging.error(f"reCAPTCHA API returned status {response.status_code}")
-                return {"success": False, "error": "api_error"}
-                
-        except httpx.TimeoutException:
-            logging.error("reCAPTCHA verification timeout")
-            return {"success": False, "error": "timeout"}
-        except Exception as e:
-            logging.error(f"reCAPTCHA verification error: {str(e)}")
-            return {"success": False, "error": "network_error"}
+    except httpx.TimeoutException:
+        logging.error("reCAPTCHA verification timeout")
+        return {"success": False, "error": "timeout"}
+    except Exception as e:
+        logging.error(f"reCAPTCHA verification error: {str(e)}")
+        return {"success": False, "error": "network_error"}
 
 # Routes
 @api_router.post("/verify-recaptcha")
@@ -1372,7 +1547,8 @@ async def login(user_data: UserLogin):
             # Generate demo emails
             demo_emails = await generate_demo_emails(demo_user.id)
             if demo_emails:
-                await db.emails.insert_many(demo_emails)
+                await bulk_upsert_emails(demo_emails)
+                await bump_mailbox_version(demo_user.id)
             
             user = demo_user
         else:
@@ -1539,7 +1715,7 @@ async def get_emails(folder: str = "inbox", current_user: dict = Depends(get_cur
         query["folder"] = folder
     
     # Get emails for specific folder
-    emails_cursor = db.emails.find(query).sort("date", -1)
+    emails_cursor = db.emails.find(query, {"attachment_terms": 0}).sort("date", -1)
     emails = await emails_cursor.to_list(length=None)
     
     # Bağlı hesap bilgilerini al
@@ -1602,6 +1778,9 @@ async def mark_email_read(email_id: str, current_user: dict = Depends(get_curren
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Email not found")
     
+    if result.modified_count:
+        await bump_mailbox_version(current_user["id"])
+    
     return {"success": True}
 
 @api_router.get("/emails/thread/{thread_id}")
@@ -1611,7 +1790,7 @@ async def get_email_thread(thread_id: str, current_user: dict = Depends(get_curr
     emails_cursor = db.emails.find({
         "user_id": current_user["id"],
         "thread_id": thread_id
-    }).sort("date", 1)  # Tarih sırasına göre (eskiden yeniye)
+    }, {"attachment_terms": 0}).sort("date", 1)  # Tarih sırasına göre (eskiden yeniye)
     
     emails = await emails_cursor.to_list(length=None)
     
@@ -1762,6 +1941,8 @@ async def reject_user(user_id: str, current_user: dict = Depends(get_current_use
     
     # Kullanıcının e-postalarını da sil
     await db.emails.delete_many({"user_id": user_id})
+    await db.attachment_texts.delete_many({"user_id": user_id})
+    await bump_mailbox_version(user_id)
     
     return {"message": "Kullanıcı başarıyla reddedildi ve hesabı silindi", "user_id": user_id}
 
@@ -1821,46 +2002,97 @@ async def get_system_logs(current_user: dict = Depends(get_current_user)):
     
     return {"logs": cleaned_logs}
 
+SYSTEM_LOG_CSV_FIELDS = ["id", "timestamp", "log_type", "message", "user_email", "user_name", "additional_data"]
+
+
+def build_system_log_query(request: "SystemLogExportRequest") -> dict:
+    """Zaman aralığı, log tipi ve kullanıcı filtrelerinden indeksli sorgu oluştur"""
+    query: Dict[str, Any] = {}
+    if request.start or request.end:
+        query["timestamp"] = {}
+        if request.start:
+            query["timestamp"]["$gte"] = coerce_datetime(request.start)
+        if request.end:
+            query["timestamp"]["$lte"] = coerce_datetime(request.end)
+    if request.log_types:
+        query["log_type"] = {"$in": request.log_types}
+    if request.user_email:
+        query["user_email"] = request.user_email
+    return query
+
+
+async def iter_system_logs_json(cursor, export_info: dict):
+    """Eski biçimle uyumlu {"export_info": ..., "logs": [...]} belgesini log log üret"""
+    yield ('{\n  "export_info": ' + json.dumps(export_info, ensure_ascii=False, default=str) + ',\n  "logs": [').encode('utf-8')
+    first = True
+    async for log in cursor:
+        log.pop("_id", None)
+        prefix = "\n    " if first else ",\n    "
+        first = False
+        yield (prefix + json.dumps(log, ensure_ascii=False, default=str)).encode('utf-8')
+    yield ('\n  ]\n}\n' if not first else ']\n}\n').encode('utf-8')
+
+
+async def iter_system_logs_csv(cursor):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(SYSTEM_LOG_CSV_FIELDS)
+    # Excel'in UTF-8 olarak açması için BOM
+    yield ('\ufeff' + buffer.getvalue()).encode('utf-8')
+    async for log in cursor:
+        buffer.seek(0)
+        buffer.truncate()
+        additional = log.get("additional_data")
+        writer.writerow([
+            log.get("id", ""),
+            coerce_datetime(log["timestamp"]).isoformat() if log.get("timestamp") else "",
+            log.get("log_type", ""),
+            log.get("message", ""),
+            log.get("user_email") or "",
+            log.get("user_name") or "",
+            json.dumps(additional, ensure_ascii=False, default=str) if additional else ""
+        ])
+        yield buffer.getvalue().encode('utf-8')
+
+
 @api_router.post("/admin/system-logs/export")
-async def export_system_logs(current_user: dict = Depends(get_current_user)):
+async def export_system_logs(request: SystemLogExportRequest = SystemLogExportRequest(),
+                             current_user: dict = Depends(get_current_user)):
     """
-    Admin endpoint - Sistem loglarını JSON formatında indirir
+    Admin endpoint - Sistem loglarını JSON, NDJSON veya CSV olarak akış halinde indirir.
+    Zaman aralığı (start/end), log tipi ve kullanıcı e-postası ile filtrelenebilir.
     """
     # Admin yetkisi kontrolü
     if current_user.get("user_type") != "admin":
         raise HTTPException(status_code=403, detail="Bu işlem için admin yetkisi gerekli")
     
-    # Tüm sistem loglarını getir
-    logs_cursor = db.system_logs.find({}).sort("timestamp", -1)
-    logs = await logs_cursor.to_list(length=None)
+    if request.format not in ("json", "ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Desteklenmeyen format")
     
-    # Logları temizle ve formatla
-    export_data = {
-        "export_info": {
+    query = build_system_log_query(request)
+    cursor = db.system_logs.find(query, {"_id": 0}).sort("timestamp", -1).batch_size(EXPORT_BATCH_SIZE)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    
+    if request.format == "csv":
+        body = iter_system_logs_csv(cursor)
+        media_type = "text/csv; charset=utf-8"
+    elif request.format == "ndjson":
+        body = iter_ndjson(cursor)
+        media_type = "application/x-ndjson"
+    else:
+        export_info = {
             "generated_at": datetime.now(timezone.utc).isoformat(),
             "generated_by": current_user.get("email"),
-            "total_logs": len(logs)
-        },
-        "logs": []
-    }
-    
-    for log in logs:
-        log_dict = dict(log)
-        if "_id" in log_dict:
-            del log_dict["_id"]
-        export_data["logs"].append(log_dict)
-    
-    # JSON response olarak dön
-    import json
-    json_content = json.dumps(export_data, indent=2, ensure_ascii=False, default=str)
-    
-    from fastapi.responses import Response
-    return Response(
-        content=json_content,
-        media_type="application/json",
-        headers={
-            "Content-Disposition": f"attachment; filename=system_logs_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+            "total_logs": await db.system_logs.count_documents(query),
+            "filters": request.dict(exclude={"format"}, exclude_none=True)
         }
+        body = iter_system_logs_json(cursor, export_info)
+        media_type = "application/json"
+    
+    return StreamingResponse(
+        coalesce_chunks(body),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=system_logs_{timestamp}.{request.format}"}
     )
 
 @api_router.post("/admin/bulk-approve-users")
@@ -1930,6 +2162,9 @@ async def bulk_reject_users(request: BulkUserRequest, current_user: dict = Depen
     
     # Kullanıcıların e-postalarını da sil
     await db.emails.delete_many({"user_id": {"$in": request.user_ids}})
+    await db.attachment_texts.delete_many({"user_id": {"$in": request.user_ids}})
+    for user_id in request.user_ids:
+        await bump_mailbox_version(user_id)
     
     # Log ekle
     await add_system_log(
@@ -2015,8 +2250,159 @@ async def delete_email(email_id: str, current_user: dict = Depends(get_current_u
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Email not found")
     
+    await db.attachment_texts.delete_many({"email_id": email_id, "user_id": current_user["id"]})
+    await bump_mailbox_version(current_user["id"])
+    
     return {"success": True, "message": "Email permanently deleted"}
 
+SYNC_MAX_CONCURRENCY = int(os.environ.get('SYNC_MAX_CONCURRENCY', '8'))
+# Graph, uygulama başına posta kutusu başına en fazla 4 eşzamanlı isteğe izin verir
+SYNC_MAILBOX_CONCURRENCY = int(os.environ.get('SYNC_MAILBOX_CONCURRENCY', '2'))
+
+# Bağlı Outlook hesaplarında senkronize edilen klasörler
+OUTLOOK_SYNC_FOLDERS = [
+    {"name": "inbox", "display_name": "Inbox", "folder_type": "inbox"},
+    {"name": "sent", "display_name": "Sent Items", "folder_type": "sent"},
+    {"name": "drafts", "display_name": "Drafts", "folder_type": "drafts"},
+    {"name": "junk", "display_name": "Junk Email", "folder_type": "spam"}  # Spam klasörü
+]
+
+
+class SyncLimiter:
+    """
+    Klasör senkronizasyonları için iki katmanlı eşzamanlılık sınırı: sunucu genelinde
+    max_total, posta kutusu (bağlı hesap) başına per_mailbox. Önce posta kutusu slotu alınır,
+    böylece sırada bekleyen bir klasör genel slotu boşuna tutmaz.
+    """
+    
+    def __init__(self, max_total: int, per_mailbox: int):
+        self.max_total = max(1, max_total)
+        self.per_mailbox = max(1, per_mailbox)
+        self._total: Optional[asyncio.Semaphore] = None
+        self._mailboxes: Dict[str, list] = {}
+        self.active = 0
+        self.waiting = 0
+        self.stats = {
+            "folders_synced": 0, "folders_failed": 0, "wait_seconds": 0.0, "sync_seconds": 0.0,
+            "pages": 0, "page_messages": 0, "page_fetch_seconds": 0.0, "page_write_seconds": 0.0,
+            "slowest_page_seconds": 0.0
+        }
+    
+    @contextlib.asynccontextmanager
+    async def slot(self, mailbox: str):
+        if self._total is None:
+            self._total = asyncio.Semaphore(self.max_total)
+        # [semaphore, kullanan sayısı]; kimse kullanmayınca posta kutusu kaydı silinir
+        entry = self._mailboxes.setdefault(mailbox, [asyncio.Semaphore(self.per_mailbox), 0])
+        entry[1] += 1
+        self.waiting += 1
+        waiting, started = True, time.monotonic()
+        try:
+            async with entry[0], self._total:
+                self.waiting -= 1
+                waiting = False
+                self.stats["wait_seconds"] += time.monotonic() - started
+                self.active += 1
+                try:
+                    yield
+                finally:
+                    self.active -= 1
+        finally:
+            if waiting:
+                self.waiting -= 1
+            entry[1] -= 1
+            if not entry[1]:
+                self._mailboxes.pop(mailbox, None)
+    
+    def record(self, result: Dict[str, Any]):
+        self.stats["folders_failed" if result.get("error") else "folders_synced"] += 1
+        self.stats["sync_seconds"] += result.get("seconds", 0.0)
+    
+    def record_page(self, fetch_seconds: float, write_seconds: float, messages: int):
+        """Bir sayfanın Graph'tan çekilme ve veritabanına yazılma süreleri"""
+        self.stats["pages"] += 1
+        self.stats["page_messages"] += messages
+        self.stats["page_fetch_seconds"] += fetch_seconds
+        self.stats["page_write_seconds"] += write_seconds
+        self.stats["slowest_page_seconds"] = max(self.stats["slowest_page_seconds"], fetch_seconds + write_seconds)
+    
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "max_total": self.max_total,
+            "per_mailbox": self.per_mailbox,
+            "active": self.active,
+            "waiting": self.waiting,
+            "mailboxes": len(self._mailboxes),
+            **{key: round(value, 3) if isinstance(value, float) else value for key, value in self.stats.items()}
+        }
+
+
+sync_limiter = SyncLimiter(SYNC_MAX_CONCURRENCY, SYNC_MAILBOX_CONCURRENCY)
+
+
+async def run_limited_folder_sync(mailbox: str, sync) -> Dict[str, Any]:
+    """sync() klasör senkronizasyonunu limiter slotunda çalıştır; hata sonuç sözlüğüne yazılır"""
+    started = time.monotonic()
+    async with sync_limiter.slot(mailbox):
+        try:
+            result = await sync()
+        except HTTPException as e:
+            result = {"synced_count": 0, "error": str(e.detail)}
+        except Exception as e:
+            result = {"synced_count": 0, "error": str(e)}
+    result["seconds"] = round(time.monotonic() - started, 3)
+    sync_limiter.record(result)
+    return result
+
+
+# Graph sayfa boyutu; Prefer: odata.maxpagesize ile istenir (sunucu daha küçük sayfa dönebilir)
+GRAPH_PAGE_SIZE = int(os.environ.get('GRAPH_PAGE_SIZE', '50'))
+
+
+class GraphAPIError(Exception):
+    """Graph isteği 200 dışında bir durum kodu döndü"""
+    
+    def __init__(self, status_code: int, detail: str = "", retry_after: Optional[float] = None):
+        super().__init__(f"Graph API error: {status_code}" + (f" - {detail[:200]}" if detail else ""))
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def graph_error_is_transient(status_code: int) -> bool:
+    """
+    Kısıtlama (429) ve sunucu hataları geçicidir; istek aynen tekrar denenir. 401 geçici değildir:
+    aynı jetonla tekrar denemek işe yaramaz, jeton yenilenmelidir.
+    """
+    return status_code == 429 or status_code >= 500
+
+
+def retry_after_seconds(headers) -> Optional[float]:
+    """Retry-After başlığı (Graph saniye cinsinden gönderir); yoksa ya da okunamazsa None"""
+    value = (headers or {}).get("Retry-After") or (headers or {}).get("retry-after")
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+async def iter_graph_pages(url: str, headers: dict, params: Optional[dict] = None, page_size: int = GRAPH_PAGE_SIZE):
+    """
+    Graph koleksiyonunu @odata.nextLink ile sayfala; $skip kullanılmaz, sunucunun imleci
+    sayfalar büyüdükçe pahalılaşmaz ve arada gelen yeni mesajlar sayfaları kaydırmaz.
+    nextLink sorgu parametrelerini taşıdığı için params yalnızca ilk istekte gönderilir.
+    Her sayfa (yanıt gövdesi, çekme süresi) olarak döner; çağıran istediği anda durabilir.
+    """
+    headers = {**headers, "Prefer": f"odata.maxpagesize={page_size}"}
+    while url:
+        started = time.monotonic()
+        response = await outbound_http.get(url, headers=headers, params=params)
+        if response.status_code != 200:
+            raise GraphAPIError(response.status_code, response.text)
+        page = response.json()
+        yield page, time.monotonic() - started
+        url, params = page.get("@odata.nextLink"), None
+
+
 @api_router.post("/sync-emails")
 async def sync_emails(current_user: dict = Depends(get_current_user)):
     """Sync emails from connected Outlook accounts"""
@@ -2059,206 +2445,237 @@ async def sync_emails(current_user: dict = Depends(get_current_user)):
                 }
                 new_emails.append(email)
             
-            if new_emails:
-                await db.emails.insert_many(new_emails)
+            result = await bulk_upsert_emails(new_emails)
+            if result["inserted"]:
+                await bump_mailbox_version(current_user["id"])
             
-            return {"success": True, "new_emails": len(new_emails), "message": "Demo e-postalar eklendi"}
+            return {"success": True, "new_emails": result["inserted"], "message": "Demo e-postalar eklendi"}
         else:
             raise HTTPException(
                 status_code=400, 
                 detail="Senkronizasyon için en az bir Outlook hesabı bağlanmalıdır"
             )
     
-    # Gerçek Outlook hesaplarından e-posta senkronizasyonu
-    total_synced = 0
+    # Gerçek Outlook hesaplarından e-posta senkronizasyonu: hesaplar ve klasörler eşzamanlı
+    # çalışır, sınırları sync_limiter belirler; toplam süre en yavaş klasöre yaklaşır
+    started = time.monotonic()
+    
+    async def sync_account(account: dict) -> Dict[str, Any]:
+        if not account.get("access_token"):
+            logger.warning(f"No access token for account {account['email']}")
+            return {"account_id": account["id"], "email": account["email"], "synced_count": 0,
+                    "folders": {}, "error": "Erişim anahtarı yok"}
+        result = await sync_outlook_account_emails(account, current_user)
+        logger.info(f"Synced {result['synced_count']} emails from {account['email']}")
+        return result
     
-    for account in connected_accounts:
-        try:
-            # Hesap için senkronizasyon yap
-            if account.get("access_token"):
-                # Microsoft Graph API kullanarak gerçek e-postaları çek
-                synced_count = await sync_outlook_account_emails(account, current_user)
-                total_synced += synced_count
-                logger.info(f"Synced {synced_count} emails from {account['email']}")
-            else:
-                logger.warning(f"No access token for account {account['email']}")
-                
-        except Exception as e:
-            logger.error(f"Error syncing account {account.get('email', 'unknown')}: {e}")
-            # Bir hesaptan hata gelirse diğer hesapları da dene
-            continue
+    accounts = await asyncio.gather(*(sync_account(account) for account in connected_accounts))
+    total_synced = sum(account["synced_count"] for account in accounts)
+    error_count = sum(
+        bool(account.get("error")) + sum(1 for folder in account["folders"].values() if folder.get("error"))
+        for account in accounts
+    )
     
     # Son senkronizasyon zamanını güncelle
-    for account in connected_accounts:
-        await db.connected_accounts.update_one(
-            {"id": account["id"]},
-            {"$set": {"last_sync": datetime.now(timezone.utc)}}
-        )
+    await db.connected_accounts.update_many(
+        {"id": {"$in": [account["id"] for account in connected_accounts]}},
+        {"$set": {"last_sync": datetime.now(timezone.utc)}}
+    )
     
     return {
         "success": True, 
         "new_emails": total_synced,
-        "message": f"{total_synced} e-posta {len(connected_accounts)} hesaptan senkronize edildi"
+        "message": f"{total_synced} e-posta {len(connected_accounts)} hesaptan senkronize edildi",
+        "accounts": accounts,
+        "error_count": error_count,
+        "seconds": round(time.monotonic() - started, 3)
     }
 
 
-async def sync_outlook_account_emails(account: dict, current_user: dict) -> int:
-    """Tek bir Outlook hesabından tüm klasörlerden e-posta senkronize et (geliştirilmiş versiyon)"""
-    try:
-        if not outlook_auth_service.is_configured():
-            logger.warning("Outlook integration not configured")
-            return 0
-        
-        # Senkronize edilecek klasörler - kullanıcının isteği üzerine tüm önemli klasörler
-        folders_to_sync = [
-            {"name": "inbox", "display_name": "Inbox", "folder_type": "inbox"},
-            {"name": "sent", "display_name": "Sent Items", "folder_type": "sent"},
-            {"name": "drafts", "display_name": "Drafts", "folder_type": "drafts"},
-            {"name": "junk", "display_name": "Junk Email", "folder_type": "spam"}  # Spam klasörü
-        ]
-        
-        total_synced = 0
-        
-        # Her klasörü ayrı ayrı senkronize et
-        for folder_info in folders_to_sync:
-            try:
-                synced_count = await sync_folder_emails(
-                    account, 
-                    current_user, 
-                    folder_info["name"], 
-                    folder_info["folder_type"],
-                    email_limit=100  # Kullanıcının belirttiği 100 e-posta limiti
-                )
-                total_synced += synced_count
-                logger.info(f"Synced {synced_count} emails from {folder_info['name']} folder for {account['email']}")
-                
-            except Exception as e:
-                logger.error(f"Error syncing {folder_info['name']} folder for {account['email']}: {e}")
-                continue  # Bir klasörde hata olursa diğerlerine devam et
-        
-        return total_synced
-                    
-    except Exception as e:
-        logger.error(f"Error syncing emails for account {account.get('email', 'unknown')}: {e}")
-        return 0
+async def sync_outlook_account_emails(account: dict, current_user: dict) -> Dict[str, Any]:
+    """
+    Tek bir Outlook hesabının klasörlerini eşzamanlı senkronize et. Bir klasördeki hata
+    diğerlerini durdurmaz; sonuç ve hata klasör başına döner.
+    """
+    summary = {"account_id": account["id"], "email": account["email"], "synced_count": 0, "folders": {}}
+    if not outlook_auth_service.is_configured():
+        logger.warning("Outlook integration not configured")
+        summary["error"] = "Outlook entegrasyonu yapılandırılmamış"
+        return summary
+    
+    async def sync_folder(folder_info: dict):
+        result = await run_limited_folder_sync(account["id"], lambda: sync_folder_emails(
+            account,
+            current_user,
+            folder_info["name"],
+            folder_info["folder_type"]
+        ))
+        if result.get("error"):
+            logger.error(f"Error syncing {folder_info['name']} folder for {account['email']}: {result['error']}")
+        else:
+            logger.info(f"Synced {result['synced_count']} emails from {folder_info['name']} folder for {account['email']}")
+        return folder_info["name"], result
+    
+    summary["folders"] = dict(await asyncio.gather(*(sync_folder(folder) for folder in OUTLOOK_SYNC_FOLDERS)))
+    summary["synced_count"] = sum(result["synced_count"] for result in summary["folders"].values())
+    return summary
+
+
+# Graph delta sorgusunda istenen alanlar: yalnızca başlıklar (gövde BodyHydrator ile ikinci
+# aşamada gelir); Message-ID tekilleştirme anahtarı için gerekli
+OUTLOOK_DELTA_SELECT = (
+    "id,internetMessageId,conversationId,subject,sender,from,toRecipients,receivedDateTime,"
+    "bodyPreview,isRead,importance,hasAttachments"
+)
+# Delta ile gelen bir mesaj zaten varsa güncellenen alanlar: taşınan mesajın Graph kimliği ve
+# klasörü değişir, okundu/önem durumu Outlook tarafında değişmiş olabilir
+OUTLOOK_DELTA_UPDATE_FIELDS = ("outlook_id", "folder", "read", "important")
+
+
+async def apply_outlook_delta(items: List[dict], account: dict, current_user: dict, folder_type: str) -> Dict[str, Any]:
+    """
+    Bir delta sayfasını tek bulk_write ile uygula: yeni mesajlar eklenir, var olanlarda
+    OUTLOOK_DELTA_UPDATE_FIELDS güncellenir, "@removed" işaretli mesajlar Graph kimliğiyle silinir.
+    Başka klasöre taşınan mesaj önce yeni kimlikle güncellenirse eski kimliğe gelen silme boşa düşer.
+    Sayfadaki anahtarlar tek $in sorgusuyla kontrol edilir: bilinen mesajlar için yalnızca
+    değişebilen alanlar gönderilir, tam belge sadece yeni mesajlarda yazılır.
+    """
+    emails, removed = [], []
+    for item in items:
+        if "@removed" in item:
+            removed.append(item["id"])
+        else:
+            email = await convert_outlook_email_to_db_format(item, account, current_user, folder_type)
+            email_dedup_filter(email)
+            emails.append(email)
+    known = await existing_dedup_keys(current_user["id"], account["id"], (email["dedup_key"] for email in emails))
+    known |= await adopt_legacy_graph_emails(
+        current_user["id"], account["id"], [email for email in emails if email["dedup_key"] not in known]
+    )
+    operations = [
+        UpdateOne(email_dedup_filter(email), {"$set": {key: email[key] for key in OUTLOOK_DELTA_UPDATE_FIELDS}})
+        if email["dedup_key"] in known else email_upsert(email, OUTLOOK_DELTA_UPDATE_FIELDS)
+        for email in emails
+    ]
+    operations += [
+        DeleteOne({"user_id": current_user["id"], "account_id": account["id"], "outlook_id": outlook_id})
+        for outlook_id in removed
+    ]
+    result = await bulk_write_emails(operations)
+    return {
+        "inserted": len(result["upserted"]),
+        "updated": result["modified"],
+        "removed": result["removed"],
+        "failed": result["failed"],
+    }
 
 
-async def sync_folder_emails(account: dict, current_user: dict, folder_name: str, folder_type: str, email_limit: int = 100) -> int:
-    """Belirtilen klasörden e-postaları senkronize et (pagination desteği ile)"""
+async def sync_folder_emails(account: dict, current_user: dict, folder_name: str, folder_type: str) -> Dict[str, Any]:
+    """
+    Klasörü Graph delta sorgusuyla senkronize et. Hesapta bu klasör için saklanan bağlantı
+    (sync_tokens) yoksa ilk tur klasörü en yeniden eskiye sayfalar (sayfalar yalnızca başlık
+    taşıdığı için tur sınırlanmaz, yeni posta ilk sayfalarda görünür); varsa yalnızca son
+    turdan beri eklenen, değişen ve silinen mesajlar gelir, değişiklik yoksa tek küçük istek yeter.
+    Her sayfa tek bulk_write ile uygulanır; bağlantı yalnızca sayfa hatasız yazıldıysa ilerler,
+    çünkü Graph aynı değişiklikleri bir daha göndermez. Yarıda kalan tur (nextLink) sonraki
+    senkronizasyonda kaldığı yerden sürer. Graph eşitleme durumunu düşürürse (410) tur baştan başlar.
+    Dönen sözlük: {"synced_count", "updated_count", "removed_count", "error"}; kısmi hatada
+    o ana kadar uygulananlar sayılır.
+    """
+    counts = {"inserted": 0, "updated": 0, "removed": 0}
     try:
         headers = {
             'Authorization': f'Bearer {account["access_token"]}',
             'Content-Type': 'application/json'
         }
-        
-        # Klasör ID'sini al
-        folder_id = await get_outlook_folder_id(headers, folder_name)
-        if not folder_id:
-            logger.warning(f"Folder {folder_name} not found for account {account['email']}")
-            return 0
-        
-        import aiohttp
-        synced_count = 0
-        page_size = 50  # Her sayfada 50 e-posta (Microsoft Graph API limiti)
-        skip = 0
-        
-        async with aiohttp.ClientSession() as session:
-            while synced_count < email_limit:
-                # Remaining emails to fetch
-                remaining = email_limit - synced_count
-                current_page_size = min(page_size, remaining)
-                
-                # Microsoft Graph API endpoint with pagination
-                if folder_name == "inbox":
-                    # Inbox için özel endpoint (daha hızlı)
-                    url = f"https://graph.microsoft.com/v1.0/me/messages?$top={current_page_size}&$skip={skip}&$orderby=receivedDateTime desc"
-                else:
-                    # Diğer klasörler için folder-specific endpoint
-                    url = f"https://graph.microsoft.com/v1.0/me/mailFolders/{folder_id}/messages?$top={current_page_size}&$skip={skip}&$orderby=receivedDateTime desc"
-                
-                async with session.get(url, headers=headers) as response:
-                    if response.status != 200:
-                        logger.error(f"Failed to fetch emails from {folder_name}: {response.status}")
-                        break
-                    
-                    data = await response.json()
-                    emails = data.get('value', [])
-                    
-                    # Eğer bu sayfada e-posta yoksa dur
-                    if not emails:
+        url = (account.get("sync_tokens") or {}).get(folder_name)
+        error = None
+        restarted = False
+        
+        while True:
+            if not url:
+                # Klasör ID'sini yalnızca yeni tur başlarken al
+                folder_id = await get_outlook_folder_id(headers, folder_name)
+                if not folder_id:
+                    logger.warning(f"Folder {folder_name} not found for account {account['email']}")
+                    error = f"Folder '{folder_name}' not found"
+                    break
+                url = (
+                    f"https://graph.microsoft.com/v1.0/me/mailFolders/{folder_id}/messages/delta"
+                    f"?$select={OUTLOOK_DELTA_SELECT}&$orderby=receivedDateTime desc"
+                )
+            
+            try:
+                async for data, fetch_seconds in iter_graph_pages(url, headers):
+                    items = data.get('value', [])
+                    written = time.monotonic()
+                    result = await apply_outlook_delta(items, account, current_user, folder_type)
+                    sync_limiter.record_page(fetch_seconds, time.monotonic() - written, len(items))
+                    for key in counts:
+                        counts[key] += result[key]
+                    if result["failed"]:
+                        # Bağlantı ilerletilmez: sonraki senkronizasyon bu sayfayı yeniden ister
+                        logger.error(f"Delta page for {folder_name} had {result['failed']} write errors, link kept")
+                        error = f"{result['failed']} e-posta yazılamadı"
                         break
                     
-                    new_emails = []
-                    for email_data in emails:
-                        # E-posta zaten var mı kontrol et
-                        existing = await db.emails.find_one({
-                            "user_id": current_user["id"],
-                            "outlook_id": email_data["id"]
-                        })
-                        
-                        if existing:
-                            continue  # Bu e-posta zaten var, atla
-                        
-                        # E-postayı dönüştür
-                        email = await convert_outlook_email_to_db_format(
-                            email_data, 
-                            account, 
-                            current_user, 
-                            folder_type
+                    link = data.get('@odata.nextLink') or data.get('@odata.deltaLink')
+                    if link:
+                        await db.connected_accounts.update_one(
+                            {"id": account["id"]}, {"$set": {f"sync_tokens.{folder_name}": link}}
                         )
-                        new_emails.append(email)
-                    
-                    # Yeni e-postaları veritabanına ekle
-                    if new_emails:
-                        await db.emails.insert_many(new_emails)
-                        synced_count += len(new_emails)
-                    
-                    # Eğer bu sayfada dönen e-posta sayısı page_size'dan azsa, son sayfaya ulaştık
-                    if len(emails) < current_page_size:
-                        break
-                    
-                    skip += current_page_size
-        
-        return synced_count
+            except GraphAPIError as e:
+                if e.status_code == 410 and not restarted:
+                    logger.info(f"Delta state expired for {folder_name} ({account['email']}), restarting")
+                    url, restarted = None, True
+                    continue
+                logger.error(f"Failed to fetch delta for {folder_name}: {e.status_code}")
+                error = f"Graph API error: {e.status_code}"
+            break
+        
+        return {"synced_count": counts["inserted"], "updated_count": counts["updated"],
+                "removed_count": counts["removed"], "error": error}
         
     except Exception as e:
         logger.error(f"Error syncing folder {folder_name}: {e}")
-        return 0
+        return {"synced_count": counts["inserted"], "updated_count": counts["updated"],
+                "removed_count": counts["removed"], "error": str(e)}
+    finally:
+        if any(counts.values()):
+            await bump_mailbox_version(current_user["id"])
+        if counts["inserted"]:
+            body_hydrator.notify()
 
 
 async def get_outlook_folder_id(headers: dict, folder_name: str) -> str:
     """Outlook klasör ID'sini al"""
     try:
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
-            url = "https://graph.microsoft.com/v1.0/me/mailFolders"
-            async with session.get(url, headers=headers) as response:
-                if response.status != 200:
-                    return None
-                
-                data = await response.json()
-                folders = data.get('value', [])
-                
-                # Klasör isim eşleştirmeleri
-                folder_mappings = {
-                    "inbox": ["inbox", "gelen kutusu"],
-                    "sent": ["sentitems", "sent items", "gönderilmiş öğeler"],
-                    "drafts": ["drafts", "taslaklar"],
-                    "junk": ["junkemail", "junk email", "spam", "istenmeyen"]
-                }
-                
-                target_names = folder_mappings.get(folder_name.lower(), [folder_name.lower()])
-                
-                # Klasör bul
-                for folder in folders:
-                    display_name = folder.get("displayName", "").lower()
-                    folder_id = folder.get("id")
-                    
-                    for target_name in target_names:
-                        if target_name in display_name or display_name == target_name:
-                            return folder_id
-                
-                return None
+        # Klasör listesi de sayfalıdır; ilk sayfada olmayan klasörler için nextLink izlenir
+        url = "https://graph.microsoft.com/v1.0/me/mailFolders"
+        folders = []
+        async for data, _ in iter_graph_pages(url, headers):
+            folders.extend(data.get('value', []))
+        
+        # Klasör isim eşleştirmeleri
+        folder_mappings = {
+            "inbox": ["inbox", "gelen kutusu"],
+            "sent": ["sentitems", "sent items", "gönderilmiş öğeler"],
+            "drafts": ["drafts", "taslaklar"],
+            "junk": ["junkemail", "junk email", "spam", "istenmeyen"]
+        }
+        
+        target_names = folder_mappings.get(folder_name.lower(), [folder_name.lower()])
+        
+        # Klasör bul
+        for folder in folders:
+            display_name = folder.get("displayName", "").lower()
+            folder_id = folder.get("id")
+            
+            for target_name in target_names:
+                if target_name in display_name or display_name == target_name:
+                    return folder_id
+        
+        return None
                 
     except Exception as e:
         logger.error(f"Error getting folder ID for {folder_name}: {e}")
@@ -2283,10 +2700,15 @@ async def convert_outlook_email_to_db_format(email_data: dict, account: dict, cu
         
         recipient_display = ", ".join(recipients) if recipients else current_user["email"]
         
-        # İçerik bilgilerini al
-        body = email_data.get("body", {})
-        content = body.get("content", "")
-        content_type = "html" if body.get("contentType", "").lower() == "html" else "text"
+        # İçerik bilgilerini al; gövdesiz (yalnızca başlık) senkronizasyonda önizleme içerik olur
+        # ve gövde BodyHydrator tarafından sonradan yazılır
+        if "body" in email_data:
+            body_fields = graph_body_fields(email_data["body"])
+        else:
+            preview = email_data.get("bodyPreview", "")
+            body_fields = {"content": preview, "content_type": "text", "size": len(preview.encode('utf-8')) or 1024,
+                           "body_pending": True, "body_priority": 0, "body_attempts": 0, "body_lease_until": None}
+        content = body_fields["content"]
         
         # Tarih bilgisini dönüştür
         received_datetime = email_data.get("receivedDateTime")
@@ -2303,18 +2725,18 @@ async def convert_outlook_email_to_db_format(email_data: dict, account: dict, cu
         return {
             "id": str(uuid.uuid4()),
             "outlook_id": email_data["id"],
+            "internet_message_id": email_data.get("internetMessageId"),
             "user_id": current_user["id"],
             "folder": folder_type,  # inbox, sent, drafts, spam
             "sender": sender_display,
             "recipient": recipient_display,
             "subject": email_data.get("subject", "Başlıksız"),
-            "content": content,
-            "content_type": content_type,
+            **body_fields,
             "preview": email_data.get("bodyPreview", content[:200])[:200],
             "date": date_str,
             "read": email_data.get("isRead", False),
             "important": email_data.get("importance", "").lower() == "high",
-            "size": len(content.encode('utf-8')) if content else 1024,
+            "has_attachments": email_data.get("hasAttachments", False),
             "account_id": account["id"],
             "thread_id": email_data.get("conversationId", str(uuid.uuid4())),
             "attachments": [],  # TODO: Attachments gelecekte eklenebilir
@@ -2347,90 +2769,1930 @@ async def convert_outlook_email_to_db_format(email_data: dict, account: dict, cu
             "synced_at": datetime.now(timezone.utc)
         }
 
-@api_router.post("/import-emails")
-async def import_emails(file: UploadFile = File(...), current_user: dict = Depends(get_current_user)):
-    if not file.filename.lower().endswith(('.pst', '.ost', '.eml')):
-        raise HTTPException(status_code=400, detail="Desteklenmeyen dosya formatı")
-    
-    # Read file content
-    content = await file.read()
-    file_size = len(content)
-    
-    # Generate demo emails based on file size (simulate parsing)
-    email_count = min(max(file_size // 1000, 1), 20)  # 1-20 emails based on file size
-    
-    # Bağlı hesaplardan sender bilgilerini al
-    connected_accounts = await db.connected_accounts.find({"user_id": current_user["id"]}).to_list(length=None)
-    
-    if not connected_accounts:
-        # Eğer bağlı hesap yoksa, demo sender'lar kullan
-        senders = ["imported@outlook.com (İçe Aktarılan)", "archive@outlook.com (Arşiv)", "backup@outlook.com (Yedek)"]
-    else:
-        senders = []
-        for account in connected_accounts:
-            email = account["email"]
-            name = account.get("name", email.split("@")[0].replace(".", " ").title())
-            sender_format = f"{email} ({name})" if name and name != email.split("@")[0].replace(".", " ").title() else email
-            senders.append(sender_format)
-    
-    imported_emails = []
-    for i in range(email_count):
-        sender = random.choice(senders)
-        email_size = random.randint(1024, 8192)  # 1-8KB per email
-        email = {
-            "id": str(uuid.uuid4()),
-            "user_id": current_user["id"],
-            "folder": "inbox",
-            "sender": sender,
-            "recipient": current_user["email"],
-            "subject": f"İçe Aktarılan E-posta {i+1} - {file.filename}",
-            "content": f"Bu e-posta {file.filename} dosyasından içe aktarılmıştır. Gönderen: {sender}, Orijinal boyut: {file_size} bytes\n\nİçerik özeti: Dosyadan başarıyla içe aktarılan e-posta verisi.",
-            "preview": f"Bu e-posta {file.filename} dosyasından içe aktarılmıştır...",
-            "date": datetime.now(timezone.utc).isoformat(),
-            "read": False,
-            "important": False,
-            "size": email_size
-        }
-        imported_emails.append(email)
-    
-    if imported_emails:
-        await db.emails.insert_many(imported_emails)
-    
-    return {"success": True, "count": len(imported_emails)}
+# ============== BODY HYDRATION ==============
 
-@api_router.post("/update-demo-emails")
-async def update_demo_emails(current_user: dict = Depends(get_current_user)):
+# Senkronizasyon önce yalnızca başlıkları yazar ve mesajlar hemen listelenir; gövdeler arka
+# planda öncelik sırasıyla, açılan e-postalarda ise istek anında Graph'tan çekilir
+BODY_HYDRATE_ENABLED = os.environ.get('BODY_HYDRATE_ENABLED', 'true').lower() == 'true'
+BODY_HYDRATE_BATCH = min(20, int(os.environ.get('BODY_HYDRATE_BATCH', '20')))  # Graph $batch en fazla 20 istek
+BODY_HYDRATE_INTERVAL = float(os.environ.get('BODY_HYDRATE_INTERVAL', '30'))
+BODY_HYDRATE_LEASE = int(os.environ.get('BODY_HYDRATE_LEASE', '120'))
+BODY_HYDRATE_MAX_ATTEMPTS = int(os.environ.get('BODY_HYDRATE_MAX_ATTEMPTS', '3'))
+# Açılıp anında doldurulamayan e-posta kuyruğun önüne geçer; diğerleri tarihe göre (yeni önce)
+BODY_PRIORITY_OPENED = 10
+BODY_PENDING_FIELDS = ("body_pending", "body_priority", "body_attempts", "body_lease_until", "body_lease_token")
+
+
+def graph_body_fields(body: dict) -> Dict[str, Any]:
+    """Graph body nesnesinden content, content_type ve size alanları"""
+    content = (body or {}).get("content", "")
+    return {
+        "content": content,
+        "content_type": "html" if (body or {}).get("contentType", "").lower() == "html" else "text",
+        "size": len(content.encode('utf-8')) if content else 1024,
+    }
+
+
+async def fetch_message_bodies(access_token: str, outlook_ids: List[str]
+                               ) -> Tuple[Dict[str, Optional[dict]], List[str], Optional[float]]:
     """
-    Mevcut demo emaillerini bağlı hesap bilgileriyle günceller
+    Mesaj gövdelerini tek JSON $batch isteğiyle çek. (gövdeler, kalıcı hatalar, retry_after) döner:
+    gövdeler sözlüğünde 404 alan (sunucuda silinmiş) mesajlar None, başarılılar Graph body
+    nesnesidir; kalıcı hatalar diğer 4xx yanıtlarıdır. Geçici hatalar (429, 5xx) ikisinde de
+    yer almaz; retry_after bunların en uzun Retry-After süresidir. Jeton geçersizse (401)
+    GraphAPIError(401) yükselir.
+    """
+    requests = [
+        {"id": str(index), "method": "GET", "url": f"/me/messages/{outlook_id}?$select=body"}
+        for index, outlook_id in enumerate(outlook_ids)
+    ]
+    response = await outbound_http.post(
+        "https://graph.microsoft.com/v1.0/$batch",
+        headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+        json={"requests": requests}
+    )
+    if response.status_code != 200:
+        raise GraphAPIError(response.status_code, response.text, retry_after=retry_after_seconds(response.headers))
+    bodies, failed, retry_after = {}, [], None
+    for item in response.json().get("responses", []):
+        outlook_id = outlook_ids[int(item["id"])]
+        status = item.get("status") or 500
+        if status == 200:
+            bodies[outlook_id] = (item.get("body") or {}).get("body") or {}
+        elif status == 404:
+            bodies[outlook_id] = None
+        elif status == 401:
+            raise GraphAPIError(401, "access token rejected in batch")
+        elif graph_error_is_transient(status):
+            wait = retry_after_seconds(item.get("headers"))
+            if wait is not None:
+                retry_after = max(retry_after or 0.0, wait)
+        else:
+            failed.append(outlook_id)
+    return bodies, failed, retry_after
+
+
+class BodyHydrator:
+    """
+    Başlığı yazılmış ama gövdesi bekleyen (body_pending) Outlook e-postalarını doldurur.
+    Her turda en öncelikli e-postanın hesabından BODY_HYDRATE_BATCH e-posta kiralanır
+    (body_lease_until) ve tek $batch isteğiyle çekilir; kira süresi dolan e-postalar başka bir
+    sunucu ya da sonraki tur tarafından yeniden alınabilir. Graph çağrıları senkronizasyonla aynı
+    posta kutusu sınırını (sync_limiter) paylaşır. Yalnızca kalıcı hatalar deneme sayılır ve
+    BODY_HYDRATE_MAX_ATTEMPTS'e ulaşan e-posta açıldığında ya da hesabın jetonu yenilendiğinde
+    tekrar denenir; geçici hatalarda (429, 5xx, bağlantı) kira süresi ya da Retry-After kadar
+    beklenir. 401'de jeton bir kez yenilenir; yine alınamazsa hesap park edilir
+    (body_hydration_parked) ve reset_account'a kadar turlara alınmaz.
     """
-    # Bağlı hesaplardan sender bilgilerini al
-    connected_accounts = await db.connected_accounts.find({"user_id": current_user["id"]}).to_list(length=None)
-    
-    if not connected_accounts:
-        return {"success": False, "message": "Bağlı hesap bulunamadı"}
     
-    # Mevcut demo emailleri bul
-    demo_emails = await db.emails.find({"user_id": current_user["id"]}).to_list(length=None)
+    def __init__(self, batch_size: int, interval: float, lease_seconds: int, max_attempts: int):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lease = timedelta(seconds=lease_seconds)
+        self.max_attempts = max_attempts
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self.stats = {"batches": 0, "hydrated": 0, "gone": 0, "failed": 0, "deferred": 0, "lease_lost": 0,
+                      "accounts_parked": 0, "on_demand": 0, "on_demand_failed": 0, "fetch_seconds": 0.0}
+    
+    def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._loop())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+    
+    def notify(self):
+        """Senkronizasyon yeni başlık yazdı; bekleme aralığını beklemeden tur başlat"""
+        if self._wake:
+            self._wake.set()
+    
+    async def reset_account(self, account_id: str):
+        """Hesaba yeni jeton yazıldı: hesabın parkını kaldır, park edilmiş e-postaların deneme sayısını sıfırla"""
+        await db.connected_accounts.update_one({"id": account_id}, {"$unset": {"body_hydration_parked": ""}})
+        await db.emails.update_many(
+            {"account_id": account_id, "body_pending": True, "body_attempts": {"$gt": 0}},
+            {"$set": {"body_attempts": 0}}
+        )
+        self.notify()
     
-    if not demo_emails:
-        return {"success": False, "message": "Güncellenecek email bulunamadı"}
+    async def _loop(self):
+        while True:
+            try:
+                processed = await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Body hydration failed: {e}")
+                processed = 0
+            if processed:
+                continue
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
     
-    # Sender mapppingi oluştur
-    sender_mapping = {}
-    for account in connected_accounts:
-        email = account["email"]
-        name = account.get("name", email.split("@")[0].replace(".", " ").title())
-        sender_format = f"{email} ({name})" if name and name != email.split("@")[0].replace(".", " ").title() else email
-        sender_mapping[email] = sender_format
+    def _pending_query(self, now: datetime) -> Dict[str, Any]:
+        return {
+            "body_pending": True,
+            "body_attempts": {"$lt": self.max_attempts},
+            "$or": [{"body_lease_until": None}, {"body_lease_until": {"$lt": now}}],
+        }
     
-    # Demo emailleri güncelle
-    updated_count = 0
-    for demo_email in demo_emails:
-        old_sender = demo_email["sender"]
+    async def run_once(self) -> int:
+        """Bir hesap için en öncelikli bekleyen gövdeleri doldur; işlenen e-posta sayısını döndür"""
+        now = datetime.now(timezone.utc)
+        pending = self._pending_query(now)
+        parked = await db.connected_accounts.distinct("id", {"body_hydration_parked": True})
+        if parked:
+            pending["account_id"] = {"$nin": parked}
+        first = await db.emails.find_one(pending, {"_id": 0, "account_id": 1}, sort=[("body_priority", -1), ("date", -1)])
+        if not first:
+            return 0
+        account_id = first["account_id"]
+        candidates = await db.emails.find(
+            {**pending, "account_id": account_id}, {"_id": 0, "id": 1}
+        ).sort([("body_priority", -1), ("date", -1)]).limit(self.batch_size).to_list(length=self.batch_size)
+        ids = [doc["id"] for doc in candidates]
+        token = uuid.uuid4().hex
+        await db.emails.update_many(
+            {**pending, "id": {"$in": ids}}, {"$set": {"body_lease_until": now + self.lease, "body_lease_token": token}}
+        )
+        # Yalnızca bu turun kiraladığı e-postalar çekilir; aynı anda seçen başka sunucu diğerlerini almıştır
+        docs = await db.emails.find(
+            {"id": {"$in": ids}, "body_lease_token": token, "body_pending": True},
+            {"_id": 0, "id": 1, "user_id": 1, "outlook_id": 1}
+        ).to_list(length=self.batch_size)
+        self.stats["lease_lost"] += len(ids) - len(docs)
+        if not docs:
+            return len(ids)
+        ids = [doc["id"] for doc in docs]
+        
+        account = await db.connected_accounts.find_one({"id": account_id}, {"_id": 0, "id": 1})
+        if not account:
+            # Hesap kaldırılmış: e-postalar açılana kadar park edilir
+            await db.emails.update_many({"id": {"$in": ids}}, {"$set": {"body_attempts": self.max_attempts}})
+            self.stats["failed"] += len(ids)
+            return len(ids)
         
-        # Eski formatı kontrol et (sadece email varsa)
-        if "@" in old_sender and "(" not in old_sender:
-            # Bağlı hesaplarda bu email var mı kontrol et
+        started = time.monotonic()
+        outlook_ids = [doc["outlook_id"] for doc in docs]
+        try:
+            fetched = await self._fetch(account_id, outlook_ids)
+        except GraphAPIError as e:
+            logger.warning(f"Body hydration batch failed for account {account_id}: {e}")
+            transient = graph_error_is_transient(e.status_code)
+            fetched = {}, [] if transient else outlook_ids, e.retry_after
+        except Exception as e:
+            logger.warning(f"Body hydration batch failed for account {account_id}: {e}")
+            fetched = {}, [], None
+        self.stats["fetch_seconds"] += time.monotonic() - started
+        self.stats["batches"] += 1
+        if fetched is None:
+            # Hesap park edildi: kira bırakılır, yeni jetonla hemen yeniden alınabilsin
+            await db.emails.update_many(
+                {"id": {"$in": ids}, "body_lease_token": token}, {"$set": {"body_lease_until": None}}
+            )
+            return len(docs)
+        await self.apply(docs, *fetched)
+        return len(docs)
+    
+    async def _fetch(self, account_id: str, outlook_ids: List[str]):
+        """
+        Gövdeleri geçerli jetonla çek. 401'de jeton bir kez zorla yenilenip tekrar denenir; jeton
+        alınamazsa hesap park edilir ve None döner.
+        """
+        for force_refresh in (False, True):
+            access_token = await get_valid_access_token(account_id, force_refresh=force_refresh)
+            if not access_token:
+                break
+            try:
+                async with sync_limiter.slot(account_id):
+                    return await fetch_message_bodies(access_token, outlook_ids)
+            except GraphAPIError as e:
+                if e.status_code != 401:
+                    raise
+        await self.park_account(account_id)
+        return None
+    
+    async def park_account(self, account_id: str):
+        """Hesabın gövde doldurmasını yeni jeton yazılana (reset_account) kadar durdur"""
+        logger.warning(f"Body hydration parked for account {account_id}: no valid access token")
+        await db.connected_accounts.update_one({"id": account_id}, {"$set": {"body_hydration_parked": True}})
+        self.stats["accounts_parked"] += 1
+    
+    async def apply(self, docs: List[dict], bodies: Dict[str, Optional[dict]],
+                    failed: List[str] = (), retry_after: Optional[float] = None):
+        """
+        Çekilen gövdeleri tek bulk_write ile yaz. Kalıcı hata alanların deneme sayısı artar; geçici
+        hata alanlar sayılmaz, kira Retry-After süresi kadar uzatılır (yoksa kira süresi beklenir).
+        """
+        unset = {field: "" for field in BODY_PENDING_FIELDS}
+        operations, users = [], set()
+        failed = set(failed)
+        retry_at = datetime.now(timezone.utc) + timedelta(seconds=retry_after) if retry_after else None
+        for doc in docs:
+            query = {"id": doc["id"], "body_pending": True}
+            if doc["outlook_id"] in failed:
+                # Kira bırakılmaz: tekrar deneme kira süresi dolduktan sonra yapılır
+                operations.append(UpdateOne(query, {"$inc": {"body_attempts": 1}}))
+                self.stats["failed"] += 1
+            elif doc["outlook_id"] not in bodies:
+                if retry_at is not None:
+                    operations.append(UpdateOne(
+                        {**query, "body_lease_until": {"$lt": retry_at}}, {"$set": {"body_lease_until": retry_at}}
+                    ))
+                self.stats["deferred"] += 1
+            elif bodies[doc["outlook_id"]] is None:
+                # Sunucuda silinmiş; delta senkronizasyonu kaydı kaldıracak, önizleme içerik olarak kalır
+                operations.append(UpdateOne(query, {"$unset": unset}))
+                self.stats["gone"] += 1
+            else:
+                operations.append(UpdateOne(query, {"$set": graph_body_fields(bodies[doc["outlook_id"]]), "$unset": unset}))
+                users.add(doc["user_id"])
+                self.stats["hydrated"] += 1
+        if operations:
+            await bulk_write_emails(operations)
+        for user_id in users:
+            await bump_mailbox_version(user_id)
+    
+    async def hydrate_now(self, email: dict) -> dict:
+        """
+        Açılan e-postanın gövdesini hemen çek. Başarısız olursa e-posta öne alınır ve
+        önizlemeyle döner; arka plan turu kısa süre içinde tekrar dener.
+        """
+        access_token = await get_valid_access_token(email.get("account_id"))
+        try:
+            if not access_token:
+                raise ValueError("account not connected")
+            async with sync_limiter.slot(email["account_id"]):
+                response = await outbound_http.get(
+                    f"https://graph.microsoft.com/v1.0/me/messages/{email['outlook_id']}?$select=body",
+                    headers={"Authorization": f"Bearer {access_token}"}
+                )
+            if response.status_code not in (200, 404):
+                raise GraphAPIError(response.status_code, response.text)
+        except Exception as e:
+            logger.warning(f"On-demand body fetch failed for email {email['id']}: {e}")
+            self.stats["on_demand_failed"] += 1
+            await db.emails.update_one(
+                {"id": email["id"], "body_pending": True},
+                {"$set": {"body_priority": BODY_PRIORITY_OPENED, "body_attempts": 0, "body_lease_until": None}}
+            )
+            self.notify()
+            return email
+        
+        # 404: mesaj sunucuda silinmiş, önizleme içerik olarak kalır
+        fields = graph_body_fields(response.json().get("body")) if response.status_code == 200 else {}
+        await db.emails.update_one(
+            {"id": email["id"], "body_pending": True},
+            {**({"$set": fields} if fields else {}), "$unset": {field: "" for field in BODY_PENDING_FIELDS}}
+        )
+        await bump_mailbox_version(email["user_id"])
+        self.stats["on_demand"] += 1
+        return {**email, **fields, "body_pending": False}
+    
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "enabled": BODY_HYDRATE_ENABLED,
+            "batch_size": self.batch_size,
+            **{key: round(value, 3) if isinstance(value, float) else value for key, value in self.stats.items()}
+        }
+
+
+body_hydrator = BodyHydrator(BODY_HYDRATE_BATCH, BODY_HYDRATE_INTERVAL, BODY_HYDRATE_LEASE, BODY_HYDRATE_MAX_ATTEMPTS)
+
+
+@api_router.get("/emails/{email_id}/body")
+async def get_email_body(email_id: str, current_user: dict = Depends(get_current_user)):
+    """Açılan e-postanın gövdesi; henüz doldurulmadıysa Graph'tan hemen çekilir"""
+    email = await db.emails.find_one(
+        {"id": email_id, "user_id": current_user["id"]},
+        {"_id": 0, "id": 1, "user_id": 1, "account_id": 1, "outlook_id": 1, "content": 1, "content_type": 1, "body_pending": 1}
+    )
+    if not email:
+        raise HTTPException(status_code=404, detail="Email not found")
+    if email.get("body_pending"):
+        email = await body_hydrator.hydrate_now(email)
+    return {
+        "id": email["id"],
+        "content": email.get("content", ""),
+        "content_type": email.get("content_type", "text"),
+        "body_pending": bool(email.get("body_pending")),
+    }
+
+
+# ============== PST/OST READER ==============
+
+# [MS-PST] NDB_CRYPT_PERMUTE / NDB_CRYPT_CYCLIC tabloları (mpbbR, mpbbS; mpbbI = mpbbR'nin tersi)
+_PST_CRYPT_R = bytes([
+    65, 54, 19, 98, 168, 33, 110, 187, 244, 22, 204, 4, 127, 100, 232, 93, 30, 242, 203, 42, 116,
+    197, 94, 53, 210, 149, 71, 158, 150, 45, 154, 136, 76, 125, 132, 63, 219, 172, 49, 182, 72, 95,
+    246, 196, 216, 57, 139, 231, 35, 59, 56, 142, 200, 193, 223, 37, 177, 32, 165, 70, 96, 78, 156,
+    251, 170, 211, 86, 81, 69, 124, 85, 0, 7, 201, 43, 157, 133, 155, 9, 160, 143, 173, 179, 15,
+    99, 171, 137, 75, 215, 167, 21, 90, 113, 102, 66, 191, 38, 74, 107, 152, 250, 234, 119, 83,
+    178, 112, 5, 44, 253, 89, 58, 134, 126, 206, 6, 235, 130, 120, 87, 199, 141, 67, 175, 180, 28,
+    212, 91, 205, 226, 233, 39, 79, 195, 8, 114, 128, 207, 176, 239, 245, 40, 109, 190, 48, 77, 52,
+    146, 213, 14, 60, 34, 50, 229, 228, 249, 159, 194, 209, 10, 129, 18, 225, 238, 145, 131, 118,
+    227, 151, 230, 97, 138, 23, 121, 164, 183, 220, 144, 122, 92, 140, 2, 166, 202, 105, 222, 80,
+    26, 17, 147, 185, 82, 135, 88, 252, 237, 29, 55, 73, 27, 106, 224, 41, 51, 153, 189, 108, 217,
+    148, 243, 64, 84, 111, 240, 198, 115, 184, 214, 62, 101, 24, 68, 31, 221, 103, 16, 241, 12, 25,
+    236, 174, 3, 161, 20, 123, 169, 11, 255, 248, 163, 192, 162, 1, 247, 46, 188, 36, 104, 117, 13,
+    254, 186, 47, 181, 208, 218, 61
+])
+_PST_CRYPT_S = bytes([
+    20, 83, 15, 86, 179, 200, 122, 156, 235, 101, 72, 23, 22, 21, 159, 2, 204, 84, 124, 131, 0, 13,
+    12, 11, 162, 98, 168, 118, 219, 217, 237, 199, 197, 164, 220, 172, 133, 116, 214, 208, 167,
+    155, 174, 154, 150, 113, 102, 195, 99, 153, 184, 221, 115, 146, 142, 132, 125, 165, 94, 209,
+    93, 147, 177, 87, 81, 80, 128, 137, 82, 148, 79, 78, 10, 107, 188, 141, 127, 110, 71, 70, 65,
+    64, 68, 1, 17, 203, 3, 63, 247, 244, 225, 169, 143, 60, 58, 249, 251, 240, 25, 48, 130, 9, 46,
+    201, 157, 160, 134, 73, 238, 111, 77, 109, 196, 45, 129, 52, 37, 135, 27, 136, 170, 252, 6,
+    161, 18, 56, 253, 76, 66, 114, 100, 19, 55, 36, 106, 117, 119, 67, 255, 230, 180, 75, 54, 92,
+    228, 216, 53, 61, 69, 185, 44, 236, 183, 49, 43, 41, 7, 104, 163, 14, 105, 123, 24, 158, 33,
+    57, 190, 40, 26, 91, 120, 245, 35, 202, 42, 176, 175, 62, 254, 4, 140, 231, 229, 152, 50, 149,
+    211, 246, 74, 232, 166, 234, 233, 243, 213, 47, 112, 32, 242, 31, 5, 103, 173, 85, 16, 206,
+    205, 227, 39, 59, 218, 186, 215, 194, 38, 212, 145, 29, 210, 28, 34, 51, 248, 250, 241, 90,
+    239, 207, 144, 182, 139, 181, 189, 192, 191, 8, 151, 30, 108, 226, 97, 224, 198, 193, 89, 171,
+    187, 88, 222, 95, 223, 96, 121, 126, 178, 138
+])
+_PST_CRYPT_I = bytes(_PST_CRYPT_R.index(value) for value in range(256))
+
+PST_CRYPT_PERMUTE = 0x01
+PST_CRYPT_CYCLIC = 0x02
+PST_NID_MESSAGE_STORE = 0x21
+PST_NID_ROOT_FOLDER = 0x122
+PST_NID_ATTACHMENT_TABLE = 0x671
+PST_NID_RECIPIENT_TABLE = 0x692
+PST_NID_TYPE_NORMAL_FOLDER = 0x02
+PST_NID_TYPE_HIERARCHY_TABLE = 0x0D
+PST_NID_TYPE_CONTENTS_TABLE = 0x0E
+PST_MAX_BTREE_DEPTH = 16
+PST_MAX_FOLDER_DEPTH = 64
+PST_HEAP_CACHE_BLOCKS = 16
+PST_MESSAGE_CLASSES = ("IPM.Note", "IPM.Schedule.Meeting", "REPORT.IPM.Note")
+PST_FOLDER_NAMES = {
+    "inbox": ("inbox", "gelen kutusu"),
+    "sent": ("sent items", "sent", "gönderilmiş öğeler", "gönderilenler"),
+    "drafts": ("drafts", "taslaklar"),
+    "spam": ("junk e-mail", "junk email", "junk", "spam", "istenmeyen e-posta", "önemsiz e-posta"),
+    "deleted": ("deleted items", "trash", "silinmiş öğeler"),
+}
+# Property Context'te 4 bayta sığan tipler HNID alanında satır içi tutulur
+_PST_INLINE_TYPES = {0x0002, 0x0003, 0x0004, 0x000A, 0x000B}
+# Table Context'te bu tipler satırda HNID olarak tutulur
+_PST_HNID_TYPES = {0x001E, 0x001F, 0x0048, 0x000D, 0x0102}
+_FILETIME_EPOCH = datetime(1601, 1, 1, tzinfo=timezone.utc)
+
+
+def pst_cyclic_decrypt(data: bytes, bid: int) -> bytes:
+    """NDB_CRYPT_CYCLIC: simetrik algoritma, anahtar blok kimliğinden türetilir"""
+    key = (bid ^ (bid >> 32)) & 0xFFFFFFFF
+    w = (key ^ (key >> 16)) & 0xFFFF
+    output = bytearray(data)
+    for i, b in enumerate(output):
+        b = _PST_CRYPT_R[(b + w) & 0xFF]
+        b = _PST_CRYPT_S[(b + (w >> 8)) & 0xFF]
+        b = _PST_CRYPT_I[(b - (w >> 8)) & 0xFF]
+        output[i] = (b - w) & 0xFF
+        w = (w + 1) & 0xFFFF
+    return bytes(output)
+
+
+def pst_codec(codepage: Optional[int], default: str = 'cp1252') -> str:
+    """Windows kod sayfası numarasını Python codec adına çevir"""
+    if not codepage:
+        return default
+    if codepage == 65001:
+        return 'utf-8'
+    name = f'iso8859-{codepage - 28590}' if 28591 <= codepage <= 28605 else f'cp{codepage}'
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return default
+
+
+def decode_pst_value(ptype: int, raw: bytes, codec: str = 'cp1252') -> Any:
+    """MAPI özellik değerini Python tipine çevir; bilinmeyen tipler bytes olarak kalır"""
+    if ptype == 0x001F:
+        return raw.decode('utf-16-le', 'replace').rstrip('\x00')
+    if ptype == 0x001E:
+        return raw.decode(codec, 'replace').rstrip('\x00')
+    if ptype == 0x0002:
+        return struct.unpack_from('<h', raw)[0]
+    if ptype in (0x0003, 0x000A):
+        return struct.unpack_from('<i', raw)[0]
+    if ptype == 0x000B:
+        return bool(raw[0])
+    if ptype in (0x0006, 0x0014):
+        return struct.unpack_from('<q', raw)[0]
+    if ptype in (0x0005, 0x0007):
+        return struct.unpack_from('<d', raw)[0]
+    if ptype == 0x0004:
+        return struct.unpack_from('<f', raw)[0]
+    if ptype == 0x0040:
+        ticks = struct.unpack_from('<Q', raw)[0]
+        try:
+            return _FILETIME_EPOCH + timedelta(microseconds=ticks // 10) if ticks else None
+        except OverflowError:
+            return None
+    return raw
+
+
+class PSTFile:
+    """
+    Bellek eşlemeli PST/OST dosyası (NDB katmanı): başlık, NBT/BBT B-ağaçları, blok şifre çözme,
+    XBLOCK veri ağaçları ve alt düğüm ağaçları. ANSI, Unicode ve 4K sayfalı OST biçimleri okunur.
+    B-ağaçları belleğe alınmaz; her arama sayfalar üzerinde doğrudan yapılır.
+    """
+    
+    NID_MASK = 0xFFFFFFFF
+    BID_MASK = 0xFFFFFFFFFFFFFFFE
+    
+    def __init__(self, fileobj):
+        self.mm = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_header()
+        except Exception:
+            self.mm.close()
+            raise
+    
+    def _read_header(self):
+        mm = self.mm
+        if len(mm) < 512 or mm[0:4] != b'!BDN':
+            raise ValueError("Geçerli bir PST/OST dosyası değil")
+        version = struct.unpack_from('<H', mm, 10)[0]
+        if version in (14, 15):
+            self.unicode = False
+            self.page_size = 512
+            self.nbt_root, self.bbt_root = struct.unpack_from('<I4xI', mm, 188)
+            self.crypt = mm[461]
+            self._id = struct.Struct('<I')
+            self._node_entry = struct.Struct('<III')
+            self._subnode_entry = (struct.Struct('<III'), struct.Struct('<II'))
+            self._page_info = (496, '<BBBB')
+        elif version >= 23:
+            self.unicode = True
+            self.page_size = 4096 if version >= 36 else 512
+            self.nbt_root, self.bbt_root = struct.unpack_from('<Q8xQ', mm, 224)
+            self.crypt = mm[513]
+            self._id = struct.Struct('<Q')
+            self._node_entry = struct.Struct('<QQQ')
+            self._subnode_entry = (struct.Struct('<QQQ'), struct.Struct('<QQ'))
+            self._page_info = (4056, '<HHBB') if self.page_size == 4096 else (488, '<BBBB')
+        else:
+            raise ValueError(f"Desteklenmeyen PST sürümü: {version}")
+    
+    def close(self):
+        self.mm.close()
+    
+    def _btree_lookup(self, ib: int, key: int, mask: int) -> Optional[bytes]:
+        """NBT/BBT'de anahtarı ara; yaprak kaydını veya None döndür"""
+        unpack_id = self._id.unpack_from
+        info_offset, info_format = self._page_info
+        for _ in range(PST_MAX_BTREE_DEPTH):
+            page = self.mm[ib:ib + self.page_size]
+            if len(page) < self.page_size:
+                raise ValueError("B-ağacı sayfası dosya dışında")
+            count, _, entry_size, level = struct.unpack_from(info_format, page, info_offset)
+            low, high, found = 0, count - 1, -1
+            while low <= high:
+                middle = (low + high) // 2
+                if unpack_id(page, middle * entry_size)[0] & mask <= key:
+                    found, low = middle, middle + 1
+                else:
+                    high = middle - 1
+            if found < 0:
+                return None
+            offset = found * entry_size
+            if level == 0:
+                return page[offset:offset + entry_size] if unpack_id(page, offset)[0] & mask == key else None
+            # BTENTRY: btkey, BREF(bid, ib)
+            ib = unpack_id(page, offset + 2 * self._id.size)[0]
+        raise ValueError("B-ağacı çok derin")
+    
+    def read_block(self, bid: int) -> bytes:
+        """Bloğu BBT'den bul, şifresini çöz (yalnızca veri blokları) ve gerekirse aç"""
+        entry = self._btree_lookup(self.bbt_root, bid & self.BID_MASK, self.BID_MASK)
+        if entry is None:
+            raise ValueError(f"Blok bulunamadı: {bid:#x}")
+        inflated = 0
+        if self.unicode:
+            ib, size = struct.unpack_from('<QH', entry, 8)
+            if self.page_size == 4096 and len(entry) >= 22:
+                inflated = struct.unpack_from('<H', entry, 20)[0]
+        else:
+            ib, size = struct.unpack_from('<IH', entry, 4)
+        data = self.mm[ib:ib + size]
+        if not bid & 0x02:
+            if self.crypt == PST_CRYPT_PERMUTE:
+                data = data.translate(_PST_CRYPT_I)
+            elif self.crypt == PST_CRYPT_CYCLIC:
+                data = pst_cyclic_decrypt(data, bid)
+        if inflated and inflated != size:
+            data = zlib.decompress(data)
+        return data
+    
+    def data_block_ids(self, bid: int) -> List[int]:
+        """Veri ağacının (XBLOCK/XXBLOCK) yaprak blok kimlikleri"""
+        if not bid:
+            return []
+        if not bid & 0x02:
+            return [bid]
+        block = self.read_block(bid)
+        level, count = block[1], struct.unpack_from('<H', block, 2)[0]
+        ids = [self._id.unpack_from(block, 8 + i * self._id.size)[0] for i in range(count)]
+        if level == 1:
+            return ids
+        return [leaf for child in ids for leaf in self.data_block_ids(child)]
+    
+    def read_subnodes(self, bid: int, subnodes: Dict[int, tuple]):
+        """SLBLOCK/SIBLOCK alt düğüm ağacını nid -> (bid_data, bid_sub) sözlüğüne oku"""
+        if not bid:
+            return
+        block = self.read_block(bid)
+        level, count = block[1], struct.unpack_from('<H', block, 2)[0]
+        header = 8 if self.unicode else 4
+        entry = self._subnode_entry[1 if level else 0]
+        for i in range(count):
+            values = entry.unpack_from(block, header + i * entry.size)
+            if level:
+                self.read_subnodes(values[1], subnodes)
+            else:
+                subnodes[values[0] & self.NID_MASK] = (values[1], values[2])
+    
+    def find_node(self, nid: int) -> Optional["PSTNode"]:
+        entry = self._btree_lookup(self.nbt_root, nid, self.NID_MASK)
+        if entry is None:
+            return None
+        _, bid_data, bid_sub = self._node_entry.unpack_from(entry)
+        return PSTNode(self, nid, bid_data, bid_sub)
+    
+    def node(self, nid: int) -> "PSTNode":
+        node = self.find_node(nid)
+        if node is None:
+            raise ValueError(f"Düğüm bulunamadı: {nid:#x}")
+        return node
+
+
+class PSTNode:
+    """NBT düğümü ya da alt düğüm: veri ağacı ve (varsa) kendi alt düğüm ağacı"""
+    
+    def __init__(self, pst: PSTFile, nid: int, bid_data: int, bid_sub: int):
+        self.pst = pst
+        self.nid = nid
+        self.bid_data = bid_data
+        self.bid_sub = bid_sub
+        self._subnodes: Optional[Dict[int, tuple]] = None
+    
+    def block_ids(self) -> List[int]:
+        return self.pst.data_block_ids(self.bid_data)
+    
+    def iter_blocks(self):
+        for bid in self.block_ids():
+            yield self.pst.read_block(bid)
+    
+    def data(self) -> bytes:
+        return b''.join(self.iter_blocks())
+    
+    def _load_subnodes(self) -> Dict[int, tuple]:
+        if self._subnodes is None:
+            self._subnodes = {}
+            self.pst.read_subnodes(self.bid_sub, self._subnodes)
+        return self._subnodes
+    
+    def has_subnode(self, nid: int) -> bool:
+        return nid in self._load_subnodes()
+    
+    def subnode(self, nid: int) -> "PSTNode":
+        try:
+            bid_data, bid_sub = self._load_subnodes()[nid]
+        except KeyError:
+            raise ValueError(f"Alt düğüm bulunamadı: {nid:#x}")
+        return PSTNode(self.pst, nid, bid_data, bid_sub)
+
+
+class PSTHeap:
+    """LTP Heap-on-Node: HID ile ayrılmış parçalar; bloklar istendikçe okunur ve az sayıda tutulur"""
+    
+    def __init__(self, node: PSTNode, client_signature: int):
+        self.node = node
+        self.block_ids = node.block_ids()
+        self._blocks: "OrderedDict[int, bytes]" = OrderedDict()
+        if not self.block_ids:
+            raise ValueError(f"Boş heap düğümü: {node.nid:#x}")
+        first = self.block(0)
+        if first[2] != 0xEC or first[3] != client_signature:
+            raise ValueError(f"Beklenmeyen heap imzası: {node.nid:#x}")
+        self.user_root = struct.unpack_from('<I', first, 4)[0]
+    
+    def block(self, index: int) -> bytes:
+        block = self._blocks.get(index)
+        if block is None:
+            block = self.node.pst.read_block(self.block_ids[index])
+            self._blocks[index] = block
+            if len(self._blocks) > PST_HEAP_CACHE_BLOCKS:
+                self._blocks.popitem(last=False)
+        return block
+    
+    def get(self, hid: int) -> bytes:
+        if not hid:
+            return b''
+        block = self.block(hid >> 16)
+        page_map = struct.unpack_from('<H', block, 0)[0]
+        index = (hid >> 5) & 0x7FF
+        start, end = struct.unpack_from('<HH', block, page_map + 2 + index * 2)
+        return block[start:end]
+    
+    def read(self, hnid: int) -> bytes:
+        """HNID: düşük 5 bit sıfırsa heap içi HID, değilse alt düğüm kimliği"""
+        if hnid & 0x1F == 0:
+            return self.get(hnid)
+        return self.node.subnode(hnid).data()
+    
+    def iter_bth(self, hid: int):
+        """BTH kayıtlarını anahtar sırasıyla (anahtar, veri) olarak döndür"""
+        header = self.get(hid)
+        _, key_size, data_size, levels, root = struct.unpack_from('<BBBBI', header)
+        if root:
+            yield from self._iter_bth_records(root, levels, key_size, data_size)
+    
+    def _iter_bth_records(self, hid: int, level: int, key_size: int, data_size: int):
+        records = self.get(hid)
+        step = key_size + (4 if level else data_size)
+        for offset in range(0, len(records) - step + 1, step):
+            if level:
+                child = struct.unpack_from('<I', records, offset + key_size)[0]
+                yield from self._iter_bth_records(child, level - 1, key_size, data_size)
+            else:
+                yield records[offset:offset + key_size], records[offset + key_size:offset + step]
+
+
+class PSTPropertyContext:
+    """LTP Property Context: özellik kimliği -> değer; büyük değerler yalnızca istendiğinde okunur"""
+    
+    def __init__(self, node: PSTNode):
+        self.heap = PSTHeap(node, 0xBC)
+        self._props: Dict[int, tuple] = {}
+        for key, data in self.heap.iter_bth(self.heap.user_root):
+            self._props[struct.unpack_from('<H', key)[0]] = struct.unpack_from('<HI', data)
+        self.codec = 'cp1252'
+        # PidTagMessageCodepage: 8 bitlik (String8) metinlerin kod sayfası
+        self.codec = pst_codec(self.get(0x3FFD))
+    
+    def __contains__(self, prop_id: int) -> bool:
+        return prop_id in self._props
+    
+    def get(self, prop_id: int, default: Any = None) -> Any:
+        if prop_id not in self._props:
+            return default
+        ptype, value = self._props[prop_id]
+        if ptype & 0x1000:
+            # Çok değerli özellikler kullanılmıyor
+            return default
+        if ptype in _PST_INLINE_TYPES:
+            raw = struct.pack('<I', value)
+        else:
+            raw = self.heap.read(value) if value else b''
+        return decode_pst_value(ptype, raw, self.codec) if raw else default
+
+
+class PSTTableContext:
+    """LTP Table Context: satır matrisi blok blok okunur, satırlar sırayla döner"""
+    
+    def __init__(self, node: PSTNode, codec: str = 'cp1252'):
+        self.node = node
+        self.codec = codec
+        self.heap = PSTHeap(node, 0x7C)
+        info = self.heap.get(self.heap.user_root)
+        # rgib: 4/2/1 baytlık sütun bölgelerinin ve hücre varlık bitmap'inin (CEB) bitiş ofsetleri
+        self.ends = struct.unpack_from('<4H', info, 2)
+        self.rows_hnid = struct.unpack_from('<I', info, 14)[0]
+        self.columns = {}
+        for i in range(info[1]):
+            tag, offset, size, bit = struct.unpack_from('<IHBB', info, 22 + i * 8)
+            self.columns[tag >> 16] = (tag & 0xFFFF, offset, size, bit)
+    
+    def iter_rows(self):
+        row_size = self.ends[3]
+        if not self.rows_hnid or not row_size:
+            return
+        if self.rows_hnid & 0x1F == 0:
+            blocks = [self.heap.get(self.rows_hnid)]
+        else:
+            # Satırlar blok sınırlarını aşmaz; her blok kendi satırlarını taşır
+            blocks = self.node.subnode(self.rows_hnid).iter_blocks()
+        for block in blocks:
+            for offset in range(0, len(block) - row_size + 1, row_size):
+                yield block[offset:offset + row_size]
+    
+    def value(self, row: bytes, prop_id: int, default: Any = None) -> Any:
+        column = self.columns.get(prop_id)
+        if column is None:
+            return default
+        ptype, offset, size, bit = column
+        if not row[self.ends[2] + bit // 8] & (0x80 >> (bit % 8)):
+            return default
+        raw = row[offset:offset + size]
+        if ptype in _PST_HNID_TYPES or ptype & 0x1000:
+            if ptype & 0x1000:
+                return default
+            hnid = struct.unpack_from('<I', raw)[0]
+            raw = self.heap.read(hnid) if hnid else b''
+            if not raw:
+                return default
+        return decode_pst_value(ptype, raw, self.codec)
+    
+    def row_ids(self):
+        """PidTagLtpRowId sütunu: hiyerarşi/içerik/ek tablolarında satırın düğüm kimliği"""
+        for row in self.iter_rows():
+            row_id = self.value(row, 0x67F2)
+            if row_id:
+                yield row_id & 0xFFFFFFFF
+
+
+def _pst_entry_id_nid(entry_id: Any) -> Optional[int]:
+    # ENTRYID: rgbFlags (4), uid (16), nid (4)
+    if isinstance(entry_id, bytes) and len(entry_id) >= 24:
+        return struct.unpack_from('<I', entry_id, 20)[0]
+    return None
+
+
+def pst_folder_type(name: str) -> Optional[str]:
+    name = name.strip().lower()
+    for folder_type, names in PST_FOLDER_NAMES.items():
+        if name in names:
+            return folder_type
+    return None
+
+
+def iter_pst_folders(pst: PSTFile):
+    """
+    Kişisel klasör ağacını gez ve (klasör nid, yol, PostaDepo klasörü) döndür.
+    Klasör türü önce mesaj deposundaki özel klasör kimliklerinden, sonra addan belirlenir;
+    bilinmeyen alt klasörler üst klasörün türünü alır. Takvim, kişi vb. klasörler atlanır.
+    """
+    special = {}
+    root = PST_NID_ROOT_FOLDER
+    store_node = pst.find_node(PST_NID_MESSAGE_STORE)
+    if store_node is not None:
+        store = PSTPropertyContext(store_node)
+        # PidTagIpmWastebasketEntryId, PidTagIpmSentMailEntryId
+        for prop_id, folder_type in ((0x35E3, "deleted"), (0x35E4, "sent")):
+            nid = _pst_entry_id_nid(store.get(prop_id))
+            if nid:
+                special[nid] = folder_type
+        # PidTagIpmSubtreeEntryId: arama klasörleri dışındaki kullanıcı klasörlerinin kökü
+        root = _pst_entry_id_nid(store.get(0x35E0)) or root
+    
+    stack = [(root, "", None, 0)]
+    while stack:
+        nid, parent_path, parent_type, depth = stack.pop()
+        try:
+            folder = PSTPropertyContext(pst.node(nid))
+        except Exception as e:
+            logger.warning(f"PST folder {nid:#x} could not be read: {e}")
+            continue
+        container_class = folder.get(0x3613) or ""
+        if container_class and not container_class.startswith("IPF.Note"):
+            continue
+        name = folder.get(0x3001) or ""
+        path = f"{parent_path}/{name}" if parent_path else name
+        folder_type = special.get(nid) or pst_folder_type(name) or parent_type or "inbox"
+        yield nid, path, folder_type
+        
+        hierarchy = pst.find_node((nid & ~0x1F) | PST_NID_TYPE_HIERARCHY_TABLE)
+        if hierarchy is None or depth >= PST_MAX_FOLDER_DEPTH:
+            continue
+        try:
+            children = [child for child in PSTTableContext(hierarchy).row_ids()
+                        if child & 0x1F == PST_NID_TYPE_NORMAL_FOLDER]
+        except Exception as e:
+            logger.warning(f"PST hierarchy table {nid:#x} could not be read: {e}")
+            continue
+        for child in reversed(children):
+            stack.append((child, path, folder_type, depth + 1))
+
+
+def parse_pst_message(node: PSTNode, folder: str) -> Optional[Dict[str, Any]]:
+    """
+    PST mesaj düğümünü parse_eml_message ile aynı biçime çevir. Posta dışı öğeler (randevu,
+    kişi, görev) için None döner. Yalnızca değerle eklenmiş (ATTACH_BY_VALUE) ekler alınır.
+    """
+    props = PSTPropertyContext(node)
+    message_class = props.get(0x001A) or "IPM.Note"
+    if not message_class.startswith(PST_MESSAGE_CLASSES):
+        return None
+    
+    subject = props.get(0x0037) or ""
+    if subject[:1] == '\x01':
+        # Konu önek işaretçisi: 0x01 + önek uzunluğu
+        subject = subject[2:]
+    sender_name = props.get(0x0C1A) or props.get(0x0042) or ""
+    sender_address = props.get(0x5D01) or props.get(0x5D02) or props.get(0x0C1F) or props.get(0x0065) or ""
+    if sender_name == sender_address:
+        sender_name = ""
+    
+    recipients, cc = [], []
+    if node.has_subnode(PST_NID_RECIPIENT_TABLE):
+        table = PSTTableContext(node.subnode(PST_NID_RECIPIENT_TABLE), props.codec)
+        for row in table.iter_rows():
+            address = table.value(row, 0x39FE) or table.value(row, 0x3003)
+            kind = (table.value(row, 0x0C15) or 1) & 0x0F
+            if address and kind == 1:
+                recipients.append(address)
+            elif address and kind == 2:
+                cc.append(address)
+    if not recipients:
+        recipients = [name.strip() for name in (props.get(0x0E04) or "").split(';') if name.strip()]
+    
+    html_body = props.get(0x1013) or ""
+    if isinstance(html_body, bytes):
+        # PidTagInternetCodepage: HTML gövdenin kod sayfası
+        html_body = html_body.decode(pst_codec(props.get(0x3FDE), 'utf-8'), 'replace')
+    text_body = props.get(0x1000) or ""
+    content, content_type, preview = build_import_body(
+        html_body.rstrip('\x00').replace('\r\n', '\n'), text_body.replace('\r\n', '\n')
+    )
+    
+    date = props.get(0x0E06) or props.get(0x0039) or props.get(0x3007) or datetime.now(timezone.utc)
+    message_id = props.get(0x1035) or ""
+    references = (props.get(0x1039) or "").split()
+    in_reply_to = props.get(0x1042) or ""
+    
+    attachments = []
+    if node.has_subnode(PST_NID_ATTACHMENT_TABLE):
+        table = PSTTableContext(node.subnode(PST_NID_ATTACHMENT_TABLE), props.codec)
+        for index, attachment_nid in enumerate(table.row_ids(), 1):
+            attachment = PSTPropertyContext(node.subnode(attachment_nid))
+            if attachment.get(0x3705) != 1:
+                continue
+            data = attachment.get(0x3701) or b''
+            name = attachment.get(0x3707) or attachment.get(0x3704) or attachment.get(0x3001) or f"ek-{index}"
+            meta = {
+                "name": name,
+                "type": attachment.get(0x370E) or mimetypes.guess_type(name)[0] or "application/octet-stream",
+                "size": len(data)
+            }
+            content_id = (attachment.get(0x3712) or "").strip("<>")
+            if content_id:
+                meta["content_id"] = content_id
+            attachments.append((meta, data))
+    
+    email = {
+        "folder": folder,
+        "sender": f"{sender_address} ({sender_name})" if sender_name else sender_address,
+        "sender_name": sender_name,
+        "recipient": ", ".join(recipients),
+        "recipients": recipients,
+        "subject": subject,
+        "content": content,
+        "content_type": content_type,
+        "preview": preview,
+        # Senkronizasyonla aynı biçim (ISO metin): BSON'da Date, String'in üstünde sıralanır
+        "date": coerce_datetime(date).astimezone(timezone.utc).isoformat(),
+        "read": bool((props.get(0x0E07) or 0) & 0x01),
+        "important": props.get(0x0017) == 2 or props.get(0x1090) == 2,
+        "size": props.get(0x0E08) or len(content) + sum(len(data) for _, data in attachments),
+        "internet_message_id": message_id or None,
+        "thread_id": (references[0] if references else in_reply_to) or message_id or None,
+    }
+    if cc:
+        email["cc"] = cc
+    return {"email": email, "attachments": attachments}
+
+
+def iter_pst_messages(pst: PSTFile):
+    """Tüm posta klasörlerinin içerik tablolarını gez; mesajları tek tek ayrıştırarak döndür"""
+    for folder_nid, path, folder_type in iter_pst_folders(pst):
+        contents = pst.find_node((folder_nid & ~0x1F) | PST_NID_TYPE_CONTENTS_TABLE)
+        if contents is None:
+            continue
+        try:
+            message_nids = PSTTableContext(contents).row_ids()
+            for message_nid in message_nids:
+                try:
+                    parsed = parse_pst_message(pst.node(message_nid), folder_type)
+                except Exception as e:
+                    parsed = {"error": f"{path} {message_nid:#x}: {e}"}
+                if parsed is not None:
+                    yield parsed
+        except Exception as e:
+            yield {"error": f"{path}: {e}"}
+
+
+def next_pst_batch(messages) -> List[Dict[str, Any]]:
+    """Üreteçten bayt ve mesaj sınırına kadar ayrıştırılmış mesaj al (thread'de çalışır)"""
+    batch, batch_bytes = [], 0
+    for parsed in messages:
+        batch.append(parsed)
+        batch_bytes += parsed["email"]["size"] if "email" in parsed else 0
+        if batch_bytes >= IMPORT_PARSE_BATCH_BYTES or len(batch) >= IMPORT_PARSE_BATCH_MESSAGES:
+            break
+    return batch
+
+
+# ============== INGEST DEDUP ==============
+
+# Aynı mesaj bir kullanıcının aynı hesabında yalnızca bir kez saklanır:
+# (user_id, account_id, dedup_key) üzerinde tekil indeks vardır.
+DEDUP_BACKFILL_BATCH = int(os.environ.get('DEDUP_BACKFILL_BATCH', '500'))
+# Tek seferlik veri göçleri db.migrations kaydıyla tek süreçte çalışır; kira bu süre
+# yenilenmezse (süreç öldü) başka bir süreç kaldığı yerden devralır
+MIGRATION_LEASE_MINUTES = float(os.environ.get('MIGRATION_LEASE_MINUTES', '10'))
+DEDUP_KEY_FIELDS = {"internet_message_id": 1, "outlook_id": 1, "message_id": 1, "sender": 1,
+                    "recipient": 1, "subject": 1, "date": 1, "content": 1}
+MONGO_DUPLICATE_KEY = 11000
+
+
+def _dedup_date(value) -> str:
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return value
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    return str(value or "")
+
+
+def email_dedup_key(email: Dict[str, Any]) -> str:
+    """
+    Kanonik tekilleştirme anahtarı. Öncelik: Internet Message-ID (açılı parantezsiz), Graph
+    mesaj kimliği, son çare olarak gönderen/alıcı/konu/tarih/içerikten türetilen başlık hash'i.
+    Tarih saniyeye ve UTC'ye indirgenir; ISO metin ve datetime aynı anahtarı üretir.
+    """
+    message_id = (email.get("internet_message_id") or "").strip().strip("<>").strip()
+    if message_id:
+        kind, source = "mid", message_id
+    elif email.get("outlook_id") or email.get("message_id"):
+        kind, source = "graph", email.get("outlook_id") or email.get("message_id")
+    else:
+        kind = "hdr"
+        source = "\n".join([
+            (email.get("sender") or "").lower(),
+            (email.get("recipient") or "").lower(),
+            (email.get("subject") or "").strip(),
+            _dedup_date(email.get("date")),
+            hashlib.sha256((email.get("content") or "").encode("utf-8", "replace")).hexdigest(),
+        ])
+    return f"{kind}:{hashlib.sha256(source.encode('utf-8', 'replace')).hexdigest()[:40]}"
+
+
+def email_upsert(email: Dict[str, Any], update_fields: Tuple[str, ...] = ()) -> UpdateOne:
+    """
+    E-postayı yalnızca anahtarı yoksa ekleyen upsert işlemi. update_fields içindeki alanlar
+    var olan e-postada da güncellenir (delta senkronizasyonunda okundu durumu, klasör vb.).
+    """
+    update = {"$setOnInsert": {key: value for key, value in email.items() if key not in update_fields}}
+    changes = {key: email[key] for key in update_fields if key in email}
+    if changes:
+        update["$set"] = changes
+    return UpdateOne(email_dedup_filter(email), update, upsert=True)
+
+
+def email_dedup_filter(email: Dict[str, Any]) -> Dict[str, Any]:
+    """Tekil indeksle eşleşen filtre; anahtarı yoksa e-postaya yazılır"""
+    email["dedup_key"] = email.get("dedup_key") or email_dedup_key(email)
+    return {"user_id": email["user_id"], "account_id": email.get("account_id"), "dedup_key": email["dedup_key"]}
+
+
+async def existing_dedup_keys(user_id: str, account_id: Optional[str], keys) -> set:
+    """
+    Verilen anahtarlardan veritabanında olanlar. Sayfa başına tek $in sorgusu; yalnızca indeks
+    alanı döndüğü için tekil indeksten karşılanır ve belge gövdeleri okunmaz.
+    """
+    keys = list(set(keys))
+    if not keys:
+        return set()
+    cursor = db.emails.find(
+        {"user_id": user_id, "account_id": account_id, "dedup_key": {"$in": keys}}, {"_id": 0, "dedup_key": 1}
+    )
+    return {doc["dedup_key"] async for doc in cursor}
+
+
+async def adopt_legacy_graph_emails(user_id: str, account_id: Optional[str], emails: List[Dict[str, Any]]) -> set:
+    """
+    Message-ID'siz saklanmış eski Graph e-postaları geri doldurmada Graph kimliğinden ("graph:")
+    anahtar alır; aynı mesaj Message-ID ile yeniden gelince "mid:" anahtarı yeni kopya açardı.
+    Anahtarı veritabanında bulunmayan e-postalar Graph kimlikleriyle (outlook_id / message_id)
+    tek $in sorgusunda aranır, bulunan eski kayıt yeni anahtara taşınır. Dönen küme sahiplenilen
+    kayıtların yeni anahtarlarıdır; bunlar çağıran için "zaten var" sayılır.
+    """
+    adopted, operations = set(), []
+    for field in ("outlook_id", "message_id"):
+        by_graph_id = {email[field]: email for email in emails if email.get(field) and email["dedup_key"] not in adopted}
+        if not by_graph_id:
+            continue
+        cursor = db.emails.find(
+            {"user_id": user_id, "account_id": account_id, field: {"$in": list(by_graph_id)}},
+            {"_id": 1, field: 1, "dedup_key": 1}
+        )
+        async for doc in cursor:
+            email = by_graph_id.get(doc.get(field))
+            if not email or email["dedup_key"] in adopted or doc.get("dedup_key") == email["dedup_key"]:
+                continue
+            operations.append(UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": {"dedup_key": email["dedup_key"], "internet_message_id": email.get("internet_message_id")}}
+            ))
+            adopted.add(email["dedup_key"])
+    if operations:
+        try:
+            await db.emails.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Yeni anahtar eşzamanlı bir yazımla zaten alınmışsa e-posta yine de var sayılır
+            if any(error.get("code") != MONGO_DUPLICATE_KEY for error in e.details.get("writeErrors", [])):
+                raise
+    return adopted
+
+
+async def bulk_write_emails(operations: List[Any]) -> Dict[str, Any]:
+    """
+    E-posta işlemlerini tek bir sırasız bulk_write ile uygula. Var olan anahtarlar ve eşzamanlı
+    yazımlardan gelen duplicate key (11000) hataları "duplicates", diğer yazım hataları "failed"
+    sayılır. Dönen "upserted" eklenen kayıtların işlem listesindeki sıralarıdır.
+    """
+    if not operations:
+        return {"upserted": set(), "modified": 0, "removed": 0, "duplicates": 0, "failed": 0}
+    try:
+        details = (await db.emails.bulk_write(operations, ordered=False)).bulk_api_result
+    except BulkWriteError as e:
+        details = e.details
+    write_errors = details.get("writeErrors", [])
+    errors = [error for error in write_errors if error.get("code") != MONGO_DUPLICATE_KEY]
+    if errors:
+        logger.warning(f"Email bulk write errors: {len(errors)} (first: {errors[0].get('errmsg', '')[:200]})")
+    return {
+        "upserted": {item["index"] for item in details.get("upserted", [])},
+        "modified": details.get("nModified", 0),
+        "removed": details.get("nRemoved", 0),
+        "duplicates": len(write_errors) - len(errors),
+        "failed": len(errors),
+    }
+
+
+async def bulk_upsert_emails(emails: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    E-postaları tek bir sırasız upsert partisiyle yaz; zaten var olanlar (dedup_key) atlanmış,
+    diğer yazım hataları başarısız sayılır. Dönen "upserted" eklenen e-postaların listedeki sıralarıdır.
+    """
+    result = await bulk_write_emails([email_upsert(email) for email in emails])
+    return {
+        "inserted": len(result["upserted"]),
+        "skipped": len(emails) - len(result["upserted"]) - result["failed"],
+        "failed": result["failed"],
+        "upserted": result["upserted"],
+    }
+
+
+async def backfill_dedup_keys(batch_size: int = DEDUP_BACKFILL_BATCH, after: Any = None, checkpoint=None) -> int:
+    """
+    dedup_key alanı olmayan eski e-postalara anahtar yaz. Aynı anahtara düşen eski kopyalardan
+    ilki anahtarı alır, diğerleri "dup:<id>" ile işaretlenir (tekrar taranmazlar, silinmezler).
+    Koleksiyon _id sırasıyla bir kez taranır; checkpoint(son _id) False dönerse durulur.
+    """
+    processed = 0
+    while True:
+        query: Dict[str, Any] = {"dedup_key": {"$exists": False}}
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        docs = await db.emails.find(
+            query, {"_id": 1, "id": 1, "user_id": 1, "account_id": 1, **DEDUP_KEY_FIELDS}
+        ).sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+        if not docs:
+            return processed
+        operations = [
+            UpdateOne({"_id": doc["_id"], "dedup_key": {"$exists": False}}, {"$set": {"dedup_key": email_dedup_key(doc)}})
+            for doc in docs
+        ]
+        try:
+            await db.emails.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            duplicates = [error["index"] for error in e.details.get("writeErrors", [])
+                          if error.get("code") == MONGO_DUPLICATE_KEY]
+            if len(duplicates) != len(e.details.get("writeErrors", [])):
+                raise
+            await db.emails.bulk_write([
+                UpdateOne({"_id": docs[index]["_id"]}, {"$set": {"dedup_key": f"dup:{docs[index].get('id') or docs[index]['_id']}"}})
+                for index in duplicates
+            ], ordered=False)
+        processed += len(docs)
+        after = docs[-1]["_id"]
+        if checkpoint is not None and not await checkpoint(after):
+            return processed
+
+
+async def claim_migration(name: str) -> Optional[dict]:
+    """Göçü bu sürece kirala; tamamlanmışsa ya da başka bir süreçte sürüyorsa None"""
+    now = datetime.now(timezone.utc)
+    try:
+        return await db.migrations.find_one_and_update(
+            {"_id": name, "status": {"$ne": "done"},
+             "$or": [{"node": NODE_ID}, {"lease_until": {"$lte": now}}]},
+            {"$set": {"status": "running", "node": NODE_ID,
+                      "lease_until": now + timedelta(minutes=MIGRATION_LEASE_MINUTES)},
+             "$setOnInsert": {"started_at": now}},
+            upsert=True, return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        return None
+
+
+async def renew_migration(name: str, **progress) -> bool:
+    """Kirayı uzat ve ilerlemeyi kaydet; kira başka sürece geçtiyse False"""
+    now = datetime.now(timezone.utc)
+    result = await db.migrations.update_one(
+        {"_id": name, "node": NODE_ID, "status": "running"},
+        {"$set": {"lease_until": now + timedelta(minutes=MIGRATION_LEASE_MINUTES), **progress}}
+    )
+    return result.matched_count > 0
+
+
+async def finish_migration(name: str, **result):
+    await db.migrations.update_one(
+        {"_id": name, "node": NODE_ID, "status": "running"},
+        {"$set": {"status": "done", "finished_at": datetime.now(timezone.utc), **result}}
+    )
+
+
+# ============== EMAIL IMPORT ==============
+
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '100'))
+IMPORT_PREVIEW_CHARS = 200
+IMPORT_EXTENSIONS = ('.pst', '.ost', '.eml', '.mbox', '.zip')
+# PostaDepo ZIP dışa aktarımından geri yüklemede özet JSON'dan alınan alanlar
+ZIP_RESTORE_SUMMARY_FIELDS = ("folder", "read", "important", "thread_id", "account_id", "outlook_id", "source")
+ZIP_SUMMARY_PENDING_LIMIT = 10000
+ZIP_SUMMARY_MAX_ITEM_BYTES = 16 * 1024 * 1024
+IMPORT_PARSE_WORKERS = int(os.environ.get('IMPORT_PARSE_WORKERS', str(os.cpu_count() or 1)))
+IMPORT_READ_CHUNK_SIZE = 1024 * 1024
+IMPORT_PARSE_BATCH_BYTES = 1024 * 1024
+IMPORT_PARSE_BATCH_MESSAGES = 200
+
+
+def _header_str(message, name: str) -> str:
+    try:
+        return _header_text(message.get(name, ""))
+    except Exception:
+        # Bozuk kodlanmış başlıklar ham haliyle alınır
+        return _header_text(message.get_all(name, [""])[0])
+
+
+def _header_addresses(message, name: str) -> List[tuple]:
+    """Adres başlığını (ad, adres) listesine çevir; ayrıştırılamayan başlıklarda parseaddr'a düş"""
+    try:
+        header = message.get(name)
+        if header is None:
+            return []
+        return [(address.display_name, address.addr_spec) for address in header.addresses if address.addr_spec]
+    except Exception:
+        name_part, address = parseaddr(str(message.get_all(name, [""])[0]))
+        return [(name_part, address)] if address else []
+
+
+def _part_text(part) -> str:
+    try:
+        text = part.get_content()
+    except (LookupError, ValueError):
+        # Bilinmeyen karakter kümesi
+        text = (part.get_payload(decode=True) or b'').decode('utf-8', 'replace')
+    return text.replace('\r\n', '\n')
+
+
+def _part_bytes(part) -> bytes:
+    if part.get_content_maintype() == "message":
+        inner = part.get_payload()
+        inner = inner[0] if isinstance(inner, list) else inner
+        return inner.as_bytes() if hasattr(inner, "as_bytes") else b''
+    return part.get_payload(decode=True) or b''
+
+
+def _header_flag(message, name: str) -> Optional[bool]:
+    value = _header_str(message, name).lower()
+    if value in ("true", "false"):
+        return value == "true"
+    return None
+
+
+def build_import_body(html_body: str, text_body: str) -> tuple:
+    """HTML varsa onu içerik yap; önizleme düz metinden (yoksa etiketsiz HTML'den) üretilir"""
+    if html_body:
+        content, content_type = html_body, "html"
+        preview_source = text_body or html_lib.unescape(_HTML_TAG_RE.sub(' ', html_body))
+    else:
+        content, content_type = text_body, "text"
+        preview_source = text_body
+    preview = re.sub(r'\s+', ' ', preview_source).strip()[:IMPORT_PREVIEW_CHARS]
+    return content, content_type, preview
+
+
+def parse_eml_message(raw: bytes) -> Dict[str, Any]:
+    """
+    RFC 822 / MIME mesajını PostaDepo e-posta alanlarına ayrıştır.
+    Ek dosyalar ({"name", "type", "size"}, içerik) çiftleri olarak ayrı döner; blob deposuna
+    yazmak çağıranın işidir. PostaDepo dışa aktarımlarındaki X-PostaDepo-* bayrakları korunur.
+    """
+    message = BytesParser(policy=email_policy.default).parsebytes(raw)
+    
+    senders = _header_addresses(message, "From")
+    sender_name, sender_address = senders[0] if senders else ("", "")
+    recipients = [address for _, address in _header_addresses(message, "To")]
+    cc = [address for _, address in _header_addresses(message, "Cc")]
+    
+    try:
+        date = message["Date"].datetime if message["Date"] else None
+    except Exception:
+        date = None
+    if date is None:
+        date = datetime.now(timezone.utc)
+    elif date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    else:
+        date = date.astimezone(timezone.utc)
+    
+    html_part = message.get_body(preferencelist=("html",))
+    text_part = message.get_body(preferencelist=("plain",))
+    html_body = _part_text(html_part) if html_part is not None else ""
+    text_body = _part_text(text_part) if text_part is not None else ""
+    content, content_type, preview = build_import_body(html_body, text_body)
+    
+    attachments = []
+    for index, part in enumerate(message.iter_attachments(), 1):
+        data = _part_bytes(part)
+        default_name = f"ek-{index}.eml" if part.get_content_maintype() == "message" else f"ek-{index}"
+        meta = {
+            "name": _header_text(part.get_filename()) or default_name,
+            "type": part.get_content_type(),
+            "size": len(data)
+        }
+        content_id = _header_str(part, "Content-ID").strip("<>")
+        if content_id:
+            meta["content_id"] = content_id
+        attachments.append((meta, data))
+    
+    message_id = _header_str(message, "Message-ID")
+    references = _header_str(message, "References").split()
+    in_reply_to = _header_str(message, "In-Reply-To")
+    importance = _header_str(message, "Importance").lower()
+    important = _header_flag(message, "X-PostaDepo-Important")
+    if important is None:
+        important = importance == "high" or _header_str(message, "X-Priority").startswith(("1", "2"))
+    
+    email = {
+        "folder": _header_str(message, "X-PostaDepo-Folder") or "inbox",
+        "sender": f"{sender_address} ({sender_name})" if sender_name else sender_address,
+        "sender_name": sender_name,
+        "recipient": ", ".join(recipients),
+        "recipients": recipients,
+        "subject": _header_str(message, "Subject"),
+        "content": content,
+        "content_type": content_type,
+        "preview": preview,
+        # Senkronizasyonla aynı biçim (ISO metin): BSON'da Date, String'in üstünde sıralanır
+        "date": date.isoformat(),
+        "read": bool(_header_flag(message, "X-PostaDepo-Read")),
+        "important": important,
+        "size": len(raw),
+        "internet_message_id": message_id or None,
+        "thread_id": _header_str(message, "X-PostaDepo-Thread-Id") or (references[0] if references else in_reply_to) or message_id or None,
+    }
+    if cc:
+        email["cc"] = cc
+    return {"email": email, "attachments": attachments, "source_id": _header_str(message, "X-PostaDepo-Id") or None}
+
+
+async def discard_email_blobs(email: dict):
+    """Yazılmayan ya da silinen e-postanın GridFS eklerini sil (sahipsiz blob kalmasın)"""
+    for attachment in email.get("attachments") or []:
+        if attachment.get("blob_id"):
+            try:
+                await attachment_bucket.delete(attachment["blob_id"])
+            except Exception as e:
+                logger.warning(f"Failed to delete attachment blob {attachment['blob_id']}: {e}")
+
+
+async def store_import_attachments(attachments: List[tuple], user_id: str) -> List[Dict[str, Any]]:
+    """Ek içeriklerini GridFS'e yaz ve e-posta belgesine girecek ek kayıtlarını döndür"""
+    stored = []
+    for meta, data in attachments:
+        blob_id = await attachment_bucket.upload_from_stream(
+            meta["name"], data, metadata={"user_id": user_id, "content_type": meta["type"]}
+        )
+        stored.append({"id": str(uuid.uuid4()), **meta, "blob_id": blob_id})
+    return stored
+
+
+async def build_imported_email(parsed: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+    email = {"id": str(uuid.uuid4()), "user_id": user_id, **parsed["email"]}
+    email["attachments"] = await store_import_attachments(parsed["attachments"], user_id)
+    email["has_attachments"] = bool(email["attachments"])
+    return email
+
+
+def parse_eml_batch(raws: List[bytes]) -> List[Dict[str, Any]]:
+    """Process pool görevi: mesaj partisini ayrıştır; hatalı mesajlar {"error": ...} olarak döner"""
+    results = []
+    for raw in raws:
+        try:
+            results.append(parse_eml_message(raw))
+        except Exception as e:
+            results.append({"error": str(e)[:200]})
+    return results
+
+
+_MBOX_SEPARATOR_RE = re.compile(rb'^From [^\n]*\n', re.MULTILINE)
+_MBOXRD_UNQUOTE_RE = re.compile(rb'^>(>*From )', re.MULTILINE)
+
+
+def _finish_mbox_message(message: bytearray) -> bytes:
+    # mbox ayırıcısından önceki boş satır mesaja ait değildir; '>From ' tırnakları geri alınır
+    if message.endswith(b'\n\n'):
+        del message[-1:]
+    elif message.endswith(b'\r\n\r\n'):
+        del message[-2:]
+    return _MBOXRD_UNQUOTE_RE.sub(rb'\1', bytes(message))
+
+
+async def iter_mbox_messages(read, chunk_size: int = IMPORT_READ_CHUNK_SIZE):
+    """
+    mbox akışını 'From ' ayırıcı satırlarından mesajlara böl. read(size) async bir okuma
+    fonksiyonudur (ör. UploadFile.read); dosya hiçbir zaman tamamen belleğe alınmaz,
+    bellek kullanımı okuma parçası ve o anki mesajla sınırlıdır.
+    """
+    buffer = b''
+    message = bytearray()
+    in_message = False
+    while True:
+        chunk = await read(chunk_size)
+        if chunk:
+            buffer += chunk
+            cut = buffer.rfind(b'\n') + 1
+            if not cut:
+                continue
+        else:
+            cut = len(buffer)
+        block, buffer = buffer[:cut], buffer[cut:]
+        
+        position = 0
+        for match in _MBOX_SEPARATOR_RE.finditer(block):
+            if in_message:
+                message += block[position:match.start()]
+                yield _finish_mbox_message(message)
+                message = bytearray()
+            in_message = True
+            position = match.end()
+        if in_message:
+            message += block[position:]
+        if not chunk:
+            break
+    
+    if in_message and message:
+        yield _finish_mbox_message(message)
+
+
+async def iter_parsed_messages(messages, workers: int = IMPORT_PARSE_WORKERS,
+                               parse_batch=parse_eml_batch, item_size=len):
+    """
+    Ham mesajları process pool'da sınırlı partiler halinde ayrıştır ve giriş sırasıyla döndür.
+    Aynı anda en fazla workers + 1 parti bekler; okuma, ayrıştırma ve yazma üst üste biner.
+    parse_batch modül düzeyinde (pickle edilebilir) bir parti fonksiyonu olmalıdır.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool("import_parse", workers)
+    pending = deque()
+    batch = []
+    batch_bytes = 0
+    
+    async for raw in messages:
+        batch.append(raw)
+        batch_bytes += item_size(raw)
+        if batch_bytes >= IMPORT_PARSE_BATCH_BYTES or len(batch) >= IMPORT_PARSE_BATCH_MESSAGES:
+            pending.append(loop.run_in_executor(pool, parse_batch, batch))
+            batch, batch_bytes = [], 0
+            while len(pending) > workers:
+                for parsed in await pending.popleft():
+                    yield parsed
+    if batch:
+        pending.append(loop.run_in_executor(pool, parse_batch, batch))
+    while pending:
+        for parsed in await pending.popleft():
+            yield parsed
+
+
+class ZipArchiveReader:
+    """
+    ZIP arşivini merkezi dizin üzerinden okur. Merkezi dizin parça parça gezilir (ZipFile gibi
+    tüm kayıtları belleğe almaz); girdiler dosya konumundan bağımsız pread ile okunur.
+    ZIP64 ve veri tanımlayıcılı (ZipStreamWriter çıktısı) arşivler desteklenir.
+    """
+    
+    def __init__(self, fileobj):
+        self.fd = fileobj.fileno()
+        self.size = os.fstat(self.fd).st_size
+        self.cd_offset, self.cd_size = self._find_central_directory()
+    
+    def _read(self, offset: int, length: int) -> bytes:
+        data = os.pread(self.fd, length, offset)
+        if len(data) < length:
+            raise ValueError("ZIP arşivi eksik")
+        return data
+    
+    def _find_central_directory(self) -> tuple:
+        tail_size = min(self.size, 22 + 0xFFFF)
+        tail = os.pread(self.fd, tail_size, self.size - tail_size)
+        position = tail.rfind(b'PK\x05\x06')
+        if position < 0:
+            raise ValueError("Geçerli bir ZIP arşivi değil")
+        _, _, _, entries, cd_size, cd_offset, _ = struct.unpack_from('<4H2IH', tail, position + 4)
+        if 0xFFFF in (entries,) or 0xFFFFFFFF in (cd_size, cd_offset):
+            eocd = self.size - tail_size + position
+            locator = self._read(eocd - 20, 20)
+            if locator[:4] != b'PK\x06\x07':
+                raise ValueError("ZIP64 dizin konumu bulunamadı")
+            zip64_offset = struct.unpack_from('<Q', locator, 8)[0]
+            record = self._read(zip64_offset, 56)
+            if record[:4] != b'PK\x06\x06':
+                raise ValueError("ZIP64 dizin kaydı bulunamadı")
+            cd_size, cd_offset = struct.unpack_from('<QQ', record, 40)
+        return cd_offset, cd_size
+    
+    def iter_entries(self):
+        """Merkezi dizin kayıtlarını (ad, yöntem, sıkıştırılmış boyut, boyut, crc, yerel başlık) döndür"""
+        buffer = b''
+        offset, end = self.cd_offset, self.cd_offset + self.cd_size
+        while True:
+            if len(buffer) < 46 and offset < end:
+                chunk = self._read(offset, min(IMPORT_READ_CHUNK_SIZE, end - offset))
+                offset += len(chunk)
+                buffer += chunk
+            if len(buffer) < 46:
+                return
+            if buffer[:4] != b'PK\x01\x02':
+                raise ValueError("ZIP merkezi dizini bozuk")
+            (flags, method, crc, compressed_size, size, name_length, extra_length,
+             comment_length, local_offset) = struct.unpack_from('<8xHH4xIIIHHH8xI', buffer, 0)
+            record_length = 46 + name_length + extra_length + comment_length
+            while len(buffer) < record_length:
+                if offset >= end:
+                    raise ValueError("ZIP merkezi dizini eksik")
+                chunk = self._read(offset, min(IMPORT_READ_CHUNK_SIZE, end - offset))
+                offset += len(chunk)
+                buffer += chunk
+            name = buffer[46:46 + name_length].decode('utf-8' if flags & 0x800 else 'cp437', 'replace')
+            extra = buffer[46 + name_length:46 + name_length + extra_length]
+            buffer = buffer[record_length:]
+            
+            # ZIP64 ek alanı: yalnızca 0xFFFFFFFF olan değerler sırasıyla burada tutulur
+            position = 0
+            while position + 4 <= len(extra):
+                header_id, length = struct.unpack_from('<HH', extra, position)
+                if header_id == 0x0001:
+                    values = iter(struct.unpack_from(f'<{length // 8}Q', extra, position + 4))
+                    if size == 0xFFFFFFFF:
+                        size = next(values)
+                    if compressed_size == 0xFFFFFFFF:
+                        compressed_size = next(values)
+                    if local_offset == 0xFFFFFFFF:
+                        local_offset = next(values)
+                    break
+                position += 4 + length
+            yield name, method, compressed_size, size, crc, local_offset
+    
+    def _data_offset(self, local_offset: int) -> int:
+        header = self._read(local_offset, 30)
+        if header[:4] != b'PK\x03\x04':
+            raise ValueError("ZIP yerel başlığı bozuk")
+        name_length, extra_length = struct.unpack_from('<HH', header, 26)
+        return local_offset + 30 + name_length + extra_length
+    
+    def read_compressed(self, local_offset: int, compressed_size: int) -> bytes:
+        return self._read(self._data_offset(local_offset), compressed_size)
+    
+    def iter_text(self, method: int, compressed_size: int, local_offset: int):
+        """Girdiyi parça parça açarak UTF-8 metin olarak döndür"""
+        position = self._data_offset(local_offset)
+        end = position + compressed_size
+        inflater = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while position < end:
+            chunk = self._read(position, min(IMPORT_READ_CHUNK_SIZE, end - position))
+            position += len(chunk)
+            yield decoder.decode(inflater.decompress(chunk) if inflater else chunk)
+        yield decoder.decode(inflater.flush() if inflater else b'', final=True)
+
+
+def iter_json_array_items(chunks):
+    """
+    JSON dizisinin elemanlarını metin parçalarından tek tek çöz; dizinin tamamı belleğe alınmaz.
+    Elemanlar nesne (veya dizi/metin) olmalıdır; bölünmüş sayılar tamamlanmadan çözülmez.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break
+            yield item
+        buffer = buffer[position:]
+        if len(buffer) > ZIP_SUMMARY_MAX_ITEM_BYTES:
+            raise ValueError("Özet JSON çözülemedi")
+
+
+class ZipSummaryMerger:
+    """
+    Özet JSON'u .eml girdileriyle aynı sırada ilerleyerek okur. Dışa aktarım ikisini aynı
+    cursor sırasıyla yazdığından normalde bekleyen kayıt olmaz; sıra dışı kayıtlar sınırlı
+    bir sözlükte tutulur ve yalnızca geri yüklenen alanları saklanır. Sözlük dolunca tarama
+    durur: özette olmayan bir kimlik özetin geri kalanını tüketip sonraki eşleşmeleri kaçırmaz.
+    """
+    
+    def __init__(self, items):
+        self.items = items
+        self.pending: Dict[str, Dict[str, Any]] = {}
+    
+    def take(self, source_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        if not source_id:
+            return None
+        if source_id in self.pending:
+            return self.pending.pop(source_id)
+        if len(self.pending) >= ZIP_SUMMARY_PENDING_LIMIT:
+            return None
+        for item in self.items:
+            if not isinstance(item, dict):
+                continue
+            fields = {field: item[field] for field in ZIP_RESTORE_SUMMARY_FIELDS if field in item}
+            if item.get("id") == source_id:
+                return fields
+            self.pending[item.get("id")] = fields
+            if len(self.pending) >= ZIP_SUMMARY_PENDING_LIMIT:
+                break
+        return None
+
+
+def parse_zip_eml_batch(entries: List[tuple]) -> List[Dict[str, Any]]:
+    """Process pool görevi: ZIP girdilerini aç, CRC'yi doğrula ve .eml olarak ayrıştır"""
+    results = []
+    for method, data, crc in entries:
+        try:
+            raw = zlib.decompress(data, -15) if method == zipfile.ZIP_DEFLATED else data
+            if zlib.crc32(raw) != crc:
+                raise ValueError("CRC uyuşmuyor")
+            results.append(parse_eml_message(raw))
+        except Exception as e:
+            results.append({"error": str(e)[:200]})
+    return results
+
+
+async def iter_in_thread(generator, batch_size: int = IMPORT_PARSE_BATCH_MESSAGES):
+    """Engelleyen (dosya okuyan) bir üreteci thread'de partiler halinde ilerlet"""
+    while True:
+        batch = await asyncio.to_thread(lambda: list(itertools.islice(generator, batch_size)))
+        if not batch:
+            return
+        for item in batch:
+            yield item
+
+
+class ImportBatchWriter:
+    """
+    İçe aktarılan e-postaları sırasız bulk_write upsert partileri halinde yazar (bkz.
+    bulk_upsert_emails); zaten var olan mesajlar atlanır ve sayılır, bir belgenin yazılamaması
+    partinin geri kalanını durdurmaz. Atlanan mesajlar için yüklenen ek blob'ları silinir.
+    """
+    
+    def __init__(self, user_id: str, batch_size: int = IMPORT_BATCH_SIZE):
+        self.user_id = user_id
+        self.batch_size = max(1, batch_size)
+        self.batch: List[dict] = []
+        self.inserted = 0
+        self.skipped = 0
+        self.failed = 0
+        self.batches = 0
+    
+    async def add(self, email: dict):
+        self.batch.append(email)
+        if len(self.batch) >= self.batch_size:
+            await self.flush()
+    
+    async def flush(self):
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        result = await bulk_upsert_emails(batch)
+        self.inserted += result["inserted"]
+        self.skipped += result["skipped"]
+        self.failed += result["failed"]
+        self.batches += 1
+        for index, email in enumerate(batch):
+            if index not in result["upserted"]:
+                await discard_email_blobs(email)
+    
+    async def close(self):
+        await self.flush()
+        if self.inserted:
+            await bump_mailbox_version(self.user_id)
+
+
+class ImportFileStats:
+    """
+    Dosya başına içe aktarma sayaçları ve hız ölçümü. position dosyada işlenen (hatalılar
+    dahil) mesaj sayısı, offset okunan bayttır; resume_after > 0 ise ilk resume_after mesaj
+    önceki bir çalıştırmada yazılmıştır ve ayrıştırılmadan atlanır (bkz. ImportJobManager).
+    """
+    
+    MAX_ERROR_SAMPLES = 5
+    SNAPSHOT_FIELDS = ("position", "offset", "messages", "errors", "error_samples", "summary_misses")
+    
+    def __init__(self, filename: str, size: int = 0, resume_after: int = 0):
+        self.filename = filename
+        self.size = size
+        self.resume_after = resume_after
+        self.position = 0
+        self.offset = 0
+        self.messages = 0
+        self.errors = 0
+        self.error_samples: List[str] = []
+        self.summary_misses = 0  # ZIP: özet JSON'da bulunamayan (klasör/okundu bilgisi gelmeyen) mesajlar
+        self.started = time.monotonic()
+    
+    @classmethod
+    def restore(cls, filename: str, snapshot: Optional[Dict[str, Any]]) -> "ImportFileStats":
+        """Kontrol noktasındaki sayaçlarla, kalan mesajlardan devam edecek istatistik nesnesi"""
+        snapshot = snapshot or {}
+        stats = cls(filename, resume_after=snapshot.get("position", 0))
+        stats.messages = snapshot.get("messages", 0)
+        stats.errors = snapshot.get("errors", 0)
+        stats.error_samples = list(snapshot.get("error_samples", []))
+        stats.summary_misses = snapshot.get("summary_misses", 0)
+        return stats
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.SNAPSHOT_FIELDS}
+    
+    async def skip_committed(self, items):
+        """Önceki çalıştırmada yazılmış ilk resume_after öğeyi ayrıştırmaya göndermeden atla"""
+        async for item in items:
+            if self.position < self.resume_after:
+                self.position += 1
+                continue
+            yield item
+    
+    def error(self, message: str):
+        self.errors += 1
+        if len(self.error_samples) < self.MAX_ERROR_SAMPLES:
+            self.error_samples.append(message[:200])
+    
+    def result(self) -> Dict[str, Any]:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return {
+            "filename": self.filename,
+            "bytes": self.size,
+            "messages": self.messages,
+            "errors": self.errors,
+            "error_samples": self.error_samples,
+            "summary_misses": self.summary_misses,
+            "seconds": round(elapsed, 3),
+            "messages_per_second": round(self.messages / elapsed, 1),
+            "bytes_per_second": round(self.size / elapsed, 1)
+        }
+
+
+async def import_eml_file(upload: UploadFile, writer: ImportBatchWriter,
+                          stats: Optional[ImportFileStats] = None) -> ImportFileStats:
+    stats = stats or ImportFileStats(upload.filename)
+    raw = await upload.read()
+    stats.size = stats.offset = len(raw)
+    if stats.resume_after:
+        return stats
+    stats.position = 1
+    try:
+        parsed = await asyncio.to_thread(parse_eml_message, raw)
+        await writer.add(await build_imported_email(parsed, writer.user_id))
+        stats.messages += 1
+    except Exception as e:
+        stats.error(f"{upload.filename}: {e}")
+    return stats
+
+
+async def import_mbox_file(upload: UploadFile, writer: ImportBatchWriter,
+                           stats: Optional[ImportFileStats] = None) -> ImportFileStats:
+    """mbox dosyasını parça parça okuyup ayrıştır ve partiler halinde yaz"""
+    stats = stats or ImportFileStats(upload.filename)
+    
+    async def read(size: int) -> bytes:
+        data = await upload.read(size)
+        stats.size += len(data)
+        stats.offset += len(data)
+        return data
+    
+    async for parsed in iter_parsed_messages(stats.skip_committed(iter_mbox_messages(read))):
+        stats.position += 1
+        if "error" in parsed:
+            stats.error(f"{upload.filename} #{stats.position}: {parsed['error']}")
+            continue
+        try:
+            await writer.add(await build_imported_email(parsed, writer.user_id))
+            stats.messages += 1
+        except Exception as e:
+            stats.error(f"{upload.filename} #{stats.position}: {e}")
+    return stats
+
+
+async def import_zip_archive(upload: UploadFile, writer: ImportBatchWriter,
+                             stats: Optional[ImportFileStats] = None) -> ImportFileStats:
+    """
+    PostaDepo ZIP dışa aktarımını geri yükle: emails/*.eml girdileri process pool'da açılıp
+    ayrıştırılır, klasör ve bayraklar emails-summary-*.json'dan akış halinde eşleştirilir.
+    """
+    stats = stats or ImportFileStats(upload.filename)
+    try:
+        archive = await asyncio.to_thread(ZipArchiveReader, upload.file)
+    except (ValueError, OSError) as e:
+        stats.error(f"{upload.filename}: {e}")
+        return stats
+    stats.size = archive.size
+    
+    def iter_archive():
+        # Özet JSON dışa aktarımda ilk girdidir; .eml girdileri merkezi dizin sırasıyla gelir
+        for name, method, compressed_size, size, crc, local_offset in archive.iter_entries():
+            if name.startswith("emails-summary-") and name.endswith(".json"):
+                yield "summary", (method, compressed_size, local_offset)
+            elif name.startswith("emails/") and name.endswith(".eml"):
+                stats.offset = local_offset + compressed_size
+                yield "eml", (method, archive.read_compressed(local_offset, compressed_size), crc)
+    
+    summary: Optional[ZipSummaryMerger] = None
+    
+    async def iter_eml_entries():
+        nonlocal summary
+        async for kind, entry in iter_in_thread(iter_archive()):
+            if kind == "summary":
+                summary = ZipSummaryMerger(iter_json_array_items(archive.iter_text(*entry)))
+            else:
+                yield entry
+    
+    async for parsed in iter_parsed_messages(stats.skip_committed(iter_eml_entries()), parse_batch=parse_zip_eml_batch,
+                                             item_size=lambda entry: len(entry[1])):
+        stats.position += 1
+        if "error" in parsed:
+            stats.error(f"{upload.filename} #{stats.position}: {parsed['error']}")
+            continue
+        try:
+            source_id = parsed.get("source_id")
+            fields = await asyncio.to_thread(summary.take, source_id) if summary and source_id else None
+            if summary and source_id and fields is None:
+                stats.summary_misses += 1
+            parsed["email"].update(fields or {})
+            await writer.add(await build_imported_email(parsed, writer.user_id))
+            stats.messages += 1
+        except Exception as e:
+            stats.error(f"{upload.filename} #{stats.position}: {e}")
+    if stats.position == 0 and not stats.errors:
+        stats.error(f"{upload.filename}: PostaDepo ZIP dışa aktarımı değil (emails/*.eml bulunamadı)")
+    return stats
+
+
+async def import_pst_file(upload: UploadFile, writer: ImportBatchWriter,
+                          stats: Optional[ImportFileStats] = None) -> ImportFileStats:
+    """
+    PST/OST dosyasını yüklemenin diskteki geçici dosyası üzerinden bellek eşlemesiyle oku.
+    Mesajlar thread'de partiler halinde ayrıştırılır; bellekte yalnızca o anki parti tutulur.
+    """
+    stats = stats or ImportFileStats(upload.filename)
+    try:
+        pst = await asyncio.to_thread(PSTFile, upload.file)
+    except (ValueError, OSError) as e:
+        stats.error(f"{upload.filename}: {e}")
+        return stats
+    stats.size = len(pst.mm)
+    
+    try:
+        # Klasör ağacı her seferinde aynı sırayla gezilir; yazılmış mesajlar atlanır
+        messages = itertools.islice(iter_pst_messages(pst), stats.resume_after, None)
+        stats.position = stats.resume_after
+        while True:
+            batch = await asyncio.to_thread(next_pst_batch, messages)
+            if not batch:
+                break
+            for parsed in batch:
+                stats.position += 1
+                if "error" in parsed:
+                    stats.error(f"{upload.filename} #{stats.position}: {parsed['error']}")
+                    continue
+                try:
+                    await writer.add(await build_imported_email(parsed, writer.user_id))
+                    stats.messages += 1
+                except Exception as e:
+                    stats.error(f"{upload.filename} #{stats.position}: {e}")
+    finally:
+        pst.close()
+    return stats
+
+
+async def import_upload(upload: UploadFile, writer: ImportBatchWriter,
+                        stats: Optional[ImportFileStats] = None) -> ImportFileStats:
+    """Dosyayı uzantısına göre uygun içe aktarıcıya yönlendir"""
+    name = upload.filename.lower()
+    if name.endswith('.eml'):
+        return await import_eml_file(upload, writer, stats)
+    if name.endswith('.mbox'):
+        return await import_mbox_file(upload, writer, stats)
+    if name.endswith('.zip'):
+        return await import_zip_archive(upload, writer, stats)
+    return await import_pst_file(upload, writer, stats)
+
+
+async def run_import(uploads: List[UploadFile], user_id: str) -> Dict[str, Any]:
+    """Dosyaları tek bir yazıcıyla içe aktar; hiçbir şey eklenemediyse 400 döner"""
+    writer = ImportBatchWriter(user_id)
+    results = []
+    try:
+        for upload in uploads:
+            results.append((await import_upload(upload, writer)).result())
+    finally:
+        await writer.close()
+    return import_result(writer, results)
+
+
+def import_result(writer: ImportBatchWriter, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    error_count = sum(result["errors"] for result in results) + writer.failed
+    if writer.inserted == 0 and writer.skipped == 0 and error_count:
+        raise HTTPException(status_code=400, detail=results[0]["error_samples"][0] if results[0]["error_samples"] else "İçe aktarma başarısız")
+    
+    return {"success": True, "count": writer.inserted, "skipped": writer.skipped, "error_count": error_count,
+            "write_errors": writer.failed, "files": results}
+
+
+@api_router.post("/import-emails")
+async def import_emails(
+    file: Optional[UploadFile] = File(None),
+    files: Optional[List[UploadFile]] = File(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    E-posta dosyalarını içe aktar. .eml dosyaları RFC 822 olarak ayrıştırılır, .mbox dosyaları
+    akış halinde okunup process pool'da ayrıştırılır, .pst/.ost dosyaları bellek eşlemesiyle
+    klasör klasör okunur, PostaDepo ZIP dışa aktarımları özet JSON'daki bayraklarla geri
+    yüklenir; ekler blob deposuna yazılır, e-postalar IMPORT_BATCH_SIZE'lık sırasız upsert
+    partileriyle eklenir. Posta kutusunda zaten olan mesajlar (dedup_key) atlanıp sayılır.
+    Yanıt dosya başına mesaj/hata sayılarını ve hızı içerir.
+    """
+    uploads = ([file] if file else []) + list(files or [])
+    if not uploads:
+        raise HTTPException(status_code=400, detail="Dosya gerekli")
+    for upload in uploads:
+        if not upload.filename.lower().endswith(IMPORT_EXTENSIONS):
+            raise HTTPException(status_code=400, detail="Desteklenmeyen dosya formatı")
+    return await run_import(uploads, current_user["id"])
+
+@api_router.post("/update-demo-emails")
+async def update_demo_emails(current_user: dict = Depends(get_current_user)):
+    """
+    Mevcut demo emaillerini bağlı hesap bilgileriyle günceller
+    """
+    # Bağlı hesaplardan sender bilgilerini al
+    connected_accounts = await db.connected_accounts.find({"user_id": current_user["id"]}).to_list(length=None)
+    
+    if not connected_accounts:
+        return {"success": False, "message": "Bağlı hesap bulunamadı"}
+    
+    # Mevcut demo emailleri bul
+    demo_emails = await db.emails.find({"user_id": current_user["id"]}).to_list(length=None)
+    
+    if not demo_emails:
+        return {"success": False, "message": "Güncellenecek email bulunamadı"}
+    
+    # Sender mapppingi oluştur
+    sender_mapping = {}
+    for account in connected_accounts:
+        email = account["email"]
+        name = account.get("name", email.split("@")[0].replace(".", " ").title())
+        sender_format = f"{email} ({name})" if name and name != email.split("@")[0].replace(".", " ").title() else email
+        sender_mapping[email] = sender_format
+    
+    # Demo emailleri güncelle
+    updated_count = 0
+    for demo_email in demo_emails:
+        old_sender = demo_email["sender"]
+        
+        # Eski formatı kontrol et (sadece email varsa)
+        if "@" in old_sender and "(" not in old_sender:
+            # Bağlı hesaplarda bu email var mı kontrol et
             for account_email, formatted_sender in sender_mapping.items():
                 if account_email in old_sender:
                     # Email'i güncelle
@@ -2441,110 +4703,2676 @@ async def update_demo_emails(current_user: dict = Depends(get_current_user)):
                     updated_count += 1
                     break
     
-    return {"success": True, "updated_count": updated_count, "message": f"{updated_count} email güncellendi"}
+    if updated_count:
+        await bump_mailbox_version(current_user["id"])
+    
+    return {"success": True, "updated_count": updated_count, "message": f"{updated_count} email güncellendi"}
+
+# ============== NODE IDENTITY ==============
+
+# Makine kimliği: yerel diskteki spool dosyalarının hangi makinede olduğunu gösterir (host alanı)
+HOST_ID = os.environ.get('NODE_ID') or socket.gethostname()
+# Süreç kimliği: aynı makinedeki worker'lar (WEB_CONCURRENCY) ayrı sahiplerdir. İş ve yükleme
+# kayıtlarının node alanı bunu taşır; kayıt yalnızca koşullu yazımla sahiplenilip çalıştırılır
+NODE_ID = f"{HOST_ID}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def host_scope() -> Dict[str, Any]:
+    """Bu makinedeki kayıtlar (host alanından önceki kayıtlarda node makine adıdır)"""
+    return {"$or": [{"host": HOST_ID}, {"node": HOST_ID}, {"node": {"$regex": f"^{re.escape(HOST_ID)}:"}}]}
+
+
+def process_is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # başka kullanıcının süreci
+    return True
+
+
+def owner_is_gone(owner: Optional[str]) -> bool:
+    """
+    Kaydın sahibi bu makinede artık çalışmayan bir süreç mi? Başka makinedeki sahiplerin
+    durumu buradan bilinemez; onlar nabız (updated_at) kesildiğinde devralınır.
+    """
+    if owner == HOST_ID:
+        return True  # süreç kimliğinden önce yazılmış kayıt; o süreç artık yok
+    host, pid, token = ((owner or "").rsplit(":", 2) + ["", ""])[:3]
+    if owner == NODE_ID or host != HOST_ID or not pid.isdigit() or not token:
+        return False
+    return int(pid) != os.getpid() and not process_is_running(int(pid))
+
+
+# ============== RESUMABLE UPLOADS ==============
+
+UPLOAD_SPOOL_DIR = Path(os.environ.get('UPLOAD_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'postadepo-uploads')))
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', str(50 * 1024 ** 3)))
+UPLOAD_MAX_CHUNK_BYTES = int(os.environ.get('UPLOAD_MAX_CHUNK_BYTES', str(64 * 1024 * 1024)))
+UPLOAD_TTL_HOURS = float(os.environ.get('UPLOAD_TTL_HOURS', '24'))
+UPLOAD_CLEANUP_INTERVAL = float(os.environ.get('UPLOAD_CLEANUP_INTERVAL', '300'))
+UPLOAD_CHUNK_LEASE_SECONDS = float(os.environ.get('UPLOAD_CHUNK_LEASE_SECONDS', '300'))
+
+
+class UploadManager:
+    """
+    Devam ettirilebilir yüklemeler: dosya spool dizininde parça parça birleştirilir, her parça
+    SHA-256 ile doğrulanır. Parçalar sırayla gelir; kopan bağlantıdan sonra istemci ilerlemeyi
+    sorgulayıp 'received' ofsetinden devam eder. Tamamlanan dosya kopyalanmadan içe aktarılır.
+    Spool dosyası makineye bağlıdır (host); aynı makinedeki her worker parça kabul edebilir.
+    """
+    
+    def __init__(self, spool_dir: Path, ttl_hours: float, max_bytes: int, max_chunk: int, cleanup_interval: float,
+                 chunk_lease_seconds: float = 300):
+        self.spool_dir = spool_dir
+        self.ttl = timedelta(hours=ttl_hours)
+        self.max_bytes = max_bytes
+        self.max_chunk = max_chunk
+        self.cleanup_interval = cleanup_interval
+        self.chunk_lease = timedelta(seconds=chunk_lease_seconds)
+        self._cleanup_task: Optional[asyncio.Task] = None
+        self.stats = {"uploads_created": 0, "uploads_imported": 0, "uploads_expired": 0, "imports_released": 0,
+                      "chunks_received": 0, "chunks_rejected": 0, "chunks_conflicted": 0, "bytes_received": 0}
+    
+    async def start(self):
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        await self.release_orphaned_imports()
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+    
+    async def stop(self):
+        if self._cleanup_task:
+            self._cleanup_task.cancel()
+            await asyncio.gather(self._cleanup_task, return_exceptions=True)
+            self._cleanup_task = None
+    
+    def path(self, upload: dict) -> Path:
+        return self.spool_dir / f"{upload['id']}.upload"
+    
+    async def create(self, user_id: str, filename: str, size: int) -> dict:
+        filename = os.path.basename(filename.replace("\\", "/"))
+        if not filename.lower().endswith(IMPORT_EXTENSIONS):
+            raise HTTPException(status_code=400, detail="Desteklenmeyen dosya formatı")
+        if size <= 0:
+            raise HTTPException(status_code=400, detail="Geçersiz dosya boyutu")
+        if size > self.max_bytes:
+            raise HTTPException(status_code=413, detail="Dosya çok büyük")
+        
+        now = datetime.now(timezone.utc)
+        upload = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "host": HOST_ID,
+            "node": NODE_ID,
+            "filename": filename,
+            "size": size,
+            "received": 0,
+            "chunks": 0,
+            "status": "uploading",
+            "result": None,
+            "error": None,
+            "created_at": now,
+            "updated_at": now,
+            "expires_at": now + self.ttl
+        }
+        await asyncio.to_thread(self._allocate, self.path(upload), size)
+        await db.uploads.insert_one(dict(upload))
+        self.stats["uploads_created"] += 1
+        return upload
+    
+    @staticmethod
+    def _allocate(path: Path, size: int):
+        # Seyrek dosya: disk alanı parçalar yazıldıkça kullanılır
+        with open(path, "wb") as handle:
+            handle.truncate(size)
+    
+    def _check_node(self, upload: dict):
+        if upload.get("host", upload.get("node")) != HOST_ID:
+            raise HTTPException(status_code=409, detail="Yükleme başka bir sunucuda başlatıldı")
+    
+    async def write_chunk(self, upload: dict, offset: int, checksum: Optional[str], chunks) -> dict:
+        """
+        Parçayı önce isteğe özel geçici dosyaya al ve doğrula; ofset kiralandıktan sonra spool
+        dosyasına kopyala. Aynı ofsete eşzamanlı iki PUT gelirse yalnızca kirayı alan diske yazar.
+        """
+        self._check_node(upload)
+        if upload["status"] != "uploading":
+            raise HTTPException(status_code=409, detail="Yükleme parça kabul etmiyor")
+        if offset != upload["received"]:
+            raise HTTPException(
+                status_code=409,
+                detail="Parça ofseti beklenen ofsetle uyuşmuyor",
+                headers={"Upload-Offset": str(upload["received"])}
+            )
+        if not checksum:
+            raise HTTPException(status_code=400, detail="X-Chunk-SHA256 başlığı gerekli")
+        
+        token = uuid.uuid4().hex
+        chunk_path = self.spool_dir / f"{upload['id']}.{token}.chunk"
+        try:
+            written = await self._receive_chunk(chunk_path, checksum, offset, upload["size"], chunks)
+            
+            now = datetime.now(timezone.utc)
+            leased = await db.uploads.find_one_and_update(
+                {"id": upload["id"], "received": offset, "status": "uploading",
+                 "$or": [{"chunk_lease_until": None}, {"chunk_lease_until": {"$lte": now}}]},
+                {"$set": {"chunk_lease": token, "chunk_lease_until": now + self.chunk_lease}}
+            )
+            if leased is None:
+                self.stats["chunks_conflicted"] += 1
+                raise HTTPException(status_code=409, detail="Yükleme eşzamanlı olarak değişti")
+            try:
+                await asyncio.to_thread(self._splice, chunk_path, self.path(upload), offset)
+                now = datetime.now(timezone.utc)
+                updated = await db.uploads.find_one_and_update(
+                    {"id": upload["id"], "received": offset, "chunk_lease": token},
+                    {"$set": {"received": offset + written, "updated_at": now, "expires_at": now + self.ttl,
+                              "chunk_lease": None, "chunk_lease_until": None},
+                     "$inc": {"chunks": 1}},
+                    return_document=ReturnDocument.AFTER
+                )
+            except BaseException:
+                await db.uploads.update_one(
+                    {"id": upload["id"], "chunk_lease": token},
+                    {"$set": {"chunk_lease": None, "chunk_lease_until": None}}
+                )
+                raise
+            if updated is None:
+                # Kira süresi yazarken doldu ve ofset başkasına geçti
+                self.stats["chunks_conflicted"] += 1
+                raise HTTPException(status_code=409, detail="Yükleme eşzamanlı olarak değişti")
+        finally:
+            chunk_path.unlink(missing_ok=True)
+        self.stats["chunks_received"] += 1
+        self.stats["bytes_received"] += written
+        return updated
+    
+    async def _receive_chunk(self, chunk_path: Path, checksum: str, offset: int, size: int, chunks) -> int:
+        """Gövdeyi geçici dosyaya yaz; SHA-256 tutmazsa ilerleme değişmez ve parça yeniden gönderilir"""
+        digest = hashlib.sha256()
+        written = 0
+        handle = await asyncio.to_thread(open, chunk_path, "wb")
+        try:
+            async for piece in chunks:
+                if not piece:
+                    continue
+                written += len(piece)
+                if written > self.max_chunk or offset + written > size:
+                    raise HTTPException(status_code=413, detail="Parça çok büyük")
+                digest.update(piece)
+                await asyncio.to_thread(handle.write, piece)
+        finally:
+            handle.close()
+        
+        if digest.hexdigest() != checksum.strip().lower():
+            self.stats["chunks_rejected"] += 1
+            raise HTTPException(status_code=422, detail="Parça sağlama toplamı uyuşmuyor")
+        if not written:
+            raise HTTPException(status_code=400, detail="Boş parça")
+        return written
+    
+    @staticmethod
+    def _splice(chunk_path: Path, path: Path, offset: int):
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            with open(chunk_path, "rb") as source:
+                while True:
+                    block = source.read(1024 * 1024)
+                    if not block:
+                        break
+                    os.pwrite(fd, block, offset)
+                    offset += len(block)
+        finally:
+            os.close(fd)
+    
+    async def _claim(self, upload: dict):
+        self._check_node(upload)
+        if upload["received"] != upload["size"]:
+            raise HTTPException(
+                status_code=409,
+                detail="Yükleme henüz tamamlanmadı",
+                headers={"Upload-Offset": str(upload["received"])}
+            )
+        claimed = await db.uploads.find_one_and_update(
+            {"id": upload["id"], "status": {"$in": ["uploading", "complete"]}},
+            {"$set": {"status": "importing", "node": NODE_ID, "updated_at": datetime.now(timezone.utc)}}
+        )
+        if claimed is None:
+            raise HTTPException(status_code=409, detail="Yükleme zaten içe aktarıldı")
+    
+    async def finalize(self, upload: dict) -> Dict[str, Any]:
+        """Tamamlanan dosyayı yerinde (kopyalamadan) içe aktarma hattına ver"""
+        await self._claim(upload)
+        path = self.path(upload)
+        try:
+            handle = await asyncio.to_thread(open, path, "rb")
+            try:
+                result = await run_import(
+                    [UploadFile(file=handle, filename=upload["filename"], size=upload["size"])], upload["user_id"]
+                )
+            finally:
+                handle.close()
+        except HTTPException as e:
+            if 400 <= e.status_code < 500 and e.status_code != 429:
+                await self._finish(upload, "failed", error=str(e.detail))
+            else:
+                await self._release(upload, str(e.detail))
+            raise
+        except Exception as e:
+            logger.error(f"Upload import {upload['id']} failed: {e}")
+            await self._release(upload, str(e))
+            raise HTTPException(status_code=500, detail="İçe aktarma başarısız")
+        await self._finish(upload, "imported", result=result)
+        self.stats["uploads_imported"] += 1
+        return result
+    
+    async def hand_off(self, upload: dict) -> dict:
+        """Tamamlanan dosyayı arka plan içe aktarma işine devret; dosya spool'lar arasında taşınır"""
+        job = await import_job_manager.new_job(upload["user_id"], [{"filename": upload["filename"], "size": upload["size"]}])
+        await self._claim(upload)
+        job_path = import_job_manager.file_path(job, 0)
+        try:
+            await asyncio.to_thread(shutil.move, str(self.path(upload)), str(job_path))
+            await import_job_manager.submit(job)
+        except Exception as e:
+            logger.error(f"Upload hand-off {upload['id']} failed: {e}")
+            if job_path.exists() and not self.path(upload).exists():
+                await asyncio.to_thread(shutil.move, str(job_path), str(self.path(upload)))
+            await self._release(upload, str(e))
+            raise HTTPException(status_code=500, detail="İçe aktarma işi başlatılamadı")
+        await self._finish(upload, "imported", result={"job_id": job["id"]})
+        self.stats["uploads_imported"] += 1
+        return job
+    
+    async def _finish(self, upload: dict, status: str, result: Optional[dict] = None, error: Optional[str] = None):
+        self.path(upload).unlink(missing_ok=True)
+        await db.uploads.update_one(
+            {"id": upload["id"]},
+            {"$set": {"status": status, "result": result, "error": error, "updated_at": datetime.now(timezone.utc)}}
+        )
+    
+    async def _release(self, upload: dict, error: str):
+        """Geçici hata (Mongo, havuz vb.): dosya korunur, /complete yeniden denenebilir"""
+        now = datetime.now(timezone.utc)
+        await db.uploads.update_one(
+            {"id": upload["id"], "status": "importing"},
+            {"$set": {"status": "complete", "error": error, "updated_at": now, "expires_at": now + self.ttl}}
+        )
+    
+    async def abort(self, upload: dict):
+        self.path(upload).unlink(missing_ok=True)
+        await db.uploads.delete_one({"id": upload["id"]})
+    
+    async def release_orphaned_imports(self):
+        """
+        Bu makinede içe aktarırken ölen süreçlerin yüklemeleri tekrar /complete edilebilsin.
+        Kardeş worker'ların süren içe aktarmalarına dokunulmaz.
+        """
+        now = datetime.now(timezone.utc)
+        async for upload in db.uploads.find({**host_scope(), "status": "importing"}, {"id": 1, "node": 1}):
+            if not owner_is_gone(upload.get("node")):
+                continue
+            result = await db.uploads.update_one(
+                {"id": upload["id"], "status": "importing", "node": upload.get("node")},
+                {"$set": {"status": "complete", "updated_at": now, "expires_at": now + self.ttl}}
+            )
+            if result.modified_count:
+                logger.info(f"Released upload {upload['id']} left importing by {upload.get('node')}")
+                self.stats["imports_released"] += 1
+    
+    async def expire_uploads(self):
+        """Süresi dolan yarım ya da içe aktarılmamış yüklemeleri ve kaydı olmayan spool dosyalarını sil"""
+        now = datetime.now(timezone.utc)
+        expired = {"status": {"$in": ["uploading", "complete"]}, "expires_at": {"$lte": now}}
+        async for upload in db.uploads.find({**host_scope(), **expired}):
+            result = await db.uploads.update_one({"id": upload["id"], **expired}, {"$set": {"status": "expired"}})
+            if result.modified_count:
+                self.path(upload).unlink(missing_ok=True)
+                self.stats["uploads_expired"] += 1
+        
+        cutoff = time.time() - self.ttl.total_seconds()
+        for path in self.spool_dir.glob("*.upload"):
+            if path.stat().st_mtime < cutoff and not await db.uploads.count_documents(
+                {"id": path.stem, "status": {"$in": ["uploading", "complete", "importing"]}}
+            ):
+                path.unlink(missing_ok=True)
+        # Parça alınırken ölen süreçlerden kalan geçici dosyalar
+        for path in self.spool_dir.glob("*.chunk"):
+            if path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+    
+    async def _cleanup_loop(self):
+        while True:
+            try:
+                await self.release_orphaned_imports()
+                await self.expire_uploads()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Upload cleanup error: {e}")
+            await asyncio.sleep(self.cleanup_interval)
+    
+    def metrics(self) -> Dict[str, Any]:
+        return {"node": NODE_ID, "max_chunk_bytes": self.max_chunk, **self.stats}
+
+
+upload_manager = UploadManager(
+    spool_dir=UPLOAD_SPOOL_DIR,
+    ttl_hours=UPLOAD_TTL_HOURS,
+    max_bytes=UPLOAD_MAX_BYTES,
+    max_chunk=UPLOAD_MAX_CHUNK_BYTES,
+    cleanup_interval=UPLOAD_CLEANUP_INTERVAL,
+    chunk_lease_seconds=UPLOAD_CHUNK_LEASE_SECONDS
+)
+
+
+def upload_view(upload: dict) -> dict:
+    upload = {key: value for key, value in upload.items()
+              if key not in ("_id", "user_id", "host", "node", "chunk_lease", "chunk_lease_until")}
+    upload["percent"] = round(upload["received"] * 100.0 / upload["size"], 1) if upload.get("size") else 0.0
+    upload["max_chunk_bytes"] = upload_manager.max_chunk
+    return upload
+
+
+async def get_user_upload(upload_id: str, user_id: str) -> dict:
+    upload = await db.uploads.find_one({"id": upload_id, "user_id": user_id}, {"_id": 0})
+    if not upload:
+        raise HTTPException(status_code=404, detail="Yükleme bulunamadı")
+    return upload
+
+
+@api_router.post("/uploads")
+async def create_upload(request: UploadCreateRequest, current_user: dict = Depends(get_current_user)):
+    """Çok GB'lık arşivler için devam ettirilebilir yükleme başlat"""
+    upload = await upload_manager.create(current_user["id"], request.filename, request.size)
+    return upload_view(upload)
+
+
+@api_router.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str, current_user: dict = Depends(get_current_user)):
+    """Yükleme ilerlemesi: istemci kopan bağlantıdan sonra 'received' ofsetinden devam eder"""
+    return upload_view(await get_user_upload(upload_id, current_user["id"]))
+
+
+@api_router.put("/uploads/{upload_id}")
+async def put_upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    x_chunk_sha256: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """Ham gövdeli parça: ?offset= beklenen ofset olmalı, X-Chunk-SHA256 parçanın özetidir"""
+    upload = await get_user_upload(upload_id, current_user["id"])
+    updated = await upload_manager.write_chunk(upload, offset, x_chunk_sha256, request.stream())
+    return upload_view(updated)
+
+
+@api_router.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, background: bool = False, current_user: dict = Depends(get_current_user)):
+    """
+    Tüm parçalar alındıysa dosyayı içe aktar; yanıt /import-emails ile aynıdır.
+    ?background=true ile arka plan içe aktarma işi başlatılır ve iş kaydı döner.
+    """
+    upload = await get_user_upload(upload_id, current_user["id"])
+    if background:
+        return import_job_view(await upload_manager.hand_off(upload))
+    return await upload_manager.finalize(upload)
+
+
+@api_router.delete("/uploads/{upload_id}")
+async def abort_upload(upload_id: str, current_user: dict = Depends(get_current_user)):
+    upload = await get_user_upload(upload_id, current_user["id"])
+    await upload_manager.abort(upload)
+    return {"success": True}
+
+
+# ============== IMPORT JOBS ==============
+
+IMPORT_JOB_SPOOL_DIR = Path(os.environ.get('IMPORT_JOB_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'postadepo-import-jobs')))
+IMPORT_JOB_TTL_HOURS = float(os.environ.get('IMPORT_JOB_TTL_HOURS', '24'))
+IMPORT_JOBS_PER_USER = int(os.environ.get('IMPORT_JOBS_PER_USER', '2'))
+IMPORT_JOBS_PER_NODE = int(os.environ.get('IMPORT_JOBS_PER_NODE', '2'))
+IMPORT_JOB_CLEANUP_INTERVAL = float(os.environ.get('IMPORT_JOB_CLEANUP_INTERVAL', '300'))
+IMPORT_PROGRESS_INTERVAL = float(os.environ.get('IMPORT_PROGRESS_INTERVAL', '1.0'))
+IMPORT_EVENTS_KEEPALIVE = 15.0
+
+# queued: sırada; parsing: dosyalar okunuyor, partiler yazıldıkça kontrol noktası işleniyor;
+# writing: son parti ve posta kutusu sürümü yazılıyor
+ACTIVE_IMPORT_STATUSES = ["queued", "parsing", "writing"]
+
+
+class ImportJobCancelled(Exception):
+    """İş kaydı çalışırken iptal edildi (başka bir sunucudan gelen DELETE dahil)"""
+
+
+class ImportJobLost(Exception):
+    """İş başka bir süreç tarafından devralındı; bu süreç dosyalara dokunmadan bırakır"""
+
+
+class ImportJobWriter(ImportBatchWriter):
+    """
+    Partileri yazdıktan sonra iş kaydına kontrol noktası işler: işlenen dosya, dosyadaki sıra
+    (position) ve sayaçlar. Kontrol noktası yazılmış partiden sonra alındığı için yeniden
+    başlatmada iş oradan devam eder; arada yazılmış mesajlar tekrar gelirse dedup_key'le atlanır.
+    """
+    
+    def __init__(self, job: dict, progress_interval: float):
+        super().__init__(job["user_id"])
+        self.job = job
+        self.inserted = job.get("inserted", 0)
+        self.skipped = job.get("skipped", 0)
+        self.failed = job.get("failed", 0)
+        self.progress_interval = progress_interval
+        self.stats: Optional[ImportFileStats] = None
+        self.bytes_before = 0
+        self.last_report = time.monotonic()
+    
+    async def flush(self):
+        await super().flush()
+        if self.stats is not None and time.monotonic() - self.last_report >= self.progress_interval:
+            await self.checkpoint()
+    
+    async def checkpoint(self, **fields):
+        self.last_report = time.monotonic()
+        update = {
+            "inserted": self.inserted,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "bytes_done": self.bytes_before + (self.stats.offset if self.stats else 0),
+            "updated_at": datetime.now(timezone.utc),
+        }
+        # Kayıtlı konum yalnızca daha ileri bir konumla değişir: dosya açılmadan ya da önceki
+        # çalıştırmada yazılmış mesajlar atlanırken alınan kontrol noktası onu silmemeli
+        if self.stats is not None and self.stats.position >= self.stats.resume_after:
+            update["current"] = self.stats.snapshot()
+        update.update(fields)
+        result = await db.import_jobs.update_one(
+            {"id": self.job["id"], "node": NODE_ID, "status": {"$in": ACTIVE_IMPORT_STATUSES}}, {"$set": update}
+        )
+        if result.matched_count == 0:
+            if await db.import_jobs.count_documents({"id": self.job["id"], "status": {"$in": ACTIVE_IMPORT_STATUSES}}):
+                raise ImportJobLost()
+            raise ImportJobCancelled()
+        self.job.update(update)
+
+
+class ImportJobManager:
+    """
+    Arka plan içe aktarma işleri: dosyalar spool dizinine alınır, iş durumu ve ilerlemesi
+    (dosya, mesaj ve bayt) import_jobs koleksiyonuna işlenir. Her işi tek bir süreç (node)
+    çalıştırır; sahibi kaybolan iş başka bir süreç tarafından koşullu yazımla devralınır ve
+    son kontrol noktasından devam eder.
+    Eşzamanlılık kullanıcı başına (aktif iş sayısı) ve düğüm başına (semaphore) sınırlıdır.
+    """
+    
+    def __init__(self, spool_dir: Path, ttl_hours: float, per_user: int, per_node: int,
+                 cleanup_interval: float, progress_interval: float):
+        self.spool_dir = spool_dir
+        self.ttl = timedelta(hours=ttl_hours)
+        self.per_user = per_user
+        self.per_node = per_node
+        self.cleanup_interval = cleanup_interval
+        self.progress_interval = progress_interval
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._jobs: Dict[str, asyncio.Task] = {}
+        self._cleanup_task: Optional[asyncio.Task] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self.stats = {"jobs_completed": 0, "jobs_failed": 0, "jobs_cancelled": 0, "jobs_resumed": 0,
+                      "jobs_stale": 0, "messages_imported": 0, "bytes_imported": 0}
+    
+    async def start(self):
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self._slots = asyncio.Semaphore(self.per_node)
+        await self.recover_jobs()
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(
+                job_heartbeat_loop(db.import_jobs, self._jobs, ACTIVE_IMPORT_STATUSES)
+            )
+    
+    async def stop(self):
+        # İşler iptal edilir ama kayıtları aktif kalır; bir sonraki start() devam ettirir
+        tasks = list(self._jobs.values())
+        for task in (self._cleanup_task, self._heartbeat_task):
+            if task:
+                tasks.append(task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._jobs = {}
+        self._cleanup_task = None
+        self._heartbeat_task = None
+    
+    async def recover_jobs(self, **scope) -> int:
+        """
+        Sahibi kaybolmuş işler (iter_orphaned_jobs): spool dosyaları bu süreçten erişilebiliyorsa
+        (aynı makine ya da paylaşılan dizin) iş koşullu yazımla devralınıp son kontrol noktasından
+        sürdürülür, değilse başarısız işaretlenir. Yeniden başlayan süreç de kendi eski işlerini
+        bu yolla (önceki süreç kimliği artık çalışmadığı için) devralır.
+        """
+        recovered = 0
+        async for job in iter_orphaned_jobs(db.import_jobs, ACTIVE_IMPORT_STATUSES, **scope):
+            if job["id"] in self._jobs:
+                continue
+            now = datetime.now(timezone.utc)
+            claim = job_claim(job, ACTIVE_IMPORT_STATUSES)
+            if all(self.file_path(job, index).exists() for index in range(len(job.get("files") or []))):
+                result = await db.import_jobs.update_one(claim, {"$set": {"node": NODE_ID, "host": HOST_ID, "updated_at": now}})
+                if result.modified_count:
+                    job.update(node=NODE_ID, host=HOST_ID, updated_at=now)
+                    self.stats["jobs_resumed"] += 1
+                    self._launch(job)
+            else:
+                result = await db.import_jobs.update_one(claim, {"$set": {
+                    "status": "failed", "error": "İş yanıt vermiyor (sunucu kapanmış olabilir)",
+                    "finished_at": now, "expires_at": now + self.ttl
+                }})
+                self.stats["jobs_stale"] += result.modified_count
+            recovered += result.modified_count
+        return recovered
+    
+    def file_path(self, job: dict, index: int) -> Path:
+        return self.spool_dir / f"{job['id']}.{index}"
+    
+    def remove_files(self, job: dict):
+        for index in range(len(job.get("files") or [])):
+            self.file_path(job, index).unlink(missing_ok=True)
+    
+    async def new_job(self, user_id: str, files: List[Dict[str, Any]]) -> dict:
+        """İş kaydını hazırla (henüz kaydedilmez); çağıran dosyaları file_path'lere koyup submit eder"""
+        if self._slots is None:
+            raise HTTPException(status_code=503, detail="İçe aktarma servisi hazır değil")
+        for meta in files:
+            if not meta["filename"].lower().endswith(IMPORT_EXTENSIONS):
+                raise HTTPException(status_code=400, detail="Desteklenmeyen dosya formatı")
+        # Ölü düğümde kalan işler kullanıcının kotasını kalıcı olarak doldurmasın
+        await self.recover_jobs(user_id=user_id)
+        active = await db.import_jobs.count_documents({"user_id": user_id, "status": {"$in": ACTIVE_IMPORT_STATUSES}})
+        if active >= self.per_user:
+            raise HTTPException(status_code=429, detail="Aynı anda en fazla %d içe aktarma işi çalıştırabilirsiniz" % self.per_user)
+        
+        return {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "node": NODE_ID,
+            "host": HOST_ID,
+            "status": "queued",
+            "files": files,
+            "file_index": 0,
+            "current": None,
+            "results": [],
+            "bytes_total": sum(meta["size"] for meta in files),
+            "bytes_done": 0,
+            "inserted": 0,
+            "skipped": 0,
+            "failed": 0,
+            "result": None,
+            "error": None,
+            "created_at": datetime.now(timezone.utc),
+            "started_at": None,
+            "finished_at": None,
+            "updated_at": datetime.now(timezone.utc),
+            "expires_at": None
+        }
+    
+    async def submit(self, job: dict) -> dict:
+        await db.import_jobs.insert_one(dict(job))
+        self._launch(job)
+        return job
+    
+    def _launch(self, job: dict):
+        self._jobs[job["id"]] = asyncio.create_task(self._run(job))
+    
+    async def _run(self, job: dict):
+        async with self._slots:
+            writer = ImportJobWriter(job, self.progress_interval)
+            results = list(job.get("results") or [])
+            start_index, resume, inserted_before = job.get("file_index", 0), job.get("current"), writer.inserted
+            try:
+                await writer.checkpoint(status="parsing", started_at=job.get("started_at") or datetime.now(timezone.utc))
+                writer.bytes_before = sum(meta["size"] for meta in job["files"][:start_index])
+                for index in range(start_index, len(job["files"])):
+                    meta = job["files"][index]
+                    writer.stats = ImportFileStats.restore(meta["filename"], resume if index == start_index else None)
+                    handle = await asyncio.to_thread(open, self.file_path(job, index), "rb")
+                    try:
+                        await import_upload(UploadFile(file=handle, filename=meta["filename"], size=meta["size"]), writer, writer.stats)
+                    finally:
+                        handle.close()
+                    await writer.flush()
+                    results.append(writer.stats.result())
+                    writer.stats = None
+                    writer.bytes_before += meta["size"]
+                    await writer.checkpoint(file_index=index + 1, results=results, current=None)
+                
+                await writer.checkpoint(status="writing")
+                await writer.close()
+                try:
+                    result, status, error = import_result(writer, results), "done", None
+                except HTTPException as e:
+                    result, status, error = None, "failed", str(e.detail)
+                finished = datetime.now(timezone.utc)
+                await writer.checkpoint(status=status, result=result, error=error,
+                                        finished_at=finished, expires_at=finished + self.ttl)
+                self.stats["jobs_completed" if status == "done" else "jobs_failed"] += 1
+                self.stats["messages_imported"] += writer.inserted - inserted_before
+                self.stats["bytes_imported"] += job["bytes_total"]
+                self.remove_files(job)
+            except asyncio.CancelledError:
+                # Kapanış veya yerel iptal: kayıt aktif kalır ya da cancel_job tarafından güncellenir
+                raise
+            except ImportJobLost:
+                logger.warning(f"Import job {job['id']} was taken over by another process")
+            except ImportJobCancelled:
+                logger.info(f"Import job {job['id']} cancelled")
+                self.stats["jobs_cancelled"] += 1
+                self.remove_files(job)
+                await bump_mailbox_version(job["user_id"])
+            except Exception as e:
+                logger.error(f"Import job {job['id']} failed: {e}")
+                self.stats["jobs_failed"] += 1
+                self.remove_files(job)
+                if writer.inserted:
+                    await bump_mailbox_version(job["user_id"])
+                finished = datetime.now(timezone.utc)
+                await db.import_jobs.update_one(
+                    {"id": job["id"], "node": NODE_ID},
+                    {"$set": {"status": "failed", "error": str(e), "finished_at": finished, "expires_at": finished + self.ttl}}
+                )
+            finally:
+                self._jobs.pop(job["id"], None)
+    
+    async def cancel_job(self, job: dict):
+        """Aktif işi durdur (yazılmış partiler kalır); bitmiş işin kaydını sil"""
+        if job["status"] not in ACTIVE_IMPORT_STATUSES:
+            await db.import_jobs.delete_one({"id": job["id"]})
+            return
+        finished = datetime.now(timezone.utc)
+        await db.import_jobs.update_one(
+            {"id": job["id"], "status": {"$in": ACTIVE_IMPORT_STATUSES}},
+            {"$set": {"status": "cancelled", "finished_at": finished, "expires_at": finished + self.ttl}}
+        )
+        task = self._jobs.pop(job["id"], None)
+        if task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            self.stats["jobs_cancelled"] += 1
+            self.remove_files(job)
+            await bump_mailbox_version(job["user_id"])
+    
+    async def expire_jobs(self):
+        """TTL'i dolan bitmiş iş kayıtlarını ve işi olmayan spool dosyalarını sil"""
+        now = datetime.now(timezone.utc)
+        await db.import_jobs.delete_many({"status": {"$nin": ACTIVE_IMPORT_STATUSES}, "expires_at": {"$lte": now}})
+        
+        cutoff = time.time() - self.ttl.total_seconds()
+        for path in self.spool_dir.glob("*"):
+            job_id = path.name.rsplit(".", 1)[0]
+            if job_id not in self._jobs and path.stat().st_mtime < cutoff and not await db.import_jobs.count_documents(
+                {"id": job_id, "status": {"$in": ACTIVE_IMPORT_STATUSES}}
+            ):
+                path.unlink(missing_ok=True)
+    
+    async def _cleanup_loop(self):
+        while True:
+            try:
+                await self.expire_jobs()
+                await self.recover_jobs()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Import job cleanup error: {e}")
+            await asyncio.sleep(self.cleanup_interval)
+    
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "node": NODE_ID,
+            "running": len(self._jobs),
+            "per_node_limit": self.per_node,
+            "per_user_limit": self.per_user,
+            **self.stats
+        }
+
+
+import_job_manager = ImportJobManager(
+    spool_dir=IMPORT_JOB_SPOOL_DIR,
+    ttl_hours=IMPORT_JOB_TTL_HOURS,
+    per_user=IMPORT_JOBS_PER_USER,
+    per_node=IMPORT_JOBS_PER_NODE,
+    cleanup_interval=IMPORT_JOB_CLEANUP_INTERVAL,
+    progress_interval=IMPORT_PROGRESS_INTERVAL
+)
+
+
+def import_job_view(job: dict) -> dict:
+    job = {key: value for key, value in job.items() if key not in ("_id", "user_id", "node")}
+    total = job.get("bytes_total") or 0
+    job["percent"] = 100.0 if job.get("status") == "done" else (
+        round(min(job.get("bytes_done", 0), total) * 100.0 / total, 1) if total else 0.0
+    )
+    return job
+
+
+async def get_user_import_job(job_id: str, user_id: str) -> dict:
+    job = await db.import_jobs.find_one({"id": job_id, "user_id": user_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="İçe aktarma işi bulunamadı")
+    return job
+
+
+def _spool_upload(upload: UploadFile, path: Path):
+    upload.file.seek(0)
+    with open(path, "wb") as handle:
+        shutil.copyfileobj(upload.file, handle, IMPORT_READ_CHUNK_SIZE)
+
+
+@api_router.post("/import-jobs")
+async def create_import_job(
+    file: Optional[UploadFile] = File(None),
+    files: Optional[List[UploadFile]] = File(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """/import-emails ile aynı dosyaları arka planda içe aktaran iş başlat; yanıt hemen döner"""
+    uploads = ([file] if file else []) + list(files or [])
+    if not uploads:
+        raise HTTPException(status_code=400, detail="Dosya gerekli")
+    job = await import_job_manager.new_job(
+        current_user["id"], [{"filename": upload.filename, "size": upload.size or 0} for upload in uploads]
+    )
+    try:
+        for index, upload in enumerate(uploads):
+            await asyncio.to_thread(_spool_upload, upload, import_job_manager.file_path(job, index))
+            job["files"][index]["size"] = import_job_manager.file_path(job, index).stat().st_size
+    except OSError as e:
+        import_job_manager.remove_files(job)
+        logger.error(f"Failed to spool import files: {e}")
+        raise HTTPException(status_code=500, detail="Dosya kaydedilemedi")
+    job["bytes_total"] = sum(meta["size"] for meta in job["files"])
+    return import_job_view(await import_job_manager.submit(job))
+
+
+@api_router.get("/import-jobs")
+async def list_import_jobs(current_user: dict = Depends(get_current_user)):
+    jobs = await db.import_jobs.find(
+        {"user_id": current_user["id"]}, {"_id": 0}
+    ).sort("created_at", -1).limit(50).to_list(length=50)
+    return {"jobs": [import_job_view(job) for job in jobs]}
+
+
+@api_router.get("/import-jobs/{job_id}")
+async def get_import_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    return import_job_view(await get_user_import_job(job_id, current_user["id"]))
+
+
+@api_router.get("/import-jobs/{job_id}/events")
+async def stream_import_job(job_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    """
+    İlerleme akışı (Server-Sent Events): durum veya sayaçlar değiştikçe 'progress', iş
+    bittiğinde (done/failed/cancelled) son hâliyle 'done' olayı gönderilir.
+    """
+    job = await get_user_import_job(job_id, current_user["id"])
+    
+    async def events():
+        nonlocal job
+        last_payload, last_sent = None, time.monotonic()
+        while job is not None:
+            view = import_job_view(job)
+            finished = view["status"] not in ACTIVE_IMPORT_STATUSES
+            payload = json.dumps(view, default=str, ensure_ascii=False)
+            if payload != last_payload:
+                last_payload, last_sent = payload, time.monotonic()
+                yield f"event: {'done' if finished else 'progress'}\ndata: {payload}\n\n".encode('utf-8')
+            elif time.monotonic() - last_sent >= IMPORT_EVENTS_KEEPALIVE:
+                last_sent = time.monotonic()
+                yield b": keep-alive\n\n"
+            if finished or await request.is_disconnected():
+                return
+            await asyncio.sleep(IMPORT_PROGRESS_INTERVAL)
+            job = await db.import_jobs.find_one({"id": job_id, "user_id": current_user["id"]}, {"_id": 0})
+    
+    return StreamingResponse(
+        events(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@api_router.delete("/import-jobs/{job_id}")
+async def delete_import_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Çalışan işi iptal et (o ana kadar yazılan e-postalar kalır) veya bitmiş işin kaydını sil"""
+    job = await get_user_import_job(job_id, current_user["id"])
+    await import_job_manager.cancel_job(job)
+    return {"message": "İçe aktarma işi iptal edildi" if job["status"] in ACTIVE_IMPORT_STATUSES else "İçe aktarma işi silindi"}
+
+
+# ============== STREAMING ARCHIVE HELPERS ==============
+
+# Zaten sıkıştırılmış içerikler ZIP içinde tekrar sıkıştırılmaz (STORED ya da seviye 0 DEFLATE)
+PRECOMPRESSED_EXTENSIONS = (
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.mp4', '.m4a', '.mov', '.avi',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub'
+)
+PRECOMPRESSED_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp', 'application/zip', 'application/gzip')
+
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP_UNSAFE_CHARS_RE = re.compile(r'[\x00-\x1f\\/:*?"<>|]+')
+
+
+def is_precompressed(filename: str, content_type: str = "") -> bool:
+    """Dosya zaten sıkıştırılmış bir formatta mı"""
+    content_type = (content_type or "").lower()
+    return (filename or "").lower().endswith(PRECOMPRESSED_EXTENSIONS) or \
+        content_type in PRECOMPRESSED_TYPES or content_type.startswith(('video/', 'audio/')) or \
+        'openxmlformats' in content_type
+
+
+def coerce_datetime(value: Any) -> datetime:
+    """ISO string veya datetime değerini timezone-aware datetime'a çevir"""
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str) and value:
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return datetime.now(timezone.utc)
+
+
+def safe_archive_name(name: str, fallback: str = "dosya", max_length: int = 150) -> str:
+    """Arşiv içi dosya adını güvenli hale getir (dizin ayırıcılar ve kontrol karakterleri temizlenir)"""
+    cleaned = _ZIP_UNSAFE_CHARS_RE.sub('_', name or "").strip(' .')
+    if not cleaned:
+        cleaned = fallback
+    if len(cleaned) > max_length:
+        stem, dot, ext = cleaned.rpartition('.')
+        cleaned = (stem[:max_length - len(ext) - 1] + '.' + ext) if dot and len(ext) < 10 else cleaned[:max_length]
+    return cleaned
+
+
+def unique_archive_name(name: str, used_names: set) -> str:
+    """Çakışan adlara deterministik olarak ' (2)', ' (3)' ... eki ekle"""
+    candidate = name
+    counter = 2
+    stem, dot, ext = name.rpartition('.')
+    if not dot or '/' in ext:
+        stem, ext = name, ""
+    while candidate.lower() in used_names:
+        candidate = f"{stem} ({counter}).{ext}" if ext else f"{stem} ({counter})"
+        counter += 1
+    used_names.add(candidate.lower())
+    return candidate
+
+
+class ZipStreamWriter:
+    """
+    Arşivin tamamını bellekte tutmadan ZIP üretir; çıktı parçaları doğrudan response'a yazılabilir.
+    Boyutu önceden bilinen kayıtlar (add_entry, add_compressed_entry) CRC ve boyutları local
+    header'a yazar. Akışla yazılan kayıtlar (start_entry/write/end_entry) boyutları sonradan
+    yazılan 64 bit data descriptor ile kapatılır; local header'da sıfır boyutlu ZIP64 extra alanı
+    bulunur, böylece 4 GiB'ı aşan kayıtlar da geçerlidir. Akış okuyucuları (ör. Java
+    ZipInputStream) data descriptor'lı STORED kaydı okuyamadığından bu kayıtlar her zaman
+    DEFLATE ile yazılır; sıkıştırma istenmezse seviye 0 (sıkıştırmasız DEFLATE blokları) kullanılır.
+    """
+    
+    def __init__(self):
+        self.offset = 0
+        self.entry_count = 0
+        self._central = bytearray()  # kayıt başına yalnızca paketlenmiş central directory satırı tutulur
+        self._entry = None
+    
+    @staticmethod
+    def _dos_datetime(date_time: Optional[datetime]):
+        dt = coerce_datetime(date_time) if date_time else datetime.now(timezone.utc)
+        if dt.year < 1980:
+            dt = datetime(1980, 1, 1)
+        dos_time = (dt.hour << 11) | (dt.minute << 5) | (dt.second // 2)
+        dos_date = ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day
+        return dos_time, dos_date
+    
+    def _emit(self, data: bytes) -> bytes:
+        self.offset += len(data)
+        return data
+    
+    def start_entry(self, name: str, date_time: Optional[datetime] = None, compress: bool = True,
+                    compress_level: int = 6) -> bytes:
+        """Boyutu bilinmeyen yeni bir kayıt başlat ve local file header'ı döndür"""
+        if self._entry is not None:
+            raise RuntimeError("Previous ZIP entry is still open")
+        compressor = zlib.compressobj(compress_level if compress else 0, zlib.DEFLATED, -15)
+        return self._open_entry(name, zipfile.ZIP_DEFLATED, date_time, compressor)
+    
+    def _open_entry(self, name: str, method: int, date_time: Optional[datetime], compressor,
+                    sizes: Optional[Tuple[int, int, int]] = None) -> bytes:
+        """sizes (crc, sıkıştırılmış boyut, ham boyut) verilmezse kayıt data descriptor ile kapatılır"""
+        name_bytes = name.encode('utf-8')
+        streaming = sizes is None
+        crc, compressed_size, size = sizes or (0, 0, 0)
+        flags = (0x08 if streaming else 0) | (0x800 if not name.isascii() else 0)
+        zip64 = streaming or compressed_size >= _ZIP64_LIMIT or size >= _ZIP64_LIMIT
+        extra = struct.pack('<2H2Q', 0x0001, 16, size, compressed_size) if zip64 else b''
+        dos_time, dos_date = self._dos_datetime(date_time)
+        self._entry = {
+            "name": name_bytes,
+            "flags": flags,
+            "method": method,
+            "dos_time": dos_time,
+            "dos_date": dos_date,
+            "offset": self.offset,
+            "crc": crc,
+            "compressed_size": compressed_size,
+            "size": size,
+            "zip64": zip64,
+            "compressor": compressor
+        }
+        header = struct.pack(
+            '<4s5H3L2H', b'PK\x03\x04', 45 if zip64 else 20, flags, method, dos_time, dos_date, crc,
+            _ZIP64_LIMIT if zip64 else compressed_size, _ZIP64_LIMIT if zip64 else size, len(name_bytes), len(extra)
+        )
+        return self._emit(header + name_bytes + extra)
+    
+    def write(self, data: bytes) -> bytes:
+        """Açık kayda veri ekle; sıkıştırılmış çıktıyı döndür (boş olabilir)"""
+        entry = self._entry
+        entry["crc"] = zlib.crc32(data, entry["crc"])
+        entry["size"] += len(data)
+        out = entry["compressor"].compress(data)
+        entry["compressed_size"] += len(out)
+        return self._emit(out)
+    
+    def end_entry(self) -> bytes:
+        """Açık kaydı kapat; kalan sıkıştırılmış veri ve data descriptor'ı döndür"""
+        entry = self._entry
+        tail = entry["compressor"].flush()
+        entry["compressed_size"] += len(tail)
+        # Local header'da ZIP64 extra alanı olduğu için boyutlar 8 bayttır
+        descriptor = struct.pack('<4sLQQ', b'PK\x07\x08', entry["crc"], entry["compressed_size"], entry["size"])
+        self._add_central_record(entry)
+        self._entry = None
+        return self._emit(tail + descriptor)
+    
+    def add_entry(self, name: str, data: bytes, date_time: Optional[datetime] = None, compress: bool = True,
+                  compress_level: int = 6) -> bytes:
+        """Küçük bir kaydı tek seferde ekle; compress=False ise STORED yazılır"""
+        if not compress:
+            return self.add_compressed_entry(name, data, zlib.crc32(data), len(data), zipfile.ZIP_STORED, date_time)
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+        payload = compressor.compress(data) + compressor.flush()
+        return self.add_compressed_entry(name, payload, zlib.crc32(data), len(data), zipfile.ZIP_DEFLATED, date_time)
+    
+    def add_compressed_entry(self, name: str, payload: bytes, crc: int, size: int,
+                             method: int = zipfile.ZIP_DEFLATED, date_time: Optional[datetime] = None) -> bytes:
+        """Önceden (ör. process pool'da) sıkıştırılmış bir kaydı ekle"""
+        if self._entry is not None:
+            raise RuntimeError("Previous ZIP entry is still open")
+        header = self._open_entry(name, method, date_time, None, sizes=(crc, len(payload), size))
+        self._add_central_record(self._entry)
+        self._entry = None
+        return header + self._emit(payload)
+    
+    def _add_central_record(self, entry: dict):
+        compressed_size, size, offset = entry["compressed_size"], entry["size"], entry["offset"]
+        zip64_fields = []
+        if size >= _ZIP64_LIMIT:
+            zip64_fields.append(size)
+            size = _ZIP64_LIMIT
+        if compressed_size >= _ZIP64_LIMIT:
+            zip64_fields.append(compressed_size)
+            compressed_size = _ZIP64_LIMIT
+        if offset >= _ZIP64_LIMIT:
+            zip64_fields.append(offset)
+            offset = _ZIP64_LIMIT
+        extra = b''
+        if zip64_fields:
+            extra = struct.pack(f'<2H{len(zip64_fields)}Q', 0x0001, 8 * len(zip64_fields), *zip64_fields)
+        version = 45 if zip64_fields or entry["zip64"] else 20
+        self._central += struct.pack(
+            '<4s6H3L5H2L', b'PK\x01\x02', (3 << 8) | version, version, entry["flags"], entry["method"],
+            entry["dos_time"], entry["dos_date"], entry["crc"], compressed_size, size,
+            len(entry["name"]), len(extra), 0, 0, 0, 0o100644 << 16, offset
+        )
+        self._central += entry["name"] + extra
+        self.entry_count += 1
+    
+    def finish(self) -> bytes:
+        """Central directory ve end of central directory kayıtlarını döndür"""
+        if self._entry is not None:
+            raise RuntimeError("ZIP entry is still open")
+        cd_offset = self.offset
+        count = self.entry_count
+        cd_size = len(self._central)
+        tail = b''
+        if count >= 0xFFFF or cd_size >= _ZIP64_LIMIT or cd_offset >= _ZIP64_LIMIT:
+            zip64_eocd_offset = cd_offset + cd_size
+            tail += struct.pack(
+                '<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, count, count, cd_size, cd_offset
+            )
+            tail += struct.pack('<4sLQL', b'PK\x06\x07', 0, zip64_eocd_offset, 1)
+        tail += struct.pack(
+            '<4s4H2LH', b'PK\x05\x06', 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+            min(cd_size, _ZIP64_LIMIT), min(cd_offset, _ZIP64_LIMIT), 0
+        )
+        central = bytes(self._central)
+        self._central = bytearray()
+        return self._emit(central + tail)
+
+
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '200'))
+EXPORT_CHUNK_SIZE = 64 * 1024
+# Süreç başına; her API worker'ı ayrı pool açtığından küçük tutulur
+EXPORT_COMPRESS_WORKERS = int(os.getenv('EXPORT_COMPRESS_WORKERS', str(min(2, os.cpu_count() or 1))))
+EXPORT_COMPRESS_BATCH_BYTES = int(os.getenv('EXPORT_COMPRESS_BATCH_BYTES', str(256 * 1024)))
+# Pool'a gönderilmiş ve yazılmayı bekleyen toplam ham bayt sınırı (dışa aktarma başına)
+EXPORT_COMPRESS_INFLIGHT_BYTES = int(os.getenv('EXPORT_COMPRESS_INFLIGHT_BYTES', str(2 * 1024 * 1024)))
+# Bundan büyük kayıtlar (ör. ekli e-postalar) pool'a gönderilmez, akış yazıcısında sıkıştırılır
+EXPORT_COMPRESS_INLINE_MAX = int(os.getenv('EXPORT_COMPRESS_INLINE_MAX', str(512 * 1024)))
+EXPORT_COMPRESS_BATCH_ENTRIES = 64
+EXPORT_COMPRESS_BLOCK_SIZE = 256 * 1024
+
+
+def parse_compression_level(request: dict) -> int:
+    """İstekteki compression_level (0-9) / store_only seçeneğini doğrula; 0 = sıkıştırmasız"""
+    if request.get("store_only"):
+        return 0
+    level = request.get("compression_level", 6)
+    if isinstance(level, bool) or not isinstance(level, int) or not 0 <= level <= 9:
+        raise HTTPException(status_code=400, detail="compression_level 0 ile 9 arasında olmalı")
+    return level
+
+
+def compress_zip_payloads(payloads: List[bytes], compress_level: int) -> List[tuple]:
+    """
+    Process pool görevi: kayıtları ham DEFLATE ile sıkıştır.
+    Küçülmeyen kayıtlar için sıkıştırılmış veri yerine None döner (STORED yazılır).
+    """
+    results = []
+    for data in payloads:
+        crc = zlib.crc32(data)
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) < len(data):
+            results.append((compressed, crc, len(data)))
+        else:
+            results.append((None, crc, len(data)))
+    return results
+
+
+async def read_entry_head(data, limit: int):
+    """
+    Kaydın ilk limit baytından fazlasını okumadan (baş, kalan) döndür. Veri bytes ya da bytes
+    parçaları üreten async iterator olabilir; kayıt sığdıysa kalan None'dır.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data), (None if len(data) <= limit else iter_async([]))
+    iterator = data.__aiter__()
+    head = bytearray()
+    while len(head) <= limit:
+        try:
+            head += await iterator.__anext__()
+        except StopAsyncIteration:
+            return bytes(head), None
+    return bytes(head), iterator
+
+
+async def iter_async(items):
+    for item in items:
+        yield item
+
+
+async def iter_compressed_entries(writer: "ZipStreamWriter", entries, compress_level: int,
+                                  workers: int = EXPORT_COMPRESS_WORKERS,
+                                  inline_max: int = EXPORT_COMPRESS_INLINE_MAX,
+                                  inflight_max: int = EXPORT_COMPRESS_INFLIGHT_BYTES):
+    """
+    (ad, tarih, veri) kayıtlarını arşive giriş sırasıyla yaz; veri bytes ya da parça üreten async
+    iterator olabilir. inline_max'a kadar olan kayıtlar process pool'da sınırlı partiler halinde
+    paralel sıkıştırılır: bekleyen parti sayısı workers + 1, toplam ham bayt inflight_max ile
+    sınırlıdır. Daha büyük kayıtlar, önceki partiler yazıldıktan sonra bellekte tutulmadan akış
+    yazıcısında parça parça sıkıştırılır; event loop bloklanmaz, bellek kayıt boyutundan bağımsızdır.
+    """
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    batch = []
+    batch_bytes = 0
+    inflight = 0
+    
+    async def drain_oldest() -> bytes:
+        nonlocal inflight
+        items, future, size = pending.popleft()
+        inflight -= size
+        output = bytearray()
+        for (name, date_time, data), (compressed, crc, size) in zip(items, await future):
+            if compressed is None:
+                output += writer.add_compressed_entry(name, data, crc, size, zipfile.ZIP_STORED, date_time)
+            else:
+                output += writer.add_compressed_entry(name, compressed, crc, size, zipfile.ZIP_DEFLATED, date_time)
+        return bytes(output)
+    
+    def submit():
+        payloads = [data for _, _, data in batch]
+        pool = get_process_pool("zip_compress", workers)
+        pending.append((batch, loop.run_in_executor(pool, compress_zip_payloads, payloads, compress_level), batch_bytes))
+    
+    async for name, date_time, data in entries:
+        head, rest = await read_entry_head(data, inline_max)
+        if rest is None and compress_level == 0:
+            yield writer.add_entry(name, head, date_time, compress=False)
+            continue
+        if rest is None:
+            batch.append((name, date_time, head))
+            batch_bytes += len(head)
+            inflight += len(head)
+            if batch_bytes >= EXPORT_COMPRESS_BATCH_BYTES or len(batch) >= EXPORT_COMPRESS_BATCH_ENTRIES:
+                submit()
+                batch, batch_bytes = [], 0
+            while pending and (len(pending) > workers or inflight > inflight_max):
+                yield await drain_oldest()
+            continue
+        
+        # Büyük kayıt: sıra korunarak önceki kayıtlar yazılır, sonra akışla sıkıştırılır
+        if batch:
+            submit()
+            batch, batch_bytes = [], 0
+        while pending:
+            yield await drain_oldest()
+        yield writer.start_entry(name, date_time, compress=compress_level > 0, compress_level=compress_level or 6)
+        block = bytearray(head)
+        async for chunk in rest:
+            block += chunk
+            if len(block) >= EXPORT_COMPRESS_BLOCK_SIZE:
+                yield await asyncio.to_thread(writer.write, bytes(block))
+                block.clear()
+        if block:
+            yield await asyncio.to_thread(writer.write, bytes(block))
+        yield writer.end_entry()
+    if batch:
+        submit()
+    while pending:
+        yield await drain_oldest()
+
+
+def clean_export_email(email: dict) -> dict:
+    """Dışa aktarım için iç alanları (_id, arama terimleri) çıkar"""
+    email_dict = dict(email)
+    email_dict.pop("_id", None)
+    email_dict.pop("attachment_terms", None)
+    return email_dict
+
+
+async def coalesce_chunks(chunks, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """Küçük parçaları birleştirerek response'a ~chunk_size büyüklüğünde yaz (ilk parça beklemeden gönderilir)"""
+    buffer = bytearray()
+    first = True
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        buffer += chunk
+        if first or len(buffer) >= chunk_size:
+            first = False
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+async def gzip_chunks(chunks, compress_level: int = 6):
+    """Parçaları akış halinde gzip ile sıkıştır"""
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def iter_json_array(cursor):
+    """Cursor'daki belgeleri geçerli bir JSON dizisi olarak eleman eleman yaz (indent=2)"""
+    yield b"["
+    first = True
+    async for email in cursor:
+        item = json.dumps(clean_export_email(email), indent=2, ensure_ascii=False, default=str)
+        prefix = "\n  " if first else ",\n  "
+        yield (prefix + item.replace("\n", "\n  ")).encode('utf-8')
+        first = False
+    yield b"]" if first else b"\n]"
+
+
+async def iter_ndjson(cursor):
+    """Her belge için tek satırlık JSON (NDJSON) üret"""
+    async for email in cursor:
+        yield (json.dumps(clean_export_email(email), ensure_ascii=False, default=str) + "\n").encode('utf-8')
+
+
+def build_export_projection(fields: Optional[List[str]]) -> Dict[str, int]:
+    """
+    İstemcinin istediği alanlar için MongoDB projection'ı oluştur. MongoDB'nin reddedeceği yollar
+    burada (yanıt başlamadan, 400 ile) elenir; aksi halde hata akışın ortasında gelirdi.
+    """
+    if not fields:
+        return {"attachment_terms": 0}
+    if not isinstance(fields, list) or not all(
+        isinstance(field, str) and '\0' not in field
+        and all(part and not part.startswith('$') for part in field.split('.'))
+        for field in fields
+    ):
+        raise HTTPException(status_code=400, detail="Geçersiz alan listesi")
+    # "from" ile "from.name" gibi biri diğerini kapsayan yollar projection'da çakışır
+    requested = set(fields)
+    for field in requested:
+        parts = field.split('.')
+        if any('.'.join(parts[:depth]) in requested for depth in range(1, len(parts))):
+            raise HTTPException(status_code=400, detail=f"Çakışan alan yolları: {field}")
+    projection = {field: 1 for field in fields}
+    projection["_id"] = 0
+    return projection
+
+
+_DISPLAY_ADDRESS_RE = re.compile(r'^\s*([^\s()<>]+@[^\s()<>]+)\s*\((.*)\)\s*$')
+MIME_LINE_BYTES = 57  # 76 karakterlik base64 satırı
+
+
+def split_display_address(value: str):
+    """'adres@x.com (Ad Soyad)' veya 'Ad <adres>' biçimini (ad, adres) çiftine ayır"""
+    value = (value or "").strip()
+    if '@' in value and not any(ch in value for ch in ' <>(),"'):
+        return "", value
+    match = _DISPLAY_ADDRESS_RE.match(value)
+    if match:
+        return match.group(2), match.group(1)
+    name, address = parseaddr(value)
+    return name, address or value
+
+
+def _header_text(value: Any) -> str:
+    return re.sub(r'[\r\n]+', ' ', str(value or "")).strip()
+
+
+def fold_mime_headers(headers) -> bytes:
+    """
+    Üst bilgileri CRLF satırlarına dönüştür. Kısa ASCII değerler doğrudan yazılır;
+    ASCII olmayan veya uzun değerler email.policy ile kodlanıp katlanır (yavaş yol).
+    """
+    lines = []
+    for name, value in headers:
+        if value.isascii() and len(name) + len(value) < 76:
+            lines.append(f"{name}: {value}\r\n".encode('ascii'))
+        else:
+            lines.append(email_policy.SMTP.fold_binary(*email_policy.SMTP.header_store_parse(name, value)))
+    return b''.join(lines)
+
+
+def email_message_id(email: dict) -> str:
+    """Kayıtlı Message-ID'yi, yoksa e-posta ID'sinden türetilmiş kalıcı bir değeri döndür"""
+    message_id = email.get("internet_message_id")
+    if message_id:
+        return message_id if message_id.startswith('<') else f"<{message_id}>"
+    return f"<{email.get('id', uuid.uuid4())}@postadepo.local>"
+
+
+def build_mime_headers(email: dict) -> List[tuple]:
+    """E-posta kaydından RFC 5322 üst bilgilerini (ad, değer) listesi olarak oluştur"""
+    sender_name, sender_address = split_display_address(email.get("sender", ""))
+    sender_name = email.get("sender_name") or sender_name
+    headers = [('From', formataddr((_header_text(sender_name), _header_text(sender_address))))]
+    
+    recipients = email.get("recipients")
+    if not recipients:
+        recipients = [r for r in (email.get("recipient") or "").split(",") if r.strip()]
+    if recipients:
+        headers.append(('To', ", ".join(
+            formataddr(tuple(_header_text(part) for part in split_display_address(r))) for r in recipients
+        )))
+    
+    headers += [
+        ('Subject', _header_text(email.get("subject", ""))),
+        ('Date', format_datetime(coerce_datetime(email.get("date")))),
+        ('Message-ID', email_message_id(email)),
+        ('MIME-Version', '1.0'),
+    ]
+    if email.get("important"):
+        headers += [('Importance', 'high'), ('X-Priority', '1')]
+    # PostaDepo'ya geri yüklemede kullanılan bayraklar
+    headers += [
+        ('X-PostaDepo-Id', _header_text(email.get("id", ""))),
+        ('X-PostaDepo-Folder', _header_text(email.get("folder", ""))),
+        ('X-PostaDepo-Read', 'true' if email.get("read") else 'false'),
+        ('X-PostaDepo-Important', 'true' if email.get("important") else 'false'),
+    ]
+    if email.get("thread_id"):
+        headers.append(('X-PostaDepo-Thread-Id', _header_text(email["thread_id"])))
+    return headers
+
+
+def build_mime_body_part(email: dict) -> bytes:
+    """Metin veya HTML gövde parçasını (üst bilgileri ve quoted-printable içeriğiyle) oluştur"""
+    subtype = "html" if str(email.get("content_type", "text")).lower() == "html" else "plain"
+    text = (email.get("content") or "").replace('\r\n', '\n').replace('\r', '\n')
+    if not text.endswith('\n'):
+        text += '\n'
+    # binascii.b2a_qp C uygulamasıdır; email paketinin saf Python kodlayıcısından çok daha hızlı
+    encoded = binascii.b2a_qp(text.encode('utf-8'), istext=True).replace(b'\n', b'\r\n')
+    return (
+        f'Content-Type: text/{subtype}; charset="utf-8"\r\n'
+        'Content-Transfer-Encoding: quoted-printable\r\n\r\n'
+    ).encode('ascii') + encoded
+
+
+def build_attachment_part_headers(attachment: dict) -> bytes:
+    """Ek parçası üst bilgileri; ASCII olmayan dosya adları RFC 2231 ile kodlanır"""
+    filename = _header_text(attachment.get("name")) or "ek"
+    content_type = _header_text(attachment.get("type")) or "application/octet-stream"
+    if filename.isascii() and not any(ch in filename for ch in '"\\') and len(filename) < 60:
+        return (
+            f'Content-Type: {content_type}; name="{filename}"\r\n'
+            f'Content-Disposition: attachment; filename="{filename}"\r\n'
+            'Content-Transfer-Encoding: base64\r\n'
+        ).encode('ascii')
+    part = MIMEPart(policy=email_policy.SMTP)
+    part['Content-Type'] = content_type
+    part.set_param('name', filename)
+    part['Content-Disposition'] = 'attachment'
+    part.set_param('filename', filename, header='Content-Disposition')
+    part['Content-Transfer-Encoding'] = 'base64'
+    return b''.join(part.policy.fold_binary(name, value) for name, value in part.items())
+
+
+async def iter_base64_lines(chunks):
+    """Parçaları 76 karakterlik CRLF satırları halinde base64 olarak kodla"""
+    pending = b''
+    async for chunk in chunks:
+        pending += chunk
+        cut = len(pending) - len(pending) % MIME_LINE_BYTES
+        if cut:
+            yield base64.encodebytes(pending[:cut]).replace(b'\n', b'\r\n')
+            pending = pending[cut:]
+    if pending:
+        yield base64.encodebytes(pending).replace(b'\n', b'\r\n')
+
+
+async def iter_email_mime(email: dict):
+    """
+    E-postayı içe aktarılabilir bir RFC 5322 / MIME mesajı olarak parça parça üret.
+    Saklanmış ham MIME varsa olduğu gibi kullanılır; ekler depodan akış halinde kodlanır.
+    """
+    if email.get("raw_mime_blob_id"):
+        async for chunk in iter_attachment_bytes({"blob_id": email["raw_mime_blob_id"]}):
+            yield chunk
+        return
+    
+    headers = build_mime_headers(email)
+    body_part = build_mime_body_part(email)
+    attachments = email.get("attachments") or []
+    
+    if not attachments:
+        yield fold_mime_headers(headers) + body_part
+        return
+    
+    boundary = f"=_PostaDepo_{hashlib.sha1(str(email.get('id', '')).encode()).hexdigest()[:24]}"
+    headers.append(('Content-Type', f'multipart/mixed; boundary="{boundary}"'))
+    yield fold_mime_headers(headers) + b'\r\nThis is a multi-part message in MIME format.\r\n'
+    yield f'\r\n--{boundary}\r\n'.encode('ascii') + body_part
+    
+    for attachment in attachments:
+        yield f'\r\n--{boundary}\r\n'.encode('ascii') + build_attachment_part_headers(attachment) + b'\r\n'
+        async for lines in iter_base64_lines(iter_attachment_bytes(attachment)):
+            yield lines
+    
+    yield f'\r\n--{boundary}--\r\n'.encode('ascii')
+
+
+async def iter_eml_digest(cursor, folder: str):
+    """Birden çok e-postayı tek bir .eml dosyasında multipart/digest olarak akış halinde yaz"""
+    boundary = f"=_PostaDepo_Digest_{uuid.uuid4().hex[:24]}"
+    headers = [
+        ('From', 'PostaDepo <export@postadepo.local>'),
+        ('Subject', f"PostaDepo E-posta Dışa Aktarma - {folder}"),
+        ('Date', format_datetime(datetime.now(timezone.utc))),
+        ('MIME-Version', '1.0'),
+        ('Content-Type', f'multipart/digest; boundary="{boundary}"'),
+    ]
+    yield fold_mime_headers(headers) + b'\r\n'
+    
+    async for email in cursor:
+        yield f'\r\n--{boundary}\r\nContent-Type: message/rfc822\r\n\r\n'.encode('ascii')
+        async for chunk in iter_email_mime(email):
+            yield chunk
+    
+    yield f'\r\n--{boundary}--\r\n'.encode('ascii')
+
+
+_MBOXRD_FROM_RE = re.compile(rb'^(>*From )', re.MULTILINE)
+
+
+def mbox_envelope_line(email: dict) -> bytes:
+    """mbox ayırıcı satırı: 'From <gönderen> <asctime>'"""
+    _, address = split_display_address(email.get("sender", ""))
+    if not address or any(ch.isspace() for ch in address):
+        address = "MAILER-DAEMON"
+    stamp = time.asctime(coerce_datetime(email.get("date")).astimezone(timezone.utc).timetuple())
+    return f"From {address} {stamp}\n".encode('utf-8', 'replace')
+
+
+async def iter_mboxrd_body(chunks):
+    """MIME akışını satır sonlarını LF'ye çevirip mboxrd kuralıyla ('>*From ' -> '>' eklenir) tırnakla"""
+    pending = b''
+    async for chunk in chunks:
+        pending += chunk
+        cut = pending.rfind(b'\n') + 1
+        if cut:
+            yield _MBOXRD_FROM_RE.sub(rb'>\1', pending[:cut].replace(b'\r\n', b'\n'))
+            pending = pending[cut:]
+    if pending:
+        yield _MBOXRD_FROM_RE.sub(rb'>\1', pending.replace(b'\r\n', b'\n')) + b'\n'
+
+
+async def iter_mbox_export(cursor):
+    """E-postaları mboxrd biçiminde (Thunderbird vb. ile uyumlu) akış halinde üret"""
+    async for email in cursor:
+        yield mbox_envelope_line(email)
+        async for chunk in iter_mboxrd_body(iter_email_mime(email)):
+            yield chunk
+        yield b'\n'
+
+
+# Maildir++ klasör adları (Dovecot/Courier uyumlu); gelen kutusu kök dizindir
+MAILDIR_FOLDER_NAMES = {
+    "inbox": "",
+    "sent": ".Sent",
+    "drafts": ".Drafts",
+    "deleted": ".Trash",
+    "junk": ".Junk",
+    "spam": ".Junk",
+    "archive": ".Archive",
+}
+TAR_BLOCK_SIZE = 512
+
+
+def maildir_folder_path(folder: str) -> str:
+    """PostaDepo klasörünü Maildir++ dizinine eşle"""
+    folder = (folder or "inbox").lower()
+    if folder in MAILDIR_FOLDER_NAMES:
+        subdir = MAILDIR_FOLDER_NAMES[folder]
+    else:
+        subdir = "." + safe_archive_name(folder, "Klasor").replace(".", "_")
+    return f"Maildir/{subdir}".rstrip("/")
+
+
+def maildir_entry_name(email: dict, index: int) -> str:
+    """
+    Maildir dosya yolu: okunmamış ve işaretsiz e-postalar new/ altına, diğerleri
+    bilgi ekiyle (':2,FS') cur/ altına yazılır. F = önemli, S = okundu.
+    """
+    stamp = int(coerce_datetime(email.get("date")).timestamp())
+    unique = re.sub(r'[^A-Za-z0-9_-]', '_', str(email.get("id") or index))
+    flags = ("F" if email.get("important") else "") + ("S" if email.get("read") else "")
+    base = maildir_folder_path(email.get("folder"))
+    if flags:
+        return f"{base}/cur/{stamp}.{unique}.postadepo:2,{flags}"
+    return f"{base}/new/{stamp}.{unique}.postadepo"
+
+
+def tar_entry_header(name: str, size: int = 0, mtime: float = 0, is_dir: bool = False) -> bytes:
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    if is_dir:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+    else:
+        info.mode = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8')
+
+
+async def iter_maildir_tar(cursor):
+    """
+    Maildir yapısını (klasör başına cur/new/tmp) geçici dosya olmadan tar akışı olarak üret.
+    Tar başlığı boyutu önceden istediğinden her mesaj tek başına bellekte oluşturulur;
+    bellek kullanımı dışa aktarılan e-posta sayısıyla değil en büyük mesajla sınırlıdır.
+    """
+    created_dirs = set()
+    now = time.time()
+    index = 0
+    
+    async for email in cursor:
+        index += 1
+        base = maildir_folder_path(email.get("folder"))
+        if base not in created_dirs:
+            created_dirs.add(base)
+            for subdir in ("", "/cur", "/new", "/tmp"):
+                yield tar_entry_header(base + subdir, mtime=now, is_dir=True)
+        
+        message = bytearray()
+        async for chunk in iter_email_mime(email):
+            message += chunk
+        mtime = coerce_datetime(email.get("date")).timestamp()
+        yield tar_entry_header(maildir_entry_name(email, index), len(message), mtime)
+        yield bytes(message)
+        padding = -len(message) % TAR_BLOCK_SIZE
+        if padding:
+            yield b'\0' * padding
+    
+    # Arşiv sonu: en az iki boş blok (tar kaydı boyutunda)
+    yield b'\0' * tarfile.RECORDSIZE
+
+
+async def iter_zip_export(cursor_factory, folder: str, compress_level: int = 6):
+    """
+    ZIP dışa aktarımını cursor üzerinden akış halinde üret. Özet JSON ve .eml dosyaları
+    kayıt kayıt yazılır; bellek kullanımı posta kutusu boyutundan bağımsızdır.
+    Sıkıştırma event loop dışında yapılır: özet bloklar halinde thread'de, .eml
+    kayıtları process pool'da paralel. compress_level=0 sıkıştırmasız yazar (.eml STORED, özet seviye 0 DEFLATE).
+    cursor_factory her çağrıldığında aynı sırada yeni bir cursor döndürmelidir.
+    """
+    writer = ZipStreamWriter()
+    
+    # Özet JSON - dizi elemanları tek tek yazılır; zlib sıkıştırırken GIL'i bırakır
+    yield writer.start_entry(f"emails-summary-{folder}.json", compress=compress_level > 0,
+                             compress_level=compress_level or 6)
+    block = bytearray()
+    async for piece in iter_json_array(cursor_factory()):
+        block += piece
+        if len(block) >= EXPORT_COMPRESS_BLOCK_SIZE:
+            yield await asyncio.to_thread(writer.write, bytes(block))
+            block.clear()
+    if block:
+        yield await asyncio.to_thread(writer.write, bytes(block))
+    yield writer.end_entry()
+    
+    # Her e-posta için ayrı .eml dosyası
+    async def iter_eml_entries():
+        index = 0
+        async for email in cursor_factory():
+            index += 1
+            yield f"emails/email-{index:03d}.eml", email.get("date"), iter_email_mime(email)
+    
+    async for chunk in iter_compressed_entries(writer, iter_eml_entries(), compress_level):
+        yield chunk
+    
+    yield writer.finish()
+
+
+EXPORT_FORMATS = ("json", "ndjson", "zip", "eml", "mbox", "maildir", "snapshot")
+
+
+async def iter_counted(cursor, progress: Optional[Dict[str, int]]):
+    """Cursor'dan geçen e-postaları ilerleme sayacına yansıt"""
+    async for email in cursor:
+        yield email
+        if progress is not None:
+            progress["messages"] += 1
+
+
+def build_export_stream(format_type: str, query: dict, folder: str, request: dict,
+                        progress: Optional[Dict[str, int]] = None):
+    """
+    Dışa aktarma akışını oluştur: (bayt üreteci, media type, dosya adı).
+    Hem senkron /export-emails hem de arka plan dışa aktarma işleri tarafından kullanılır.
+    """
+    if format_type not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Desteklenmeyen format")
+    
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    use_gzip = request.get("compression") == "gzip" or request.get("gzip") is True
+    
+    def open_cursor(projection: dict, counted: bool = True):
+        cursor = db.emails.find(query, projection).sort("_id", 1).batch_size(EXPORT_BATCH_SIZE)
+        return iter_counted(cursor, progress if counted else None)
+    
+    if format_type in ("json", "ndjson"):
+        # JSON dizisi veya NDJSON - cursor'dan eleman eleman, ilk bayt hemen gönderilir
+        cursor = open_cursor(build_export_projection(request.get("fields")))
+        body = iter_json_array(cursor) if format_type == "json" else iter_ndjson(cursor)
+        media_type = "application/json" if format_type == "json" else "application/x-ndjson"
+        filename = f"postadepo-emails-{folder}-{timestamp}.{format_type}"
+    elif format_type == "zip":
+        # ZIP export - cursor'dan akış halinde, tüm arşiv bellekte tutulmaz.
+        # Özet JSON için ilk geçiş sayılmaz; ilerleme .eml girdilerinden ölçülür.
+        passes = iter([False, True])
+        body = iter_zip_export(
+            lambda: open_cursor({"attachment_terms": 0}, next(passes, True)), folder,
+            parse_compression_level(request)
+        )
+        media_type = "application/zip"
+        filename = f"postadepo-emails-{folder}-{timestamp}.zip"
+        use_gzip = False
+    elif format_type == "eml":
+        # EML export - tüm e-postalar tek dosyada, her biri message/rfc822 parçası olarak (multipart/digest)
+        body = iter_eml_digest(open_cursor({"attachment_terms": 0}), folder)
+        media_type = "message/rfc822"
+        filename = f"postadepo-emails-{folder}-{timestamp}.eml"
+        use_gzip = False
+    elif format_type == "mbox":
+        # mboxrd export - Thunderbird ve diğer mbox tabanlı araçlar için, isteğe bağlı gzip
+        body = iter_mbox_export(open_cursor({"attachment_terms": 0}))
+        media_type = "application/mbox"
+        filename = f"postadepo-emails-{folder}-{timestamp}.mbox"
+    elif format_type == "maildir":
+        # Maildir export - IMAP sunucusu taşımaları için tar (veya tar.gz) akışı
+        body = iter_maildir_tar(open_cursor({"attachment_terms": 0}))
+        media_type = "application/x-tar"
+        filename = f"postadepo-maildir-{folder}-{timestamp}.tar"
+    else:
+        # Yedek anlık görüntüsü - since_last ile yalnızca son anlık görüntüden beri değişenler
+        incremental = bool(request.get("since_last"))
+        body = iter_snapshot_archive(query, folder, incremental, progress)
+        media_type = "application/zip"
+        filename = f"postadepo-snapshot-{folder}-{timestamp}.zip"
+        use_gzip = False
+    
+    if use_gzip:
+        body = gzip_chunks(body)
+        media_type = "application/gzip"
+        filename += ".gz"
+    
+    return coalesce_chunks(body), media_type, filename
+
+
+def build_export_query(user_id: str, folder: str) -> dict:
+    query = {"user_id": user_id}
+    if folder != "all":
+        query["folder"] = folder
+    return query
+
 
 @api_router.post("/export-emails")
-async def export_emails(request: dict, current_user: dict = Depends(get_current_user)):
+async def export_emails(request: dict, http_request: Request, current_user: dict = Depends(get_current_user)):
     format_type = request.get("format", "json")
     folder = request.get("folder", "all")
     
+    # Posta kutusu değişmediyse önceki dışa aktarım dosyası doğrudan sunulur
+    version = await get_mailbox_version(current_user["id"])
+    cache_key = export_cache.make_key(current_user["id"], folder, format_type, request, version)
+    cached = export_cache.get(cache_key)
+    if cached:
+        response = range_file_response(
+            cached["path"], http_request, cached["media_type"], cached["filename"], f'"{cache_key[:32]}"'
+        )
+        response.headers["X-Export-Cache"] = "hit"
+        return response
+    
     # Get emails to export
-    query = {"user_id": current_user["id"]}
-    if folder != "all":
-        query["folder"] = folder
+    query = build_export_query(current_user["id"], folder)
+    body, media_type, filename = build_export_stream(format_type, query, folder, request)
+    
+    return StreamingResponse(
+        export_cache.tee(cache_key, body, media_type, filename),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}", "X-Export-Cache": "miss"}
+    )
+
+
+# ============== EXPORT JOBS ==============
+
+EXPORT_SPOOL_DIR = Path(os.environ.get('EXPORT_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'postadepo-exports')))
+# Spool dizini tüm sunucuların bağladığı paylaşılan bir birimse true; değilse dosya yalnızca işi
+# üreten makineden indirilebilir (iş kaydında host, yanıtta download_node_local)
+EXPORT_SPOOL_SHARED = os.environ.get('EXPORT_SPOOL_SHARED', 'false').lower() == 'true'
+EXPORT_JOB_TTL_HOURS = float(os.environ.get('EXPORT_JOB_TTL_HOURS', '24'))
+EXPORT_JOBS_PER_USER = int(os.environ.get('EXPORT_JOBS_PER_USER', '2'))
+EXPORT_JOBS_PER_NODE = int(os.environ.get('EXPORT_JOBS_PER_NODE', '4'))
+EXPORT_JOB_CLEANUP_INTERVAL = float(os.environ.get('EXPORT_JOB_CLEANUP_INTERVAL', '300'))
+EXPORT_PROGRESS_INTERVAL = 1.0
+# Çalışan işler updated_at alanını bu aralıkla yeniler; JOB_STALE_MINUTES boyunca yenilenmeyen
+# iş, hangi süreçte olursa olsun ölü sayılır (süreç ya da makine kapanmış, adı değişmiş)
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', '30'))
+JOB_STALE_MINUTES = float(os.environ.get('JOB_STALE_MINUTES', '10'))
+
+ACTIVE_EXPORT_STATUSES = ["queued", "running"]
+
+
+class ExportJobCancelled(Exception):
+    """İş kaydı çalışırken silindi ya da başka bir süreç tarafından sonlandırıldı"""
+
+
+def stale_job_query(statuses: List[str], **scope) -> Dict[str, Any]:
+    """Aktif görünen ama sahibi JOB_STALE_MINUTES boyunca nabız vermemiş işler"""
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=JOB_STALE_MINUTES)
+    return {
+        **scope,
+        "status": {"$in": statuses},
+        "$or": [{"updated_at": {"$lt": cutoff}}, {"updated_at": None, "created_at": {"$lt": cutoff}}],
+    }
+
+
+async def iter_orphaned_jobs(collection, statuses: List[str], **scope):
+    """
+    Sahibi kaybolmuş aktif işler: sahibi bu makinede artık çalışmayan süreçse hemen, değilse
+    nabzı JOB_STALE_MINUTES boyunca kesildiğinde. Çağıran işi {id, node, updated_at} üzerinden
+    koşullu yazımla sahiplenmelidir; aynı işi iki süreç birden devralamaz.
+    """
+    seen = set()
+    async for job in collection.find({**scope, **host_scope(), "status": {"$in": statuses}}, {"_id": 0}):
+        if owner_is_gone(job.get("node")):
+            seen.add(job["id"])
+            yield job
+    async for job in collection.find(stale_job_query(statuses, **scope), {"_id": 0}):
+        if job["id"] not in seen and job.get("node") != NODE_ID:
+            yield job
+
+
+def job_claim(job: dict, statuses: List[str]) -> Dict[str, Any]:
+    """İşi okunduğu andaki sahibine ve nabzına koşullu güncelleme filtresi"""
+    return {"id": job["id"], "status": {"$in": statuses}, "node": job.get("node"), "updated_at": job.get("updated_at")}
+
+
+async def job_heartbeat_loop(collection, jobs: Dict[str, asyncio.Task], statuses: List[str]):
+    """Bu süreçte çalışan ya da sırada bekleyen işlerin updated_at alanını düzenli yenile"""
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        try:
+            if jobs:
+                await collection.update_many(
+                    {"id": {"$in": list(jobs)}, "node": NODE_ID, "status": {"$in": statuses}},
+                    {"$set": {"updated_at": datetime.now(timezone.utc)}}
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Job heartbeat error: {e}")
+
+
+def parse_range_header(range_header: Optional[str], size: int):
+    """
+    Tek aralıklı 'bytes=' Range başlığını (başlangıç, bitiş) çiftine çevir.
+    Başlık yoksa, biçimi bozuksa veya birden çok aralık içeriyorsa None döner
+    (dosyanın tamamı 200 ile gönderilir); karşılanamayan aralıkta 416 verir.
+    """
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_text, sep, end_text = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+        else:
+            # Son N bayt
+            suffix = int(end_text)
+            if suffix <= 0:
+                raise ValueError
+            start, end = max(size - suffix, 0), size - 1
+    except ValueError:
+        return None
+    
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="İstenen aralık karşılanamıyor",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, min(end, size - 1)
+
+
+async def iter_file_range(path: Path, start: int, end: int, chunk_size: int = EXPORT_CHUNK_SIZE):
+    async with await anyio.open_file(path, "rb") as handle:
+        await handle.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await handle.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def range_file_response(path: Path, request: Request, media_type: str, filename: str, etag: str):
+    """
+    Dosyayı Range desteğiyle sun: aralık yoksa FileResponse (200), tek aralıkta 206.
+    If-Range ETag ile eşleşmezse dosyanın tamamı gönderilir.
+    """
+    size = path.stat().st_size
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f"attachment; filename={filename}"
+    }
+    
+    byte_range = parse_range_header(request.headers.get("range"), size)
+    if_range = request.headers.get("if-range")
+    if byte_range is None or (if_range and if_range != etag):
+        return FileResponse(path, media_type=media_type, headers=headers)
+    
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(iter_file_range(path, start, end), status_code=206, media_type=media_type, headers=headers)
+
+
+class ExportJobManager:
+    """
+    Arka plan dışa aktarma işleri: arşivi spool dizinine yazar, ilerlemeyi (e-posta ve bayt)
+    export_jobs koleksiyonuna işler, süresi dolan dosyaları temizler.
+    Eşzamanlılık kullanıcı başına (aktif iş sayısı) ve düğüm başına (semaphore) sınırlıdır.
+    Kayıt güncellemeleri sahip sürece (node) koşulludur; kayıt silinir ya da iş sonlandırılırsa
+    çalışan süreç bir sonraki ilerleme yazımında durur.
+    """
+    
+    def __init__(self, spool_dir: Path, ttl_hours: float, per_user: int, per_node: int, cleanup_interval: float):
+        self.spool_dir = spool_dir
+        self.ttl = timedelta(hours=ttl_hours)
+        self.per_user = per_user
+        self.per_node = per_node
+        self.cleanup_interval = cleanup_interval
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._jobs: Dict[str, asyncio.Task] = {}
+        self._cleanup_task: Optional[asyncio.Task] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self.stats = {"jobs_completed": 0, "jobs_failed": 0, "jobs_expired": 0, "jobs_stale": 0, "bytes_written": 0}
+    
+    async def start(self):
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self._slots = asyncio.Semaphore(self.per_node)
+        await self.fail_orphaned_jobs()
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(
+                job_heartbeat_loop(db.export_jobs, self._jobs, ACTIVE_EXPORT_STATUSES)
+            )
+    
+    async def stop(self):
+        tasks = list(self._jobs.values())
+        for task in (self._cleanup_task, self._heartbeat_task):
+            if task:
+                tasks.append(task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._jobs = {}
+        self._cleanup_task = None
+        self._heartbeat_task = None
+    
+    async def fail_orphaned_jobs(self, **scope) -> int:
+        """
+        Sahibi kaybolmuş işleri (iter_orphaned_jobs) başarısız işaretle; yarım arşiv başka bir
+        süreçte tamamlanamaz. Aynı makinedeki çalışan süreçlerin işlerine dokunulmaz.
+        """
+        failed = 0
+        async for job in iter_orphaned_jobs(db.export_jobs, ACTIVE_EXPORT_STATUSES, **scope):
+            result = await db.export_jobs.update_one(
+                job_claim(job, ACTIVE_EXPORT_STATUSES),
+                {"$set": {"status": "failed", "error": "İş yanıt vermiyor (sunucu kapanmış olabilir)",
+                          "finished_at": datetime.now(timezone.utc)}}
+            )
+            failed += result.modified_count
+        self.stats["jobs_stale"] += failed
+        return failed
+    
+    def artifact_path(self, job: dict) -> Path:
+        return self.spool_dir / f"{job['id']}.export"
+    
+    async def create_job(self, user_id: str, request: dict) -> dict:
+        format_type = request.get("format", "json")
+        folder = request.get("folder", "all")
+        if format_type not in EXPORT_FORMATS:
+            raise HTTPException(status_code=400, detail="Desteklenmeyen format")
+        if self._slots is None:
+            raise HTTPException(status_code=503, detail="Dışa aktarma servisi hazır değil")
+        
+        # Ölü düğümde kalan işler kullanıcının kotasını kalıcı olarak doldurmasın
+        await self.fail_orphaned_jobs(user_id=user_id)
+        active = await db.export_jobs.count_documents({"user_id": user_id, "status": {"$in": ACTIVE_EXPORT_STATUSES}})
+        if active >= self.per_user:
+            raise HTTPException(status_code=429, detail="Aynı anda en fazla %d dışa aktarma işi çalıştırabilirsiniz" % self.per_user)
+        
+        query = build_export_query(user_id, folder)
+        options = {
+            key: request[key]
+            for key in ("compression", "gzip", "fields", "compression_level", "store_only", "since_last")
+            if key in request
+        }
+        # Biçim ve alan seçimi iş oluşturulmadan doğrulanır (geçersizse 400)
+        _, media_type, filename = build_export_stream(format_type, query, folder, options)
+        
+        version = await get_mailbox_version(user_id)
+        cache_key = export_cache.make_key(user_id, folder, format_type, options, version)
+        
+        now = datetime.now(timezone.utc)
+        job = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "node": NODE_ID,
+            "host": HOST_ID,
+            "status": "queued",
+            "format": format_type,
+            "folder": folder,
+            "options": options,
+            "media_type": media_type,
+            "filename": filename,
+            "messages_total": await db.emails.count_documents(query),
+            "messages_done": 0,
+            "bytes_written": 0,
+            "error": None,
+            "created_at": now,
+            "updated_at": now,
+            "started_at": None,
+            "finished_at": None,
+            "expires_at": None,
+            "cache_key": cache_key
+        }
+        
+        cached = export_cache.get(cache_key)
+        if cached:
+            # Aynı sürümün dosyası önbellekte: iş beklemeden tamamlanır
+            await asyncio.to_thread(link_or_copy, cached["path"], self.artifact_path(job))
+            job.update({
+                "status": "done",
+                "media_type": cached["media_type"],
+                "filename": cached["filename"],
+                "messages_done": job["messages_total"],
+                "bytes_written": cached["size"],
+                "started_at": now,
+                "finished_at": now,
+                "expires_at": now + self.ttl
+            })
+            await db.export_jobs.insert_one(dict(job))
+            return job
+        
+        await db.export_jobs.insert_one(dict(job))
+        self._jobs[job["id"]] = asyncio.create_task(self._run(job))
+        return job
+    
+    async def _run(self, job: dict):
+        async with self._slots:
+            path = self.artifact_path(job)
+            part_path = path.with_suffix(".part")
+            progress = {"messages": 0}
+            written = 0
+            last_report = time.monotonic()
+            owned = {"id": job["id"], "node": NODE_ID, "status": "running"}
+            try:
+                started = await db.export_jobs.update_one(
+                    {"id": job["id"], "node": NODE_ID, "status": "queued"},
+                    {"$set": {"status": "running", "started_at": datetime.now(timezone.utc),
+                              "updated_at": datetime.now(timezone.utc)}}
+                )
+                if started.matched_count == 0:
+                    raise ExportJobCancelled()
+                query = build_export_query(job["user_id"], job["folder"])
+                body, _, _ = build_export_stream(job["format"], query, job["folder"], job["options"], progress)
+                
+                async with await anyio.open_file(part_path, "wb") as handle:
+                    async for chunk in body:
+                        await handle.write(chunk)
+                        written += len(chunk)
+                        if time.monotonic() - last_report >= EXPORT_PROGRESS_INTERVAL:
+                            last_report = time.monotonic()
+                            result = await db.export_jobs.update_one(
+                                owned,
+                                {"$set": {"messages_done": progress["messages"], "bytes_written": written,
+                                          "updated_at": datetime.now(timezone.utc)}}
+                            )
+                            if result.matched_count == 0:
+                                raise ExportJobCancelled()
+                part_path.replace(path)
+                
+                finished = datetime.now(timezone.utc)
+                result = await db.export_jobs.update_one(
+                    owned,
+                    {"$set": {
+                        "status": "done",
+                        "messages_done": progress["messages"],
+                        "bytes_written": written,
+                        "finished_at": finished,
+                        "expires_at": finished + self.ttl
+                    }}
+                )
+                if result.matched_count == 0:
+                    path.unlink(missing_ok=True)
+                    raise ExportJobCancelled()
+                self.stats["jobs_completed"] += 1
+                self.stats["bytes_written"] += written
+                await export_cache.adopt(job.get("cache_key"), path, job["media_type"], job["filename"])
+            except asyncio.CancelledError:
+                part_path.unlink(missing_ok=True)
+                raise
+            except ExportJobCancelled:
+                logger.info(f"Export job {job['id']} was cancelled or taken over")
+                part_path.unlink(missing_ok=True)
+            except Exception as e:
+                logger.error(f"Export job {job['id']} failed: {e}")
+                part_path.unlink(missing_ok=True)
+                self.stats["jobs_failed"] += 1
+                await db.export_jobs.update_one(
+                    {"id": job["id"], "node": NODE_ID},
+                    {"$set": {"status": "failed", "error": str(e), "finished_at": datetime.now(timezone.utc)}}
+                )
+            finally:
+                self._jobs.pop(job["id"], None)
+    
+    def artifact_is_local(self, job: dict) -> bool:
+        return EXPORT_SPOOL_SHARED or job.get("host", job.get("node")) == HOST_ID
+    
+    async def cancel_job(self, job: dict):
+        """
+        İşi sil. Başka bir süreçte çalışan iş, kaydın silindiğini bir sonraki ilerleme yazımında
+        görüp durur ve yarım dosyasını siler; başka makinedeki dosyayı o makinenin temizliği siler.
+        """
+        task = self._jobs.pop(job["id"], None)
+        if task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if self.artifact_is_local(job):
+            self.artifact_path(job).unlink(missing_ok=True)
+        await db.export_jobs.delete_one({"id": job["id"]})
+    
+    async def expire_jobs(self):
+        """TTL'i dolan iş dosyalarını sil ve işleri 'expired' olarak işaretle"""
+        now = datetime.now(timezone.utc)
+        scope = {} if EXPORT_SPOOL_SHARED else host_scope()
+        async for job in db.export_jobs.find({**scope, "status": "done", "expires_at": {"$lte": now}}):
+            self.artifact_path(job).unlink(missing_ok=True)
+            await db.export_jobs.update_one({"id": job["id"]}, {"$set": {"status": "expired"}})
+            self.stats["jobs_expired"] += 1
+        
+        # Kaydı silinmiş veya yarım kalmış sahipsiz dosyalar; dizini paylaşan süreçlerin işleri korunur
+        cutoff = time.time() - self.ttl.total_seconds()
+        for path in self.spool_dir.glob("*"):
+            if path.stem not in self._jobs and path.stat().st_mtime < cutoff and not await db.export_jobs.count_documents(
+                {"id": path.stem, "status": {"$in": ACTIVE_EXPORT_STATUSES + ["done"]}}
+            ):
+                path.unlink(missing_ok=True)
+    
+    async def _cleanup_loop(self):
+        while True:
+            try:
+                await self.expire_jobs()
+                await self.fail_orphaned_jobs()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Export job cleanup error: {e}")
+            await asyncio.sleep(self.cleanup_interval)
+    
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "node": NODE_ID,
+            "running": len(self._jobs),
+            "per_node_limit": self.per_node,
+            "per_user_limit": self.per_user,
+            **self.stats
+        }
+
+
+export_job_manager = ExportJobManager(
+    spool_dir=EXPORT_SPOOL_DIR,
+    ttl_hours=EXPORT_JOB_TTL_HOURS,
+    per_user=EXPORT_JOBS_PER_USER,
+    per_node=EXPORT_JOBS_PER_NODE,
+    cleanup_interval=EXPORT_JOB_CLEANUP_INTERVAL
+)
+
+
+def export_job_view(job: dict) -> dict:
+    job = {key: value for key, value in job.items() if key not in ("_id", "user_id", "node", "options", "cache_key")}
+    # Paylaşılan spool yoksa dosya yalnızca host makinesinden indirilebilir
+    job["download_node_local"] = not EXPORT_SPOOL_SHARED
+    total = job.get("messages_total") or 0
+    job["percent"] = 100.0 if job.get("status") == "done" else (
+        round(job.get("messages_done", 0) * 100.0 / total, 1) if total else 0.0
+    )
+    return job
+
+
+async def get_user_export_job(job_id: str, user_id: str) -> dict:
+    job = await db.export_jobs.find_one({"id": job_id, "user_id": user_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Dışa aktarma işi bulunamadı")
+    return job
+
+
+@api_router.post("/export-jobs")
+async def create_export_job(request: dict, current_user: dict = Depends(get_current_user)):
+    """Büyük posta kutuları için arka planda dışa aktarma işi başlat"""
+    job = await export_job_manager.create_job(current_user["id"], request)
+    return export_job_view(job)
+
+
+@api_router.get("/export-jobs")
+async def list_export_jobs(current_user: dict = Depends(get_current_user)):
+    jobs = await db.export_jobs.find(
+        {"user_id": current_user["id"]}, {"_id": 0}
+    ).sort("created_at", -1).limit(50).to_list(length=50)
+    return {"jobs": [export_job_view(job) for job in jobs]}
+
+
+@api_router.get("/export-jobs/{job_id}")
+async def get_export_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    return export_job_view(await get_user_export_job(job_id, current_user["id"]))
+
+
+@api_router.get("/export-jobs/{job_id}/download")
+async def download_export_job(job_id: str, request: Request, current_user: dict = Depends(get_current_user)):
+    """Tamamlanan dışa aktarma dosyasını indir (Range ile kaldığı yerden devam edilebilir)"""
+    job = await get_user_export_job(job_id, current_user["id"])
+    if job["status"] == "expired":
+        raise HTTPException(status_code=410, detail="Dışa aktarma dosyasının süresi doldu")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail="Dışa aktarma henüz tamamlanmadı")
+    
+    path = export_job_manager.artifact_path(job)
+    if not path.exists():
+        if not export_job_manager.artifact_is_local(job):
+            # İstek dosyayı üreten makineye yönlendirilmeli (ör. X-Export-Host ile sticky routing)
+            host = job.get("host", job.get("node"))
+            raise HTTPException(
+                status_code=421,
+                detail=f"Dışa aktarma dosyası {host} sunucusunda; indirme o sunucudan yapılmalı",
+                headers={"X-Export-Host": str(host)}
+            )
+        raise HTTPException(status_code=404, detail="Dışa aktarma dosyası bulunamadı")
+    
+    return range_file_response(path, request, job["media_type"], job["filename"], f'"{job_id}"')
+
+
+@api_router.delete("/export-jobs/{job_id}")
+async def delete_export_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """İşi iptal et veya tamamlanmış dosyayı sil"""
+    job = await get_user_export_job(job_id, current_user["id"])
+    await export_job_manager.cancel_job(job)
+    return {"message": "Dışa aktarma işi silindi"}
+
+# ============== EXPORT ARTIFACT CACHE ==============
+
+EXPORT_CACHE_ENABLED = os.environ.get('EXPORT_CACHE_ENABLED', 'true').lower() == 'true'
+EXPORT_CACHE_DIR = Path(os.environ.get('EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'postadepo-export-cache')))
+# Düğüm başına toplam bütçe; aynı dizini paylaşan worker süreçleri arasında eşit bölünür
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get('EXPORT_CACHE_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+EXPORT_CACHE_PROCESSES = max(1, int(os.environ.get('WEB_CONCURRENCY', '1')))
+
+# Çıktıyı etkileyen istek seçenekleri; önbellek anahtarına girer
+EXPORT_CACHE_OPTIONS = ("fields", "compression", "gzip", "compression_level", "store_only")
+
+
+async def get_mailbox_version(user_id: str) -> int:
+    doc = await db.mailbox_versions.find_one({"user_id": user_id}, {"_id": 0, "version": 1})
+    return doc["version"] if doc else 0
+
+
+async def bump_mailbox_version(user_id: str):
+    """Posta kutusu değişti: sürümü artır (önbellekteki dışa aktarımlar geçersiz olur)"""
+    await db.mailbox_versions.update_one(
+        {"user_id": user_id},
+        {"$inc": {"version": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+
+class ExportArtifactCache:
+    """
+    Tamamlanmış dışa aktarma dosyalarının yerel disk önbelleği.
+    Anahtar (kullanıcı, klasör, format, seçenekler, posta kutusu sürümü); posta kutusu
+    değiştiğinde sürüm artar ve eski kayıtlar bir daha eşleşmez, LRU ile silinir.
+    Toplam boyut max_bytes ile sınırlıdır.
+    
+    Her süreç ortak kök altında kendi alt dizinini ({HOST_ID}.{pid}) kullanır ve yalnızca onu
+    temizler; kayıt tablosu süreç içinde tutulduğundan başka süreçlerin dosyalarına dokunulmaz.
+    """
+    
+    def __init__(self, root: Path, max_bytes: int, enabled: bool = True):
+        self.root = root
+        self.cache_dir = root / f"{HOST_ID}.{os.getpid()}"
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.total_bytes = 0
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+    
+    def start(self):
+        if not self.enabled:
+            return
+        # Kayıt tablosu yeniden başlatmada kaybolur; aynı pid'le kalmış eski dizin temizlenir
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._remove_orphans()
+    
+    def _remove_orphans(self):
+        """Bu makinede artık çalışmayan süreçlerden kalan alt dizinleri sil"""
+        for path in self.root.iterdir():
+            host, _, pid = path.name.rpartition(".")
+            if path == self.cache_dir or host != HOST_ID or not pid.isdigit():
+                continue
+            if not process_is_running(int(pid)):
+                shutil.rmtree(path, ignore_errors=True)
+    
+    @staticmethod
+    def make_key(user_id: str, folder: str, format_type: str, request: dict, version: int) -> Optional[str]:
+        if format_type == "snapshot":
+            return None  # anlık görüntülerin yan etkisi var (zincir durumu), önbelleğe alınmaz
+        options = {key: request.get(key) for key in EXPORT_CACHE_OPTIONS}
+        raw = json.dumps([user_id, folder, format_type, options, version], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def get(self, key: Optional[str]) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key) if key and self.enabled else None
+        if entry is None or not entry["path"].exists():
+            if entry is not None:
+                self._remove(key)
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry
+    
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.total_bytes -= entry["size"]
+            entry["path"].unlink(missing_ok=True)
+    
+    def _register(self, key: str, path: Path, media_type: str, filename: str):
+        size = path.stat().st_size
+        if size > self.max_bytes:
+            path.unlink(missing_ok=True)
+            return
+        if key in self._entries:
+            self.total_bytes -= self._entries.pop(key)["size"]
+        self._entries[key] = {"path": path, "size": size, "media_type": media_type, "filename": filename}
+        self.total_bytes += size
+        self.stats["stores"] += 1
+        while self.total_bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.stats["evictions"] += 1
+    
+    async def tee(self, key: Optional[str], body, media_type: str, filename: str):
+        """Akışı istemciye iletirken önbellek dosyasına da yaz; akış yarıda kalırsa dosya atılır"""
+        if not key or not self.enabled:
+            async for chunk in body:
+                yield chunk
+            return
+        
+        part_path = self.cache_dir / f"{key}.{uuid.uuid4().hex}.part"
+        completed = False
+        try:
+            async with await anyio.open_file(part_path, "wb") as handle:
+                async for chunk in body:
+                    await handle.write(chunk)
+                    yield chunk
+            completed = True
+        finally:
+            if completed:
+                path = self.cache_dir / key
+                part_path.replace(path)
+                self._register(key, path, media_type, filename)
+            else:
+                part_path.unlink(missing_ok=True)
     
-    emails_cursor = db.emails.find(query)
-    emails = await emails_cursor.to_list(length=None)
+    async def adopt(self, key: Optional[str], source: Path, media_type: str, filename: str):
+        """Arka plan işiyle üretilmiş dosyanın bir kopyasını önbelleğe ekle"""
+        if not key or not self.enabled:
+            return
+        path = self.cache_dir / key
+        await asyncio.to_thread(link_or_copy, source, path)
+        self._register(key, path, media_type, filename)
     
-    # Clean up emails
-    cleaned_emails = []
-    for email in emails:
-        email_dict = dict(email)
-        if "_id" in email_dict:
-            del email_dict["_id"]
-        cleaned_emails.append(email_dict)
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "total_bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            **self.stats
+        }
+
+
+def link_or_copy(source: Path, target: Path):
+    """Aynı dosya sistemindeyse hard link, değilse kopya oluştur"""
+    target.unlink(missing_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+export_cache = ExportArtifactCache(
+    EXPORT_CACHE_DIR, EXPORT_CACHE_MAX_BYTES // EXPORT_CACHE_PROCESSES, EXPORT_CACHE_ENABLED
+)
+
+
+# ============== INCREMENTAL BACKUPS ==============
+
+# Anlık görüntü özetine girmeyen, sunucu tarafında türetilen alanlar
+SNAPSHOT_VOLATILE_FIELDS = (
+    "_id", "attachment_terms", "attachments_indexed", "attachment_attempts", "attachment_error", "dedup_key",
+    "body_priority", "body_attempts", "body_lease_until", "body_lease_token"
+)
+SNAPSHOT_BATCH_SIZE = int(os.environ.get('SNAPSHOT_BATCH_SIZE', '200'))
+
+
+def snapshot_document(email: dict) -> dict:
+    return {key: value for key, value in email.items() if key not in SNAPSHOT_VOLATILE_FIELDS}
+
+
+def snapshot_hash(document: dict) -> str:
+    """E-postanın içerik özeti; alan sırasından bağımsız kanonik JSON üzerinden SHA-256"""
+    canonical = json.dumps(document, sort_keys=True, default=str, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def json_line(value: Any) -> bytes:
+    return (json.dumps(value, default=str, ensure_ascii=False) + "\n").encode('utf-8')
+
+
+async def iter_snapshot_archive(query: dict, folder: str, incremental: bool,
+                                progress: Optional[Dict[str, int]] = None):
+    """
+    Yedek anlık görüntüsünü ZIP olarak akış halinde üret.
     
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    Arşiv içeriği: snapshot.json (zincir bilgisi), emails/<id>.json ve GridFS ekleri için
+    blobs/<blob_id>, tombstones.ndjson (silinen e-postalar), manifest.ndjson (ID + özet)
+    ve summary.json. Artımlı modda yalnızca son tamamlanmış anlık görüntüden beri yeni
+    veya değişmiş e-postalar yazılır.
     
-    if format_type == "json":
-        # JSON export
-        json_data = json.dumps(cleaned_emails, indent=2, ensure_ascii=False, default=str)
-        
-        def iter_json():
-            yield json_data.encode('utf-8')
-        
-        return StreamingResponse(
-            iter_json(),
-            media_type="application/json",
-            headers={"Content-Disposition": f"attachment; filename=postadepo-emails-{folder}-{timestamp}.json"}
+    Kapsam durumu (snapshot_state) önce pending_* alanlarına yazılır ve yalnızca arşiv
+    sonuna kadar üretildiğinde kalıcı hale gelir; yarıda kesilen indirme bir sonraki
+    artımlı yedekte değişikliklerin kaybolmasına yol açmaz.
+    """
+    user_id = query["user_id"]
+    parent = None
+    if incremental:
+        parent = await db.export_snapshots.find_one(
+            {"user_id": user_id, "folder": folder, "status": "complete"},
+            {"_id": 0}, sort=[("created_at", -1)]
         )
     
-    elif format_type == "zip":
-        # ZIP export with multiple files
-        zip_buffer = io.BytesIO()
-        
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # Add summary JSON file
-            json_data = json.dumps(cleaned_emails, indent=2, ensure_ascii=False, default=str)
-            zip_file.writestr(f"emails-summary-{folder}.json", json_data.encode('utf-8'))
+    snapshot = {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "folder": folder,
+        "kind": "incremental" if parent else "full",
+        "parent_id": parent["id"] if parent else None,
+        "status": "running",
+        "created_at": datetime.now(timezone.utc),
+        "message_count": 0,
+        "changed_count": 0,
+        "removed_count": 0
+    }
+    await db.export_snapshots.insert_one(dict(snapshot))
+    snapshot_id = snapshot["id"]
+    scope = {"user_id": user_id, "folder": folder}
+    
+    writer = ZipStreamWriter()
+    yield writer.add_entry("snapshot.json", json.dumps(
+        {key: snapshot[key] for key in ("id", "parent_id", "kind", "user_id", "folder", "created_at")},
+        default=str, ensure_ascii=False, indent=2
+    ).encode('utf-8'))
+    
+    async def write_batch(batch: List[dict]):
+        hashes = {email["id"]: snapshot_hash(snapshot_document(email)) for email in batch}
+        known = {}
+        if snapshot["kind"] == "incremental":
+            async for state in db.snapshot_state.find(
+                {**scope, "email_id": {"$in": list(hashes)}}, {"_id": 0, "email_id": 1, "hash": 1}
+            ):
+                known[state["email_id"]] = state.get("hash")
+        
+        operations = []
+        manifest = []
+        unchanged = []
+        for email in batch:
+            email_hash = hashes[email["id"]]
+            snapshot["message_count"] += 1
+            if known.get(email["id"]) == email_hash:
+                unchanged.append(email["id"])
+                continue
             
-            # Add individual email files
-            for i, email in enumerate(cleaned_emails):
-                email_content = f"""From: {email.get('sender', '')}
-To: {email.get('recipient', '')}
-Subject: {email.get('subject', '')}
-Date: {email.get('date', '')}
-Size: {email.get('size', 0)} bytes
+            snapshot["changed_count"] += 1
+            manifest.append({"snapshot_id": snapshot_id, "email_id": email["id"], "hash": email_hash, "op": "upsert"})
+            operations.append(UpdateOne(
+                {**scope, "email_id": email["id"]},
+                {"$set": {"pending_hash": email_hash, "pending_snapshot": snapshot_id, "seen": snapshot_id}},
+                upsert=True
+            ))
+            
+            document = snapshot_document(email)
+            yield writer.add_entry(f"emails/{email['id']}.json", json.dumps(
+                {**document, "snapshot_hash": email_hash}, default=str, ensure_ascii=False
+            ).encode('utf-8'), email.get("date"))
+            for attachment in email.get("attachments") or []:
+                if attachment.get("blob_id"):
+                    yield writer.start_entry(
+                        f"blobs/{attachment['blob_id']}", email.get("date"),
+                        compress=not is_precompressed(attachment.get("name", ""), attachment.get("type", ""))
+                    )
+                    async for chunk in iter_attachment_bytes(attachment):
+                        yield writer.write(chunk)
+                    yield writer.end_entry()
+        
+        if unchanged:
+            await db.snapshot_state.update_many({**scope, "email_id": {"$in": unchanged}}, {"$set": {"seen": snapshot_id}})
+        if operations:
+            await db.snapshot_state.bulk_write(operations, ordered=False)
+        if manifest:
+            await db.snapshot_manifests.insert_many(manifest)
+        if progress is not None:
+            progress["messages"] += len(batch)
+    
+    # Tam yedekte bilinen durum okunmaz (her e-posta yazılır) ama silinmez de: indirme yarıda
+    # kalırsa son tamamlanmış anlık görüntünün durumu artımlı yedekler için korunmalı. Bu
+    # geçişte görülmeyen satırlar ancak arşiv tamamlandığında kaldırılır.
+    batch = []
+    cursor = db.emails.find(query, {"_id": 0}).sort("_id", 1).batch_size(SNAPSHOT_BATCH_SIZE)
+    async for email in cursor:
+        batch.append(email)
+        if len(batch) >= SNAPSHOT_BATCH_SIZE:
+            async for chunk in write_batch(batch):
+                yield chunk
+            batch = []
+    if batch:
+        async for chunk in write_batch(batch):
+            yield chunk
+    
+    # Bu geçişte görülmeyen, daha önce yedeklenmiş e-postalar silinmiştir; tam yedek
+    # zincirin başı olduğu için silme kaydı taşımaz
+    yield writer.start_entry("tombstones.ndjson")
+    tombstones = []
+    if snapshot["kind"] == "incremental":
+        async for state in db.snapshot_state.find(
+            {**scope, "seen": {"$ne": snapshot_id}, "hash": {"$ne": None}}, {"_id": 0, "email_id": 1}
+        ):
+            snapshot["removed_count"] += 1
+            tombstones.append({"snapshot_id": snapshot_id, "email_id": state["email_id"], "hash": None, "op": "delete"})
+            yield writer.write(json_line(state["email_id"]))
+            if len(tombstones) >= SNAPSHOT_BATCH_SIZE:
+                await db.snapshot_manifests.insert_many(tombstones)
+                tombstones = []
+    if tombstones:
+        await db.snapshot_manifests.insert_many(tombstones)
+    yield writer.end_entry()
+    
+    yield writer.start_entry("manifest.ndjson")
+    async for entry in db.snapshot_manifests.find({"snapshot_id": snapshot_id}, {"_id": 0, "snapshot_id": 0}):
+        yield writer.write(json_line(entry))
+    yield writer.end_entry()
+    
+    counts = {key: snapshot[key] for key in ("message_count", "changed_count", "removed_count")}
+    yield writer.add_entry("summary.json", json.dumps(counts).encode('utf-8'))
+    yield writer.finish()
+    
+    # Arşiv tamamlandı: aşamalı durumu kalıcı hale getir
+    await db.snapshot_state.delete_many({**scope, "seen": {"$ne": snapshot_id}})
+    await db.snapshot_state.update_many(
+        {**scope, "pending_snapshot": snapshot_id},
+        [{"$set": {"hash": "$pending_hash"}}]
+    )
+    await db.export_snapshots.update_one(
+        {"id": snapshot_id},
+        {"$set": {**counts, "status": "complete", "completed_at": datetime.now(timezone.utc)}}
+    )
 
-{email.get('content', '')}
-"""
-                zip_file.writestr(f"emails/email-{i+1:03d}.eml", email_content.encode('utf-8'))
-        
-        zip_buffer.seek(0)
-        
-        def iter_zip():
-            yield zip_buffer.read()
-        
-        return StreamingResponse(
-            iter_zip(),
-            media_type="application/zip",
-            headers={"Content-Disposition": f"attachment; filename=postadepo-emails-{folder}-{timestamp}.zip"}
-        )
-    
-    elif format_type == "eml":
-        # EML export (single file with all emails)
-        eml_content = f"""# PostaDepo E-posta Dışa Aktarma
-# Klasör: {folder}
-# Tarih: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-# Toplam E-posta: {len(cleaned_emails)}
 
-"""
-        
-        for i, email in enumerate(cleaned_emails):
-            eml_content += f"""
-================== E-posta #{i+1} ==================
-From: {email.get('sender', '')}
-To: {email.get('recipient', '')}
-Subject: {email.get('subject', '')}
-Date: {email.get('date', '')}
-Size: {email.get('size', 0)} bytes
-Read: {'Okundu' if email.get('read', False) else 'Okunmadı'}
-Important: {'Evet' if email.get('important', False) else 'Hayır'}
+def read_snapshot_meta(archive: zipfile.ZipFile) -> dict:
+    try:
+        return json.loads(archive.read("snapshot.json"))
+    except (KeyError, ValueError):
+        raise HTTPException(status_code=400, detail="Geçersiz yedek dosyası: snapshot.json bulunamadı")
 
-{email.get('content', '')}
 
-"""
-        
-        def iter_eml():
-            yield eml_content.encode('utf-8')
-        
-        return StreamingResponse(
-            iter_eml(),
-            media_type="message/rfc822",
-            headers={"Content-Disposition": f"attachment; filename=postadepo-emails-{folder}-{timestamp}.eml"}
-        )
+def iter_snapshot_chain(archives: List[zipfile.ZipFile]):
+    """
+    Anlık görüntü zincirini doğrula ve sırayla uygulanacak işlemleri üret:
+    ("upsert", e-posta, arşiv) veya ("delete", e-posta ID'si, arşiv).
+    Zincir tam bir anlık görüntüyle başlamalı ve her halka bir öncekinin devamı olmalıdır.
+    """
+    previous = None
+    for archive in archives:
+        meta = read_snapshot_meta(archive)
+        if previous is None and meta.get("kind") != "full":
+            raise HTTPException(status_code=400, detail="Yedek zinciri tam bir anlık görüntüyle başlamalı")
+        if previous is not None and meta.get("parent_id") != previous["id"]:
+            raise HTTPException(status_code=400, detail=f"Yedek zinciri kopuk: {meta.get('id')} bir önceki anlık görüntünün devamı değil")
+        previous = meta
+        
+        for name in archive.namelist():
+            if name.startswith("emails/") and name.endswith(".json"):
+                yield "upsert", json.loads(archive.read(name)), archive
+        if "tombstones.ndjson" in archive.namelist():
+            for line in archive.read("tombstones.ndjson").decode('utf-8').splitlines():
+                if line.strip():
+                    yield "delete", json.loads(line), archive
+
+
+async def restore_snapshot_chain(archives: List[zipfile.ZipFile], user_id: str) -> Dict[str, int]:
+    """
+    Zinciri kullanıcının posta kutusuna uygula; GridFS ekleri yeniden yüklenir. Zincir tam bir
+    anlık görüntüyle başladığı için geri yükleme birleştirme değildir: anlık görüntünün klasör
+    kapsamında olup zincir sonunda yer almayan e-postalar (ve ekleri) silinir.
+    ZIP okumaları olay döngüsünü tıkamasın diye iş parçacığında yapılır.
+    """
+    counts = {"restored": 0, "skipped": 0, "deleted": 0, "removed": 0, "blobs": 0}
+    operations, payloads = [], []
+    kept = set()
+    
+    async def flush():
+        # Sıralı yazım: aynı e-postanın güncellemesi ve silinmesi zincir sırasıyla uygulanır.
+        # Posta kutusunda başka kimlikle zaten olan bir mesaj (dedup_key çakışması) atlanır;
+        # yüklenen ekleri silinir ve mailbox'taki kopyası korunur.
+        remaining = list(zip(operations, payloads))
+        operations.clear()
+        payloads.clear()
+        while remaining:
+            try:
+                await db.emails.bulk_write([operation for operation, _ in remaining], ordered=True)
+                return
+            except BulkWriteError as e:
+                error = e.details["writeErrors"][0]
+                if error.get("code") != MONGO_DUPLICATE_KEY:
+                    raise
+                payload = remaining[error["index"]][1]
+                counts["restored"] -= 1
+                counts["skipped"] += 1
+                kept.discard(payload["id"])
+                await discard_email_blobs(payload)
+                existing = await db.emails.find_one(
+                    {"user_id": user_id, "account_id": payload.get("account_id"), "dedup_key": payload["dedup_key"]},
+                    {"_id": 0, "id": 1}
+                )
+                if existing:
+                    kept.add(existing["id"])
+                remaining = remaining[error["index"] + 1:]
+    
+    meta = await asyncio.to_thread(read_snapshot_meta, archives[0])
+    chain = iter_snapshot_chain(archives)
+    while True:
+        item = await asyncio.to_thread(next, chain, None)
+        if item is None:
+            break
+        op, payload, archive = item
+        if op == "delete":
+            operations.append(DeleteOne({"id": payload, "user_id": user_id}))
+            payloads.append(None)
+            kept.discard(payload)
+            counts["deleted"] += 1
+        else:
+            payload.pop("snapshot_hash", None)
+            payload["user_id"] = user_id
+            payload["dedup_key"] = payload.get("dedup_key") or email_dedup_key(payload)
+            for attachment in payload.get("attachments") or []:
+                if attachment.get("blob_id"):
+                    # motor akışı kendi iş parçacığı havuzunda okur
+                    blob = await asyncio.to_thread(archive.open, f"blobs/{attachment['blob_id']}")
+                    with blob:
+                        attachment["blob_id"] = await attachment_bucket.upload_from_stream(
+                            attachment.get("name") or "ek", blob
+                        )
+                    counts["blobs"] += 1
+            operations.append(ReplaceOne({"id": payload["id"], "user_id": user_id}, payload, upsert=True))
+            payloads.append(payload)
+            kept.add(payload["id"])
+            counts["restored"] += 1
+        if len(operations) >= SNAPSHOT_BATCH_SIZE:
+            await flush()
+    await flush()
+    
+    counts["removed"] = await remove_emails_outside(build_export_query(user_id, meta.get("folder") or "all"), kept)
+    await bump_mailbox_version(user_id)
+    return counts
+
+
+async def remove_emails_outside(query: dict, kept: set) -> int:
+    """Kapsamdaki, kept kümesinde olmayan e-postaları ekleri ve ek metinleriyle birlikte sil"""
+    removed = 0
+    batch = []
+    
+    async def delete(batch: List[dict]) -> int:
+        ids = [email["id"] for email in batch]
+        result = await db.emails.delete_many({"user_id": query["user_id"], "id": {"$in": ids}})
+        await db.attachment_texts.delete_many({"user_id": query["user_id"], "email_id": {"$in": ids}})
+        for email in batch:
+            await discard_email_blobs(email)
+        return result.deleted_count
+    
+    async for email in db.emails.find(query, {"_id": 0, "id": 1, "attachments.blob_id": 1}):
+        if email["id"] in kept:
+            continue
+        batch.append(email)
+        if len(batch) >= SNAPSHOT_BATCH_SIZE:
+            removed += await delete(batch)
+            batch = []
+    if batch:
+        removed += await delete(batch)
+    return removed
+
+
+@api_router.get("/backups/snapshots")
+async def list_backup_snapshots(folder: str = "all", current_user: dict = Depends(get_current_user)):
+    snapshots = await db.export_snapshots.find(
+        {"user_id": current_user["id"], "folder": folder}, {"_id": 0, "user_id": 0}
+    ).sort("created_at", -1).limit(100).to_list(length=100)
+    return {"snapshots": snapshots}
+
+
+@api_router.post("/backups/restore")
+async def restore_backup_chain(files: List[UploadFile] = File(...), current_user: dict = Depends(get_current_user)):
+    """
+    Tam yedek ve ardından gelen artımlı yedeklerden (sırayla yüklenmiş) posta kutusunu yeniden
+    oluştur; anlık görüntünün kapsamında olup zincirde olmayan e-postalar silinir
+    """
+    archives = []
+    try:
+        for upload in files:
+            archives.append(await asyncio.to_thread(zipfile.ZipFile, upload.file))
+    except zipfile.BadZipFile:
+        for archive in archives:
+            archive.close()
+        raise HTTPException(status_code=400, detail="Geçersiz yedek dosyası")
+    
+    try:
+        counts = await restore_snapshot_chain(archives, current_user["id"])
+    finally:
+        for archive in archives:
+            archive.close()
     
-    raise HTTPException(status_code=400, detail="Desteklenmeyen format")
+    return {"message": "Yedek geri yüklendi", **counts}
+
 
 @api_router.get("/connected-accounts")
 async def get_connected_accounts(current_user: dict = Depends(get_current_user)):
@@ -2624,12 +7452,12 @@ async def download_attachment(attachment_id: str, current_user: dict = Depends(g
         if not attachment:
             raise HTTPException(status_code=404, detail="Attachment not found")
         
-        # Get the attachment content (base64 decoded)
-        content = base64.b64decode(attachment.get("content", ""))
-        
-        # Create streaming response
-        def iter_content():
-            yield content
+        # Ek içeriği: GridFS blob'undan akış halinde veya inline base64
+        if attachment.get("blob_id"):
+            content_length = attachment.get("size")
+        else:
+            encoded = attachment.get("content", "")
+            content_length = len(encoded) * 3 // 4 - encoded[-2:].count("=")
         
         # Determine media type based on file extension
         media_type = attachment.get("type", "application/octet-stream")
@@ -2646,13 +7474,14 @@ async def download_attachment(attachment_id: str, current_user: dict = Depends(g
         else:
             safe_filename = f"filename={safe_filename}"
         
+        headers = {"Content-Disposition": f"attachment; {safe_filename}"}
+        if content_length is not None:
+            headers["Content-Length"] = str(content_length)
+        
         return StreamingResponse(
-            iter_content(),
+            iter_attachment_bytes(attachment),
             media_type=media_type,
-            headers={
-                "Content-Disposition": f"attachment; {safe_filename}",
-                "Content-Length": str(len(content))
-            }
+            headers=headers
         )
         
     except Exception as e:
@@ -2662,6 +7491,59 @@ async def download_attachment(attachment_id: str, current_user: dict = Depends(g
             raise HTTPException(status_code=404, detail="Attachment not found")
         raise HTTPException(status_code=500, detail="Error downloading attachment")
 
+@api_router.post("/attachments/archive")
+async def download_attachment_archive(request: AttachmentArchiveRequest, current_user: dict = Depends(get_current_user)):
+    """Thread, klasör veya filtreye uyan tüm ekleri tek bir ZIP olarak akış halinde indir"""
+    query = {"user_id": current_user["id"], "attachments.0": {"$exists": True}}
+    if request.thread_id:
+        query["thread_id"] = request.thread_id
+    if request.folder and request.folder != "all":
+        query["folder"] = request.folder
+    if request.sender:
+        query["sender"] = {"$regex": re.escape(request.sender), "$options": "i"}
+    if request.query:
+        query["subject"] = {"$regex": re.escape(request.query), "$options": "i"}
+    if request.email_ids:
+        query["id"] = {"$in": request.email_ids}
+    if request.attachment_name:
+        # Ön kontrol ek adı filtresini de kapsasın: hiçbir ek uymuyorsa boş ZIP yerine 404
+        query["attachments.name"] = {"$regex": re.escape(request.attachment_name), "$options": "i"}
+    
+    if not await db.emails.find_one(query, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Filtreye uyan ek bulunamadı")
+    
+    name_filter = (request.attachment_name or "").lower()
+    cursor = db.emails.find(query, {"_id": 0, "id": 1, "date": 1, "attachments": 1}).sort([("date", 1), ("id", 1)])
+    
+    async def iter_archive():
+        writer = ZipStreamWriter()
+        used_names = set()
+        async for email in cursor:
+            email_date = coerce_datetime(email.get("date"))
+            for attachment in email.get("attachments") or []:
+                name = attachment.get("name") or "ek"
+                if name_filter and name_filter not in name.lower():
+                    continue
+                archive_name = unique_archive_name(
+                    f"{email_date.strftime('%Y-%m-%d')}_{safe_archive_name(name)}", used_names
+                )
+                yield writer.start_entry(
+                    archive_name, email_date, compress=not is_precompressed(name, attachment.get("type"))
+                )
+                async for chunk in iter_attachment_bytes(attachment):
+                    data = writer.write(chunk)
+                    if data:
+                        yield data
+                yield writer.end_entry()
+        yield writer.finish()
+    
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return StreamingResponse(
+        iter_archive(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=postadepo-attachments-{timestamp}.zip"}
+    )
+
 @api_router.delete("/connected-accounts/{account_id}")
 async def disconnect_account(account_id: str, current_user: dict = Depends(get_current_user)):
     """Remove connected account"""
@@ -2675,6 +7557,549 @@ async def disconnect_account(account_id: str, current_user: dict = Depends(get_c
     
     return {"success": True, "message": "Account disconnected"}
 
+# ============== ATTACHMENT TEXT EXTRACTION ==============
+
+ATTACHMENT_EXTRACT_ENABLED = os.getenv('ATTACHMENT_EXTRACT_ENABLED', 'true').lower() == 'true'
+ATTACHMENT_EXTRACT_WORKERS = int(os.getenv('ATTACHMENT_EXTRACT_WORKERS', '2'))
+ATTACHMENT_EXTRACT_MAX_BYTES = int(os.getenv('ATTACHMENT_EXTRACT_MAX_BYTES', str(25 * 1024 * 1024)))
+ATTACHMENT_EXTRACT_TIMEOUT = float(os.getenv('ATTACHMENT_EXTRACT_TIMEOUT', '20'))
+ATTACHMENT_EXTRACT_POLL_INTERVAL = float(os.getenv('ATTACHMENT_EXTRACT_POLL_INTERVAL', '30'))
+ATTACHMENT_EXTRACT_MAX_ATTEMPTS = int(os.getenv('ATTACHMENT_EXTRACT_MAX_ATTEMPTS', '3'))
+ATTACHMENT_TEXT_MAX_CHARS = 1_000_000
+ATTACHMENT_SEARCH_MAX_TERMS = 2000
+
+_process_pools: Dict[str, ProcessPoolExecutor] = {}
+
+
+def get_process_pool(name: str, max_workers: int) -> ProcessPoolExecutor:
+    """İsimlendirilmiş process pool'u döndür (ilk kullanımda oluşturulur)"""
+    pool = _process_pools.get(name)
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=max_workers)
+        _process_pools[name] = pool
+    return pool
+
+
+def recycle_process_pool(name: str, pool: ProcessPoolExecutor):
+    """
+    Takılan işçiyi bırakmak için pool'u kapat ve süreçlerini sonlandır; sonraki get_process_pool
+    yenisini açar. Pool bu arada zaten yenilendiyse (eşzamanlı zaman aşımı) yeni pool'a dokunulmaz.
+    """
+    if _process_pools.get(name) is pool:
+        del _process_pools[name]
+    processes = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+
+
+def shutdown_process_pools():
+    """Tüm process pool'ları kapat"""
+    for pool in _process_pools.values():
+        pool.shutdown(wait=False, cancel_futures=True)
+    _process_pools.clear()
+
+
+async def iter_attachment_bytes(attachment: dict, chunk_size: int = 256 * 1024):
+    """Ek dosya içeriğini parça parça döndür (GridFS blob veya inline base64)"""
+    blob_id = attachment.get("blob_id")
+    if blob_id:
+        stream = await attachment_bucket.open_download_stream(blob_id)
+        while True:
+            chunk = await stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        return
+    
+    content = attachment.get("content")
+    if content:
+        data = base64.b64decode(content)
+        for offset in range(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+
+
+async def read_attachment_bytes(attachment: dict, max_bytes: Optional[int] = None) -> Optional[bytes]:
+    """Ek içeriğini belleğe oku; max_bytes aşılırsa None döndür"""
+    buffer = bytearray()
+    async for chunk in iter_attachment_bytes(attachment):
+        buffer.extend(chunk)
+        if max_bytes is not None and len(buffer) > max_bytes:
+            return None
+    return bytes(buffer)
+
+
+class ExtractionTimeout(Exception):
+    """Metin çıkarma süre sınırı aşıldı"""
+
+
+_TEXT_EXTENSIONS = ('.txt', '.csv', '.tsv', '.md', '.log', '.json', '.xml', '.html', '.htm', '.eml', '.ics', '.vcf')
+_OOXML_PARTS = {
+    "docx": re.compile(r'^word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$'),
+    "xlsx": re.compile(r'^xl/(sharedStrings|worksheets/sheet\d+)\.xml$'),
+    "pptx": re.compile(r'^ppt/slides/slide\d+\.xml$'),
+}
+_PDF_TEXT_OP_RE = re.compile(rb'\((?:\\.|[^\\)])*\)\s*(?:Tj|\'|")|\[(?:\\.|[^\]])*\]\s*TJ', re.S)
+_PDF_LITERAL_RE = re.compile(rb'\((?:\\.|[^\\)])*\)', re.S)
+_PDF_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f'}
+_HTML_TAG_RE = re.compile(r'<(script|style)[^>]*>.*?</\1>|<[^>]+>', re.S | re.I)
+_SEARCH_TERM_RE = re.compile(r'\w{3,40}')
+
+
+def _check_deadline(deadline: float):
+    if time.monotonic() > deadline:
+        raise ExtractionTimeout()
+
+
+def _looks_like_text(data: bytes) -> bool:
+    sample = data[:4096]
+    if b'\x00' in sample:
+        return False
+    try:
+        sample.decode('utf-8')
+        return True
+    except UnicodeDecodeError as e:
+        # Örnek çok baytlı bir karakterin ortasında kesilmiş olabilir
+        return e.start >= len(sample) - 3
+
+
+def _detect_attachment_kind(data: bytes, content_type: str, filename: str) -> Optional[str]:
+    """İçerik imzası, MIME tipi ve uzantıya göre çıkarıcı türünü belirle"""
+    name = filename.lower()
+    if data.startswith(b'%PDF'):
+        return "pdf"
+    if data.startswith(b'PK'):
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as zf:
+                names = set(zf.namelist())
+        except zipfile.BadZipFile:
+            return None
+        if 'word/document.xml' in names:
+            return "docx"
+        if 'xl/workbook.xml' in names:
+            return "xlsx"
+        if 'ppt/presentation.xml' in names:
+            return "pptx"
+        return None
+    if content_type.startswith('text/') or name.endswith(_TEXT_EXTENSIONS) or _looks_like_text(data):
+        return "html" if ('html' in content_type or name.endswith(('.html', '.htm'))) else "text"
+    return None
+
+
+def _decode_text_bytes(data: bytes) -> str:
+    for encoding in ('utf-8', 'cp1254'):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode('latin-1')
+
+
+def _extract_ooxml_text(data: bytes, kind: str, deadline: float, max_chars: int) -> str:
+    """DOCX/XLSX/PPTX içindeki XML parçalarından metni akış halinde topla"""
+    pieces = []
+    total = 0
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        part_names = sorted(n for n in zf.namelist() if _OOXML_PARTS[kind].match(n))
+        for part_name in part_names:
+            with zf.open(part_name) as fh:
+                for _, elem in ET.iterparse(fh, events=("end",)):
+                    tag = elem.tag.rsplit('}', 1)[-1]
+                    text = None
+                    if tag == 't' and elem.text:
+                        text = elem.text
+                    elif tag == 'c' and elem.get('t') not in ('s', 'inlineStr'):
+                        # Sayısal hücre değerleri (paylaşılan metinler sharedStrings'ten gelir)
+                        value = next((child.text for child in elem if child.tag.endswith('}v')), None)
+                        text = value
+                        elem.clear()
+                    elif tag in ('p', 'si', 'row'):
+                        pieces.append('\n')
+                        elem.clear()
+                    if text:
+                        pieces.append(text)
+                        pieces.append(' ')
+                        total += len(text) + 1
+                        if total >= max_chars:
+                            return ''.join(pieces)
+                    _check_deadline(deadline)
+    return ''.join(pieces)
+
+
+def _unescape_pdf_literal(raw: bytes) -> bytes:
+    out = bytearray()
+    i = 0
+    while i < len(raw):
+        ch = raw[i:i + 1]
+        if ch != b'\\':
+            out += ch
+            i += 1
+            continue
+        nxt = raw[i + 1:i + 2]
+        if nxt in _PDF_ESCAPES:
+            out += _PDF_ESCAPES[nxt]
+            i += 2
+        elif nxt.isdigit():
+            octal = re.match(rb'[0-7]{1,3}', raw[i + 1:i + 4]).group(0)
+            out.append(int(octal, 8) & 0xFF)
+            i += 1 + len(octal)
+        elif nxt in (b'\n', b'\r'):
+            i += 2
+        else:
+            out += nxt
+            i += 2
+    return bytes(out)
+
+
+def _extract_pdf_text(data: bytes, deadline: float, max_chars: int) -> str:
+    """PDF metni: pypdf varsa onu, yoksa içerik akışlarındaki metin operatörlerini kullan"""
+    if PYPDF_AVAILABLE:
+        reader = PdfReader(io.BytesIO(data))
+        pieces = []
+        total = 0
+        for page in reader.pages:
+            _check_deadline(deadline)
+            text = page.extract_text() or ""
+            pieces.append(text)
+            total += len(text)
+            if total >= max_chars:
+                break
+        return '\n'.join(pieces)
+    
+    pieces = []
+    total = 0
+    for match in re.finditer(rb'stream\r?\n', data):
+        _check_deadline(deadline)
+        start = match.end()
+        end = data.find(b'endstream', start)
+        if end < 0:
+            break
+        header = data[max(0, match.start() - 1024):match.start()]
+        obj_pos = header.rfind(b'obj')
+        if obj_pos >= 0:
+            header = header[obj_pos:]
+        raw = data[start:end]
+        if b'/FlateDecode' in header:
+            try:
+                raw = zlib.decompressobj().decompress(raw, max_chars * 8)
+            except zlib.error:
+                continue
+        elif b'/Filter' in header:
+            continue  # Görüntü vb. desteklenmeyen filtreler
+        if b'BT' not in raw:
+            continue
+        for op in _PDF_TEXT_OP_RE.finditer(raw):
+            for literal in _PDF_LITERAL_RE.findall(op.group(0)):
+                text = _decode_text_bytes(_unescape_pdf_literal(literal[1:-1]))
+                pieces.append(text)
+                total += len(text)
+            pieces.append(' ')
+            if total >= max_chars:
+                return ''.join(pieces)
+    return ''.join(pieces)
+
+
+def extract_attachment_text(data: bytes, content_type: str, filename: str, time_limit: float,
+                            max_chars: int = ATTACHMENT_TEXT_MAX_CHARS) -> Dict[str, Any]:
+    """Process pool içinde çalışır: ek dosyadan düz metin çıkarır"""
+    deadline = time.monotonic() + time_limit
+    kind = _detect_attachment_kind(data, (content_type or "").lower(), filename or "")
+    if kind is None:
+        return {"status": "unsupported", "text": ""}
+    
+    try:
+        if kind == "pdf":
+            text = _extract_pdf_text(data, deadline, max_chars)
+        elif kind in _OOXML_PARTS:
+            text = _extract_ooxml_text(data, kind, deadline, max_chars)
+        else:
+            text = _decode_text_bytes(data)
+            if kind == "html":
+                text = html_lib.unescape(_HTML_TAG_RE.sub(' ', text))
+    except ExtractionTimeout:
+        return {"status": "timeout", "kind": kind, "text": ""}
+    except Exception as e:
+        return {"status": "error", "kind": kind, "text": "", "error": str(e)[:200]}
+    
+    text = re.sub(r'[ \t\r\f\v]+', ' ', text).strip()
+    return {"status": "ok", "kind": kind, "text": text[:max_chars]}
+
+
+def build_search_terms(text: str, terms: Optional[set] = None, limit: int = ATTACHMENT_SEARCH_MAX_TERMS) -> set:
+    """Metni arama indeksi için küçük harfli, tekil terimlere ayır"""
+    terms = set() if terms is None else terms
+    for match in _SEARCH_TERM_RE.finditer(text.lower()):
+        if len(terms) >= limit:
+            break
+        terms.add(match.group(0))
+    return terms
+
+
+class AttachmentExtractionPipeline:
+    """
+    Ek dosya metin çıkarma hattı: bekleyen e-postaları process pool'da işler ve arama indeksine ekler.
+    İşlenirken hata veren e-postanın deneme sayısı (attachment_attempts) artar; max_attempts'e
+    ulaşan e-posta kuyruğa bir daha alınmaz. Zaman aşımına uğrayan dosyanın işçisi pool ile
+    birlikte sonlandırılır, böylece takılan ayrıştırıcı bir işçi yuvasını kalıcı olarak tutmaz.
+    """
+    
+    def __init__(self, workers: int, max_bytes: int, timeout: float, poll_interval: float, max_attempts: int):
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.queue: Optional[asyncio.Queue] = None
+        self.in_flight = 0
+        self.pending_in_db = 0
+        self.started_at: Optional[float] = None
+        self._queued: set = set()
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {
+            "emails_processed": 0,
+            "emails_failed": 0,
+            "emails_terms_truncated": 0,
+            "pool_recycles": 0,
+            "files_processed": 0,
+            "files_failed": 0,
+            "files_timed_out": 0,
+            "files_too_large": 0,
+            "files_unsupported": 0,
+            "bytes_processed": 0,
+            "chars_extracted": 0,
+            "extract_seconds": 0.0,
+        }
+    
+    def start(self):
+        if self._tasks:
+            return
+        self.queue = asyncio.Queue(maxsize=self.workers * 4)
+        self.started_at = time.monotonic()
+        self._tasks.append(asyncio.create_task(self._feeder()))
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._consumer()))
+        logger.info(f"Attachment extraction pipeline started with {self.workers} workers")
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    async def enqueue(self, email_id: str):
+        """E-postayı (zaten kuyrukta değilse) çıkarma kuyruğuna ekle"""
+        if self.queue is None or email_id in self._queued:
+            return
+        self._queued.add(email_id)
+        await self.queue.put(email_id)
+    
+    async def _feeder(self):
+        query = {
+            "attachments.0": {"$exists": True},
+            "attachments_indexed": {"$ne": True},
+            "attachment_attempts": {"$not": {"$gte": self.max_attempts}},
+        }
+        while True:
+            try:
+                self.pending_in_db = await db.emails.count_documents(query)
+                async for doc in db.emails.find(query, {"_id": 0, "id": 1}).limit(500):
+                    await self.enqueue(doc["id"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Attachment extraction feeder error: {e}")
+            await asyncio.sleep(self.poll_interval)
+    
+    async def _consumer(self):
+        while True:
+            email_id = await self.queue.get()
+            self.in_flight += 1
+            try:
+                await self.process_email(email_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Attachment extraction failed for email {email_id}: {e}")
+                self.stats["emails_failed"] += 1
+                await self._record_failure(email_id, e)
+            finally:
+                self.in_flight -= 1
+                self._queued.discard(email_id)
+                self.queue.task_done()
+    
+    async def _record_failure(self, email_id: str, error: Exception):
+        try:
+            await db.emails.update_one(
+                {"id": email_id},
+                {"$inc": {"attachment_attempts": 1}, "$set": {"attachment_error": str(error)[:500]}}
+            )
+        except Exception as e:
+            logger.error(f"Could not record attachment extraction failure for email {email_id}: {e}")
+    
+    async def _extract(self, attachment: dict) -> Dict[str, Any]:
+        data = await read_attachment_bytes(attachment, self.max_bytes)
+        if data is None:
+            return {"status": "too_large", "text": ""}
+        
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        for attempt in range(2):
+            pool = get_process_pool("attachment_extract", self.workers)
+            try:
+                result = await asyncio.wait_for(
+                    loop.run_in_executor(
+                        pool, extract_attachment_text, data,
+                        attachment.get("type", ""), attachment.get("name", ""), self.timeout
+                    ),
+                    timeout=self.timeout + 5
+                )
+                break
+            except asyncio.TimeoutError:
+                # İşçi kendi süre sınırını da aşmış, takılmış demektir; iptal süreci durdurmaz
+                recycle_process_pool("attachment_extract", pool)
+                self.stats["pool_recycles"] += 1
+                result = {"status": "timeout", "text": ""}
+                break
+            except BrokenProcessPool:
+                # Başka bir dosyanın zaman aşımı pool'u yeniledi ya da işçi çöktü; bir kez daha denenir
+                recycle_process_pool("attachment_extract", pool)
+                if attempt:
+                    raise
+        self.stats["extract_seconds"] += time.monotonic() - started
+        self.stats["bytes_processed"] += len(data)
+        return result
+    
+    async def process_email(self, email_id: str):
+        """Bir e-postanın tüm eklerini işle, metni sıkıştırarak sakla ve arama terimlerini güncelle"""
+        email = await db.emails.find_one({"id": email_id}, {"_id": 0, "id": 1, "user_id": 1, "attachments": 1})
+        if not email:
+            return
+        
+        terms = set()
+        for attachment in email.get("attachments") or []:
+            result = await self._extract(attachment)
+            status = result["status"]
+            text = result.get("text", "")
+            
+            if status == "ok":
+                self.stats["files_processed"] += 1
+                self.stats["chars_extracted"] += len(text)
+                build_search_terms(text, terms)
+            elif status == "timeout":
+                self.stats["files_timed_out"] += 1
+            elif status == "too_large":
+                self.stats["files_too_large"] += 1
+            elif status == "unsupported":
+                self.stats["files_unsupported"] += 1
+            else:
+                self.stats["files_failed"] += 1
+            
+            await db.attachment_texts.update_one(
+                {"user_id": email["user_id"], "email_id": email_id, "attachment_id": attachment.get("id")},
+                {"$set": {
+                    "name": attachment.get("name"),
+                    "status": status,
+                    "kind": result.get("kind"),
+                    "chars": len(text),
+                    "text_z": Binary(zlib.compress(text.encode('utf-8'), 6)),
+                    "extracted_at": datetime.now(timezone.utc)
+                }},
+                upsert=True
+            )
+        
+        if len(terms) >= ATTACHMENT_SEARCH_MAX_TERMS:
+            # Sınıra ulaşıldı: eklerin sonraki terimleri aramada bulunmaz
+            self.stats["emails_terms_truncated"] += 1
+        await db.emails.update_one(
+            {"id": email_id},
+            {"$set": {"attachments_indexed": True, "attachment_terms": sorted(terms)},
+             "$unset": {"attachment_attempts": "", "attachment_error": ""}}
+        )
+        self.stats["emails_processed"] += 1
+    
+    def metrics(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        files_done = self.stats["files_processed"] + self.stats["files_failed"] + self.stats["files_timed_out"]
+        return {
+            "running": bool(self._tasks),
+            "workers": self.workers,
+            "search_terms_limit": ATTACHMENT_SEARCH_MAX_TERMS,
+            "backlog": {
+                "queued": self.queue.qsize() if self.queue else 0,
+                "in_flight": self.in_flight,
+                "pending_in_db": self.pending_in_db
+            },
+            **self.stats,
+            "uptime_seconds": round(elapsed, 1),
+            "files_per_second": round(files_done / elapsed, 3) if elapsed else 0.0,
+            "bytes_per_second": round(self.stats["bytes_processed"] / elapsed, 1) if elapsed else 0.0,
+            "avg_extract_seconds": round(self.stats["extract_seconds"] / files_done, 3) if files_done else 0.0
+        }
+
+
+attachment_extraction_pipeline = AttachmentExtractionPipeline(
+    workers=ATTACHMENT_EXTRACT_WORKERS,
+    max_bytes=ATTACHMENT_EXTRACT_MAX_BYTES,
+    timeout=ATTACHMENT_EXTRACT_TIMEOUT,
+    poll_interval=ATTACHMENT_EXTRACT_POLL_INTERVAL,
+    max_attempts=ATTACHMENT_EXTRACT_MAX_ATTEMPTS
+)
+
+
+@api_router.get("/search")
+async def search_emails(
+    q: str,
+    folder: str = "all",
+    limit: int = Query(50, ge=1, le=200),
+    current_user: dict = Depends(get_current_user)
+):
+    """E-posta başlıkları ve ek dosya içeriklerinde arama"""
+    q = q.strip()
+    if not q:
+        raise HTTPException(status_code=400, detail="Arama metni gerekli")
+    
+    pattern = re.escape(q)
+    conditions = [
+        {"subject": {"$regex": pattern, "$options": "i"}},
+        {"sender": {"$regex": pattern, "$options": "i"}},
+        {"preview": {"$regex": pattern, "$options": "i"}}
+    ]
+    terms = build_search_terms(q)
+    if terms:
+        conditions.append({"attachment_terms": {"$all": sorted(terms)}})
+    
+    query = {"user_id": current_user["id"], "$or": conditions}
+    if folder != "all":
+        query["folder"] = folder
+    
+    emails = await db.emails.find(
+        query, {"_id": 0, "attachment_terms": 0}
+    ).sort("date", -1).limit(limit).to_list(length=limit)
+    
+    return {"emails": emails, "count": len(emails)}
+
+
+@api_router.get("/admin/metrics")
+async def get_pipeline_metrics(current_user: dict = Depends(get_current_user)):
+    """
+    Admin endpoint - Arka plan işlem hatlarının metriklerini döndürür
+    """
+    # Admin yetkisi kontrolü
+    if current_user.get("user_type") != "admin":
+        raise HTTPException(status_code=403, detail="Bu işlem için admin yetkisi gerekli")
+    
+    return {
+        "attachment_extraction": attachment_extraction_pipeline.metrics(),
+        "export_jobs": export_job_manager.metrics(),
+        "export_cache": export_cache.metrics(),
+        "uploads": upload_manager.metrics(),
+        "import_jobs": import_job_manager.metrics(),
+        "sync": sync_limiter.metrics(),
+        "outbound_http": outbound_http.metrics(),
+        "body_hydration": body_hydrator.metrics(),
+        "timestamp": datetime.now(timezone.utc)
+    }
+
 # ============== MICROSOFT GRAPH API INTEGRATION ==============
 
 class OutlookAuthService:
@@ -2753,7 +8178,7 @@ class OutlookEmailService:
                 orderby=["receivedDateTime desc"],
                 select=["id", "subject", "bodyPreview", "body", "from", "toRecipients", 
                        "receivedDateTime", "sentDateTime", "importance", "isRead", 
-                       "hasAttachments", "parentFolderId"]
+                       "hasAttachments", "parentFolderId", "internetMessageId"]
             )
             
             request_config = MessagesRequestBuilder.MessagesRequestBuilderGetRequestConfiguration(
@@ -2810,6 +8235,7 @@ class OutlookEmailService:
         return {
             "id": str(uuid.uuid4()),
             "message_id": message.id or str(uuid.uuid4()),
+            "internet_message_id": message.internet_message_id,
             "user_id": user_email,
             "account_id": f"outlook-{user_email}",
             "folder": folder_name.lower(),
@@ -2844,24 +8270,15 @@ class OutlookEmailService:
             if not folder_names:
                 folder_names = ["inbox", "sent", "drafts", "junk", "deleted"]
             
-            total_synced = 0
-            folder_results = {}
-            
-            # Sync each folder
-            for folder_name in folder_names:
-                try:
-                    folder_result = await self._sync_folder_with_token(
-                        access_token, account, folder_name
-                    )
-                    folder_results[folder_name] = folder_result
-                    total_synced += folder_result["synced_count"]
-                    
-                except Exception as e:
-                    logger.error(f"Error syncing folder {folder_name}: {e}")
-                    folder_results[folder_name] = {
-                        "synced_count": 0,
-                        "error": str(e)
-                    }
+            # Sync folders concurrently within the per-mailbox and global limits
+            results = await asyncio.gather(*(
+                run_limited_folder_sync(account_id, lambda folder_name=folder_name: self._sync_folder_with_token(
+                    access_token, account, folder_name
+                ))
+                for folder_name in folder_names
+            ))
+            folder_results = dict(zip(folder_names, results))
+            total_synced = sum(result["synced_count"] for result in results)
             
             # Update account sync timestamp
             await db.connected_accounts.update_one(
@@ -2881,8 +8298,14 @@ class OutlookEmailService:
             logger.error(f"Error syncing emails for account {account_id}: {e}")
             raise HTTPException(status_code=500, detail=f"Email sync failed: {str(e)}")
     
-    async def _sync_folder_with_token(self, access_token: str, account: dict, folder_name: str) -> Dict[str, Any]:
-        """Sync specific folder using access token"""
+    async def _sync_folder_with_token(self, access_token: str, account: dict, folder_name: str,
+                                      email_limit: int = 100) -> Dict[str, Any]:
+        """
+        Sync specific folder using access token. Sayfalar en yeniden eskiye @odata.nextLink ile
+        izlenir; email_limit mesaja ulaşınca ya da tamamı zaten bilinen bir sayfa gelince durulur
+        (daha eskileri önceki senkronizasyonlarda alınmıştır).
+        """
+        synced_count = 0
         try:
             # Get folder messages from Microsoft Graph API
             folder_id = await self._get_folder_id(access_token, folder_name)
@@ -2897,48 +8320,48 @@ class OutlookEmailService:
                 "Content-Type": "application/json"
             }
             
-            # Parameters for email retrieval
+            # Parameters for email retrieval; sayfa boyutu Prefer başlığıyla istenir
             params = {
-                "$top": 50,  # Batch size
                 "$orderby": "receivedDateTime desc",
-                "$select": "id,subject,bodyPreview,body,from,toRecipients,receivedDateTime,isRead,hasAttachments,parentFolderId"
+                "$select": "id,subject,bodyPreview,body,from,toRecipients,receivedDateTime,isRead,hasAttachments,parentFolderId,internetMessageId"
             }
             
-            synced_count = 0
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.get(graph_url, headers=headers, params=params)
-                
-                if response.status_code != 200:
-                    raise Exception(f"Graph API error: {response.status_code} - {response.text}")
-                
-                data = response.json()
+            processed = 0
+            async for data, fetch_seconds in iter_graph_pages(graph_url, headers, params):
                 messages = data.get("value", [])
                 
                 # Process each message
+                new_emails = []
                 for message in messages:
                     try:
-                        email_data = await self._convert_graph_message_v2(message, account, folder_name)
-                        
-                        # Check if email already exists
-                        existing = await db.emails.find_one({
-                            "message_id": email_data["message_id"],
-                            "user_id": account["user_id"]
-                        })
-                        
-                        if not existing:
-                            await db.emails.insert_one(email_data)
-                            synced_count += 1
-                            
+                        new_emails.append(await self._convert_graph_message_v2(message, account, folder_name))
                     except Exception as e:
                         logger.error(f"Error processing message {message.get('id', 'unknown')}: {e}")
                         continue
+                
+                # Sayfa başına tek $in sorgusu ve tek upsert partisi; bilinen e-postalar hiç yazılmaz
+                written = time.monotonic()
+                known = await existing_dedup_keys(
+                    account["user_id"], account["id"], (email_dedup_filter(email)["dedup_key"] for email in new_emails)
+                )
+                known |= await adopt_legacy_graph_emails(
+                    account["user_id"], account["id"], [email for email in new_emails if email["dedup_key"] not in known]
+                )
+                result = await bulk_upsert_emails([email for email in new_emails if email["dedup_key"] not in known])
+                sync_limiter.record_page(fetch_seconds, time.monotonic() - written, len(messages))
+                if result["inserted"]:
+                    synced_count += result["inserted"]
+                    await bump_mailbox_version(account["user_id"])
+                
+                processed += len(messages)
+                if processed >= email_limit or (new_emails and len(known) == len(new_emails)):
+                    break
             
             return {"synced_count": synced_count}
             
         except Exception as e:
             logger.error(f"Error syncing folder {folder_name}: {e}")
-            return {"synced_count": 0, "error": str(e)}
+            return {"synced_count": synced_count, "error": str(e)}
     
     async def _get_folder_id(self, access_token: str, folder_name: str) -> Optional[str]:
         """Get folder ID by name"""
@@ -2948,39 +8371,31 @@ class OutlookEmailService:
                 "Content-Type": "application/json"
             }
             
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    "https://graph.microsoft.com/v1.0/me/mailFolders",
-                    headers=headers
-                )
-                
-                if response.status_code != 200:
-                    return None
-                
-                data = response.json()
-                folders = data.get("value", [])
-                
-                # Look for folder by display name (case insensitive)
-                for folder in folders:
-                    if folder.get("displayName", "").lower() == folder_name.lower():
-                        return folder.get("id")
-                
-                # Also check standard folder names
-                folder_mapping = {
-                    "inbox": "inbox",
-                    "sent": "sentitems", 
-                    "drafts": "drafts",
-                    "junk": "junkemail",
-                    "deleted": "deleteditems"
-                }
-                
-                target_name = folder_mapping.get(folder_name.lower(), folder_name.lower())
-                for folder in folders:
-                    if folder.get("displayName", "").lower().replace(" ", "") == target_name:
-                        return folder.get("id")
-                
-                return None
-                
+            folders = []
+            async for data, _ in iter_graph_pages("https://graph.microsoft.com/v1.0/me/mailFolders", headers):
+                folders.extend(data.get("value", []))
+            
+            # Look for folder by display name (case insensitive)
+            for folder in folders:
+                if folder.get("displayName", "").lower() == folder_name.lower():
+                    return folder.get("id")
+            
+            # Also check standard folder names
+            folder_mapping = {
+                "inbox": "inbox",
+                "sent": "sentitems", 
+                "drafts": "drafts",
+                "junk": "junkemail",
+                "deleted": "deleteditems"
+            }
+            
+            target_name = folder_mapping.get(folder_name.lower(), folder_name.lower())
+            for folder in folders:
+                if folder.get("displayName", "").lower().replace(" ", "") == target_name:
+                    return folder.get("id")
+            
+            return None
+            
         except Exception as e:
             logger.error(f"Error getting folder ID for {folder_name}: {e}")
             return None
@@ -3024,6 +8439,7 @@ class OutlookEmailService:
         return {
             "id": str(uuid.uuid4()),
             "message_id": message.get("id", str(uuid.uuid4())),
+            "internet_message_id": message.get("internetMessageId"),
             "user_id": account["user_id"],
             "account_id": account["id"],
             "account_email": account["email"],
@@ -3050,29 +8466,13 @@ class OutlookEmailService:
         try:
             emails = await self.get_user_emails(user_email, folder_name, sync_count)
             
-            synced_count = 0
-            skipped_count = 0
-            error_count = 0
+            result = await bulk_upsert_emails(emails)
+            synced_count = result["inserted"]
+            skipped_count = result["skipped"]
+            error_count = result["failed"]
             
-            for email_data in emails:
-                try:
-                    # Check if email already exists
-                    existing = await db.emails.find_one({
-                        "message_id": email_data["message_id"],
-                        "user_id": user_email
-                    })
-                    
-                    if existing:
-                        skipped_count += 1
-                        continue
-                    
-                    # Insert new email
-                    await db.emails.insert_one(email_data)
-                    synced_count += 1
-                    
-                except Exception as e:
-                    logger.error(f"Error syncing email {email_data.get('message_id', 'unknown')}: {e}")
-                    error_count += 1
+            if synced_count:
+                await bump_mailbox_version(user_email)
             
             return {
                 "account_email": user_email,
@@ -3228,6 +8628,7 @@ async def process_oauth_callback(code: str, state: str, user_id: str = None):
                     "is_connected": True
                 }}
             )
+            await body_hydrator.reset_account(existing["id"])
             
             # Clean up used state
             await db.oauth_states.delete_one({"state": state})
@@ -3724,39 +9125,38 @@ async def exchange_code_for_tokens(authorization_code: str, state: str = None) -
         logger.info(f"Authorization Code (first 30 chars): {authorization_code[:30]}...")
         logger.info("=" * 80)
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(token_url, data=data, timeout=30.0)
+        response = await outbound_http.post(token_url, data=data, timeout=30.0)
+        
+        logger.info(f"Token exchange response status: {response.status_code}")
+        
+        if response.status_code == 200:
+            logger.info("✓ Token exchange successful")
+            return response.json()
+        else:
+            # DETAYLI HATA LOGU
+            logger.error("=" * 80)
+            logger.error("TOKEN EXCHANGE FAILED")
+            logger.error(f"Status Code: {response.status_code}")
+            logger.error(f"Response Body: {response.text}")
+            logger.error("=" * 80)
             
-            logger.info(f"Token exchange response status: {response.status_code}")
+            # Azure Portal'da kayıtlı redirect URI'leri kontrol et
+            error_json = response.json() if response.text else {}
+            error_code = error_json.get("error", "unknown")
+            error_description = error_json.get("error_description", "No description")
+            
+            logger.error(f"Error Code: {error_code}")
+            logger.error(f"Error Description: {error_description}")
+            
+            # Redirect URI hatası için özel mesaj
+            if "redirect_uri" in error_description.lower():
+                logger.error("⚠️  REDIRECT URI MISMATCH!")
+                logger.error(f"Used redirect_uri: {redirect_uri}")
+                logger.error("Please check Azure Portal -> App Registration -> Redirect URIs")
+                logger.error("Make sure this URI is registered: " + redirect_uri)
+            
+            return None
             
-            if response.status_code == 200:
-                logger.info("✓ Token exchange successful")
-                return response.json()
-            else:
-                # DETAYLI HATA LOGU
-                logger.error("=" * 80)
-                logger.error("TOKEN EXCHANGE FAILED")
-                logger.error(f"Status Code: {response.status_code}")
-                logger.error(f"Response Body: {response.text}")
-                logger.error("=" * 80)
-                
-                # Azure Portal'da kayıtlı redirect URI'leri kontrol et
-                error_json = response.json() if response.text else {}
-                error_code = error_json.get("error", "unknown")
-                error_description = error_json.get("error_description", "No description")
-                
-                logger.error(f"Error Code: {error_code}")
-                logger.error(f"Error Description: {error_description}")
-                
-                # Redirect URI hatası için özel mesaj
-                if "redirect_uri" in error_description.lower():
-                    logger.error("⚠️  REDIRECT URI MISMATCH!")
-                    logger.error(f"Used redirect_uri: {redirect_uri}")
-                    logger.error("Please check Azure Portal -> App Registration -> Redirect URIs")
-                    logger.error("Make sure this URI is registered: " + redirect_uri)
-                
-                return None
-                
     except httpx.TimeoutException:
         logger.error("Token exchange timeout after 30 seconds")
         return None
@@ -3774,15 +9174,14 @@ async def get_user_profile_from_graph(access_token: str) -> Optional[dict]:
             "Content-Type": "application/json"
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(graph_url, headers=headers)
+        response = await outbound_http.get(graph_url, headers=headers)
+        
+        if response.status_code == 200:
+            return response.json()
+        else:
+            logger.error(f"Graph API call failed: {response.status_code} - {response.text}")
+            return None
             
-            if response.status_code == 200:
-                return response.json()
-            else:
-                logger.error(f"Graph API call failed: {response.status_code} - {response.text}")
-                return None
-                
     except Exception as e:
         logger.error(f"Error getting user profile: {e}")
         return None
@@ -3800,28 +9199,28 @@ async def refresh_access_token(refresh_token: str) -> Optional[dict]:
             "scope": "https://graph.microsoft.com/Mail.Read https://graph.microsoft.com/Mail.ReadWrite https://graph.microsoft.com/User.Read offline_access"
         }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(token_url, data=data)
+        response = await outbound_http.post(token_url, data=data)
+        
+        if response.status_code == 200:
+            return response.json()
+        else:
+            logger.error(f"Token refresh failed: {response.status_code} - {response.text}")
+            return None
             
-            if response.status_code == 200:
-                return response.json()
-            else:
-                logger.error(f"Token refresh failed: {response.status_code} - {response.text}")
-                return None
-                
     except Exception as e:
         logger.error(f"Error refreshing token: {e}")
         return None
 
-async def get_valid_access_token(account_id: str) -> Optional[str]:
-    """Get valid access token for account, refresh if needed"""
+async def get_valid_access_token(account_id: str, force_refresh: bool = False) -> Optional[str]:
+    """Get valid access token for account, refresh if needed (or if Graph rejected it: force_refresh)"""
     try:
         account = await db.connected_accounts.find_one({"id": account_id, "is_connected": True})
         if not account:
             return None
         
         # Check if token is still valid (with 5 minute buffer)
-        if datetime.now(timezone.utc) < account["token_expires_at"].replace(minute=account["token_expires_at"].minute - 5):
+        expires_at = coerce_datetime(account.get("token_expires_at"))
+        if not force_refresh and datetime.now(timezone.utc) < expires_at - timedelta(minutes=5):
             return account["access_token"]
         
         # Token expired, try to refresh
@@ -3834,9 +9233,10 @@ async def get_valid_access_token(account_id: str) -> Optional[str]:
                     {"$set": {
                         "access_token": new_tokens["access_token"],
                         "refresh_token": new_tokens.get("refresh_token", account["refresh_token"]),
-                        "token_expires_at": datetime.now(timezone.utc) + timedelta(seconds=token_data.get("expires_in", 3600)),
+                        "token_expires_at": datetime.now(timezone.utc) + timedelta(seconds=new_tokens.get("expires_in", 3600)),
                     }}
                 )
+                await body_hydrator.reset_account(account_id)
                 return new_tokens["access_token"]
         
         return None
@@ -3872,6 +9272,91 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+async def ensure_indexes():
+    """Sık kullanılan sorgular için MongoDB indekslerini oluştur"""
+    try:
+        await db.emails.create_index([("user_id", 1), ("_id", 1)])
+        await db.emails.create_index([("user_id", 1), ("attachment_terms", 1)])
+        await db.emails.create_index([("attachments_indexed", 1)])
+        await db.emails.create_index(
+            [("user_id", 1), ("account_id", 1), ("dedup_key", 1)], unique=True,
+            partialFilterExpression={"dedup_key": {"$exists": True}}
+        )
+        await db.emails.create_index([("user_id", 1), ("account_id", 1), ("outlook_id", 1)])
+        await db.emails.create_index(
+            [("body_pending", 1), ("body_priority", -1), ("date", -1)],
+            partialFilterExpression={"body_pending": True}
+        )
+        await db.attachment_texts.create_index(
+            [("user_id", 1), ("email_id", 1), ("attachment_id", 1)], unique=True
+        )
+        await db.export_jobs.create_index([("user_id", 1), ("status", 1)])
+        await db.export_jobs.create_index([("node", 1), ("status", 1), ("expires_at", 1)])
+        await db.export_jobs.create_index([("status", 1), ("updated_at", 1)])
+        await db.mailbox_versions.create_index([("user_id", 1)], unique=True)
+        await db.system_logs.create_index([("timestamp", -1)])
+        await db.system_logs.create_index([("log_type", 1), ("timestamp", -1)])
+        await db.system_logs.create_index([("user_email", 1), ("timestamp", -1)])
+        await db.export_snapshots.create_index([("user_id", 1), ("folder", 1), ("status", 1), ("created_at", -1)])
+        await db.snapshot_state.create_index([("user_id", 1), ("folder", 1), ("email_id", 1)], unique=True)
+        await db.snapshot_state.create_index([("user_id", 1), ("folder", 1), ("seen", 1)])
+        await db.snapshot_manifests.create_index([("snapshot_id", 1)])
+        await db.uploads.create_index([("id", 1)], unique=True)
+        await db.uploads.create_index([("node", 1), ("status", 1), ("expires_at", 1)])
+        await db.uploads.create_index([("host", 1), ("status", 1), ("expires_at", 1)])
+        await db.import_jobs.create_index([("id", 1)], unique=True)
+        await db.import_jobs.create_index([("user_id", 1), ("status", 1)])
+        await db.import_jobs.create_index([("node", 1), ("status", 1), ("expires_at", 1)])
+        await db.import_jobs.create_index([("status", 1), ("updated_at", 1)])
+    except Exception as e:
+        logger.error(f"Failed to create indexes: {e}")
+
+dedup_backfill_task: Optional[asyncio.Task] = None
+
+
+async def run_dedup_backfill():
+    """Her worker ve pod başlarken çağrılır; geri doldurmayı yalnızca göçü kiralayan süreç yapar"""
+    try:
+        migration = await claim_migration("dedup_key_backfill")
+        if migration is None:
+            return
+        
+        async def checkpoint(last_id):
+            return await renew_migration("dedup_key_backfill", last_id=last_id)
+        
+        processed = await backfill_dedup_keys(after=migration.get("last_id"), checkpoint=checkpoint)
+        await finish_migration("dedup_key_backfill")
+        if processed:
+            logger.info(f"Dedup keys backfilled for {processed} emails")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Dedup key backfill failed: {e}")
+
+@app.on_event("startup")
+async def start_background_workers():
+    global dedup_backfill_task
+    await ensure_indexes()
+    await outbound_http.start()
+    dedup_backfill_task = asyncio.create_task(run_dedup_backfill())
+    if ATTACHMENT_EXTRACT_ENABLED:
+        attachment_extraction_pipeline.start()
+    export_cache.start()
+    await export_job_manager.start()
+    await upload_manager.start()
+    await import_job_manager.start()
+    if BODY_HYDRATE_ENABLED:
+        body_hydrator.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    if dedup_backfill_task:
+        dedup_backfill_task.cancel()
+    await attachment_extraction_pipeline.stop()
+    await export_job_manager.stop()
+    await upload_manager.stop()
+    await import_job_manager.stop()
+    await body_hydrator.stop()
+    await outbound_http.stop()
+    shutdown_process_pools()
     client.close()
\ No newline at end of file
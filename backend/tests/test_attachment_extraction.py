@@ -0,0 +1,71 @@
+"""
+Ek dosya metin çıkarma testleri
+"""
+import sys
+import os
+import io
+import zlib
+import zipfile
+
+# Add parent directory to Python path to import server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+def test_extract_docx_text():
+    """DOCX paragrafları düz metne dönüştürülür"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        zf.writestr(
+            'word/document.xml',
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            '<w:body><w:p><w:r><w:t>Fatura</w:t></w:r><w:r><w:t>numarası 2024</w:t></w:r></w:p></w:body>'
+            '</w:document>'
+        )
+    
+    result = server.extract_attachment_text(buffer.getvalue(), "", "fatura.docx", time_limit=5)
+    assert result["status"] == "ok"
+    assert result["kind"] == "docx"
+    assert "Fatura numarası 2024" in result["text"]
+
+
+def test_extract_pdf_text_without_pypdf():
+    """pypdf olmadan da FlateDecode içerik akışlarındaki metin okunur"""
+    content = zlib.compress(b'BT /F1 12 Tf (Teklif \\(revize\\)) Tj [(Anla) -20 (sma)] TJ ET')
+    pdf = (
+        b'%PDF-1.4\n1 0 obj\n<< /Length ' + str(len(content)).encode() +
+        b' /Filter /FlateDecode >>\nstream\n' + content + b'\nendstream\nendobj\n'
+    )
+    
+    result = server.extract_attachment_text(pdf, "application/pdf", "teklif.pdf", time_limit=5)
+    assert result["status"] == "ok"
+    if not server.PYPDF_AVAILABLE:
+        assert result["text"].startswith("Teklif (revize)")
+
+
+def test_binary_attachment_is_unsupported():
+    """Tanınmayan ikili içerik çıkarıcıya gönderilmez"""
+    result = server.extract_attachment_text(b'\x00\x01\x02\x03', "application/octet-stream", "a.bin", time_limit=5)
+    assert result["status"] == "unsupported"
+    assert server.build_search_terms("Fatura numarası 12 ab") == {"fatura", "numarası"}
+
+
+def test_recycled_pool_terminates_hung_worker():
+    """Zaman aşımında pool kaldırılır ve takılan işçi süreci sonlandırılır; sonraki çağrı yeni pool açar"""
+    import time
+    
+    pool = server.get_process_pool("test_recycle", 1)
+    try:
+        pool.submit(time.sleep, 60)
+        time.sleep(0.5)
+        processes = list(pool._processes.values())
+        assert processes and all(process.is_alive() for process in processes)
+        
+        server.recycle_process_pool("test_recycle", pool)
+        for process in processes:
+            process.join(5)
+        assert not any(process.is_alive() for process in processes)
+        assert server.get_process_pool("test_recycle", 1) is not pool
+    finally:
+        server.shutdown_process_pools()
@@ -0,0 +1,123 @@
+"""
+Artımlı yedek (anlık görüntü zinciri) testleri
+"""
+import sys
+import os
+import io
+import json
+import asyncio
+import zipfile
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+# Add parent directory to Python path to import server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+def _snapshot_archive(snapshot_id, parent_id, kind, emails=(), tombstones=(), blobs=()):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("snapshot.json", json.dumps({"id": snapshot_id, "parent_id": parent_id, "kind": kind}))
+        for email in emails:
+            archive.writestr(f"emails/{email['id']}.json", json.dumps(email))
+        for blob_id in blobs:
+            archive.writestr(f"blobs/{blob_id}", b"ek")
+        archive.writestr("tombstones.ndjson", "".join(json.dumps(email_id) + "\n" for email_id in tombstones))
+    buffer.seek(0)
+    return zipfile.ZipFile(buffer)
+
+
+def test_snapshot_hash_ignores_field_order_and_volatile_fields():
+    """Özet alan sırasından ve sunucu tarafı türetilmiş alanlardan etkilenmez"""
+    email = {"id": "e1", "subject": "Fatura", "read": False}
+    reordered = {"read": False, "subject": "Fatura", "id": "e1", "attachment_terms": ["fatura"], "_id": 1}
+    assert server.snapshot_hash(server.snapshot_document(email)) == server.snapshot_hash(server.snapshot_document(reordered))
+    assert server.snapshot_hash(email) != server.snapshot_hash(dict(email, read=True))
+
+
+def test_snapshot_chain_yields_operations_in_order():
+    """Zincir tam anlık görüntüden başlayıp sırayla güncelleme ve silme işlemleri üretir"""
+    chain = [
+        _snapshot_archive("s1", None, "full", emails=[{"id": "e1"}, {"id": "e2"}]),
+        _snapshot_archive("s2", "s1", "incremental", emails=[{"id": "e3"}], tombstones=["e1"]),
+    ]
+    operations = [(op, payload if op == "delete" else payload["id"]) for op, payload, _ in server.iter_snapshot_chain(chain)]
+    assert operations == [("upsert", "e1"), ("upsert", "e2"), ("upsert", "e3"), ("delete", "e1")]
+
+
+def test_snapshot_chain_rejects_broken_links():
+    """Artımlı anlık görüntüyle başlayan veya halkası kopuk zincir reddedilir"""
+    with pytest.raises(HTTPException):
+        list(server.iter_snapshot_chain([_snapshot_archive("s2", "s1", "incremental")]))
+    with pytest.raises(HTTPException):
+        list(server.iter_snapshot_chain([
+            _snapshot_archive("s1", None, "full"),
+            _snapshot_archive("s3", "s2", "incremental"),
+        ]))
+
+
+class _RestoreEmails:
+    """Tekil dedup_key çakışmasını ve kapsam taramasını taklit eden bellek içi koleksiyon"""
+
+    def __init__(self, docs):
+        self.docs = {doc["id"]: doc for doc in docs}
+
+    async def bulk_write(self, operations, ordered=True):
+        for index, operation in enumerate(operations):
+            if isinstance(operation, server.DeleteOne):
+                self.docs.pop(operation._filter["id"], None)
+                continue
+            document = operation._doc
+            if any(other["dedup_key"] == document["dedup_key"] and other_id != document["id"]
+                   for other_id, other in self.docs.items()):
+                raise server.BulkWriteError({"writeErrors": [{"index": index, "code": 11000}]})
+            self.docs[document["id"]] = document
+
+    async def find_one(self, query, projection=None):
+        return next((doc for doc in self.docs.values() if doc["dedup_key"] == query["dedup_key"]), None)
+
+    async def find(self, query, projection=None):
+        for doc in list(self.docs.values()):
+            yield doc
+
+    async def delete_many(self, query):
+        ids = [email_id for email_id in query["id"]["$in"] if email_id in self.docs]
+        for email_id in ids:
+            del self.docs[email_id]
+        return SimpleNamespace(deleted_count=len(ids))
+
+
+def test_full_restore_removes_emails_outside_chain_and_discards_skipped_blobs(monkeypatch):
+    """Zincirde olmayan e-posta silinir; çakışmada atlanan kopyanın yüklenen eki silinir, mevcut kopya kalır"""
+    existing = {"id": "x1", "user_id": "u", "dedup_key": "mid:e2"}
+    stray = {"id": "e9", "user_id": "u", "dedup_key": "mid:e9", "attachments": [{"blob_id": "old"}]}
+    emails = _RestoreEmails([existing, stray])
+    uploaded, deleted = [], []
+
+    async def upload_from_stream(name, source):
+        uploaded.append(source.read())
+        return f"new{len(uploaded)}"
+
+    async def delete(blob_id):
+        deleted.append(blob_id)
+
+    async def noop(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(server, "db", SimpleNamespace(emails=emails, attachment_texts=SimpleNamespace(delete_many=noop)))
+    monkeypatch.setattr(server, "attachment_bucket", SimpleNamespace(upload_from_stream=upload_from_stream, delete=delete))
+    monkeypatch.setattr(server, "bump_mailbox_version", noop)
+    chain = [_snapshot_archive("s1", None, "full", emails=[
+        {"id": "e1", "dedup_key": "mid:e1"},
+        {"id": "e2", "dedup_key": "mid:e2", "attachments": [{"name": "a.pdf", "blob_id": "b2"}]},
+    ], blobs=["b2"])]
+
+    counts = asyncio.run(server.restore_snapshot_chain(chain, "u"))
+
+    assert (counts["restored"], counts["skipped"], counts["removed"]) == (1, 1, 1)
+    assert sorted(emails.docs) == ["e1", "x1"]
+    assert uploaded == [b"ek"] and deleted == ["new1", "old"]
@@ -0,0 +1,367 @@
+"""
+E-posta içe aktarma (.eml, .mbox ve ZIP geri yükleme) testleri
+"""
+import sys
+import os
+import io
+import json
+import asyncio
+import tempfile
+import time
+from email.message import EmailMessage
+
+import pytest
+
+# Add parent directory to Python path to import server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+def test_parse_eml_extracts_headers_bodies_and_attachments():
+    """Başlıklar, HTML/metin gövde, Message-ID ve ekler ayrıştırılır"""
+    message = EmailMessage()
+    message["From"] = "Ayşe Yılmaz <ayse@example.com>"
+    message["To"] = "ali@example.com, veli@example.com"
+    message["Subject"] = "Toplantı notları"
+    message["Date"] = "Tue, 05 Mar 2024 10:00:00 +0300"
+    message["Message-ID"] = "<abc123@example.com>"
+    message.set_content("Merhaba, notlar ekte.")
+    message.add_alternative("<p>Merhaba, <b>notlar</b> ekte.</p>", subtype="html")
+    message.add_attachment(b"%PDF-1.4 test", maintype="application", subtype="pdf", filename="Sözleşme.pdf")
+    
+    parsed = server.parse_eml_message(message.as_bytes())
+    email = parsed["email"]
+    assert email["sender"] == "ayse@example.com (Ayşe Yılmaz)"
+    assert email["recipients"] == ["ali@example.com", "veli@example.com"]
+    assert email["subject"] == "Toplantı notları"
+    assert email["content_type"] == "html" and "<b>notlar</b>" in email["content"]
+    assert email["preview"] == "Merhaba, notlar ekte."
+    # Senkronizasyonla aynı tür: ISO metin (datetime, sıralamada tüm metin tarihlerin üstüne çıkar)
+    assert isinstance(email["date"], str) and email["date"] == "2024-03-05T07:00:00+00:00"
+    assert email["internet_message_id"] == "<abc123@example.com>"
+    assert parsed["attachments"] == [({"name": "Sözleşme.pdf", "type": "application/pdf", "size": 13}, b"%PDF-1.4 test")]
+
+
+def test_parse_eml_roundtrips_postadepo_export():
+    """PostaDepo'nun ürettiği .eml geri okunduğunda klasör ve bayraklar korunur"""
+    source = {"id": "e1", "folder": "sent", "sender": "x@example.com (X Y)", "recipient": "u@example.com",
+              "subject": "Şube raporu", "content": "satır 1\nsatır 2", "date": "2024-01-01T00:00:00+00:00",
+              "read": True, "important": True, "attachments": []}
+    
+    async def render():
+        output = b""
+        async for chunk in server.iter_email_mime(source):
+            output += chunk
+        return output
+    
+    email = server.parse_eml_message(asyncio.run(render()))["email"]
+    assert (email["folder"], email["read"], email["important"]) == ("sent", True, True)
+    assert email["subject"] == "Şube raporu"
+    assert email["content"] == "satır 1\nsatır 2\n"
+    assert email["sender"] == "x@example.com (X Y)"
+
+
+def _split_mbox(data, chunk_size):
+    async def run():
+        stream = io.BytesIO(data)
+        
+        async def read(size):
+            return stream.read(size)
+        
+        return [message async for message in server.iter_mbox_messages(read, chunk_size)]
+    return asyncio.run(run())
+
+
+def test_mbox_split_across_chunk_boundaries():
+    """'From ' ayırıcıları parça sınırlarından bağımsız bulunur, mboxrd tırnakları geri alınır"""
+    data = (b"preamble\n"
+            b"From a@example.com Mon Jan  1 00:00:00 2024\n"
+            b"Subject: bir\n\n>From here on\n>>From quoted\n\n"
+            b"From b@example.com Mon Jan  1 00:00:01 2024\n"
+            b"Subject: iki\n\nson satir")
+    for chunk_size in (7, 64, 1024 * 1024):
+        messages = _split_mbox(data, chunk_size)
+        assert messages == [b"Subject: bir\n\nFrom here on\n>From quoted\n",
+                            b"Subject: iki\n\nson satir"]
+
+
+def test_mbox_export_reimports_in_order():
+    """mbox dışa aktarımı process pool ile ayrıştırılıp aynı sırayla geri okunur"""
+    sources = [{"id": f"m{i}", "folder": "inbox", "sender": "x@example.com", "recipient": "u@example.com",
+                "subject": f"Konu {i}", "content": "From the start\nbody", "date": "2024-01-01T00:00:00+00:00",
+                "read": False, "important": False, "attachments": []} for i in range(5)]
+    
+    async def cursor():
+        for source in sources:
+            yield source
+    
+    async def run():
+        data = b"".join([chunk async for chunk in server.iter_mbox_export(cursor())])
+        stream = io.BytesIO(data)
+        
+        async def read(size):
+            return stream.read(size)
+        
+        messages = server.iter_mbox_messages(read, 100)
+        return [parsed async for parsed in server.iter_parsed_messages(messages, workers=1)]
+    
+    try:
+        parsed = asyncio.run(run())
+    finally:
+        server.shutdown_process_pools()
+    assert [item["email"]["subject"] for item in parsed] == [f"Konu {i}" for i in range(5)]
+    assert parsed[0]["email"]["content"] == "From the start\nbody\n"
+
+
+@pytest.mark.skipif(not os.environ.get("POSTADEPO_BENCH"), reason="POSTADEPO_BENCH=1 ile çalıştırın")
+def test_mbox_import_throughput_benchmark():
+    """1M mesajlık mbox bölme + ayrıştırma hızı (veritabanı yazımı hariç)"""
+    count = int(os.environ.get("POSTADEPO_BENCH_COUNT", "1000000"))
+    message = (b"From a@example.com Mon Jan  1 00:00:00 2024\n"
+               b"From: A <a@example.com>\nTo: u@example.com\nSubject: Rapor\n"
+               b"Date: Mon, 01 Jan 2024 00:00:00 +0000\n\n" + b"x" * 1024 + b"\n\n")
+    
+    async def run():
+        remaining = count
+        
+        async def read(size):
+            nonlocal remaining
+            batch = min(remaining, max(size // len(message), 1))
+            remaining -= batch
+            return message * batch
+        
+        parsed = 0
+        async for _ in server.iter_parsed_messages(server.iter_mbox_messages(read)):
+            parsed += 1
+        return parsed
+    
+    started = time.perf_counter()
+    try:
+        parsed = asyncio.run(run())
+    finally:
+        server.shutdown_process_pools()
+    elapsed = time.perf_counter() - started
+    assert parsed == count
+    print(f"\nmbox içe aktarma: {count} mesaj, {count * len(message) / 1e6:.0f} MB, "
+          f"{elapsed:.1f} sn, {count / elapsed:.0f} mesaj/sn")
+
+
+class _CollectingWriter:
+    """ImportBatchWriter yerine: veritabanına yazmadan e-postaları toplar"""
+    
+    def __init__(self):
+        self.user_id = "u"
+        self.emails = []
+    
+    async def add(self, email):
+        self.emails.append(email)
+
+
+class _Upload:
+    def __init__(self, filename, file):
+        self.filename = filename
+        self.file = file
+
+
+def test_zip_export_restores_with_summary_fields():
+    """ZIP dışa aktarımı geri yüklenir; özet JSON'daki alanlar X-PostaDepo-Id ile eşleştirilir"""
+    sources = [{"id": f"z{i}", "folder": "sent" if i % 2 else "inbox", "sender": "x@example.com",
+                "recipient": "u@example.com", "subject": f"Arşiv {i}", "content": "gövde",
+                "date": "2024-01-01T00:00:00+00:00", "read": bool(i % 2), "important": False,
+                "account_id": f"acc-{i}", "attachments": []} for i in range(7)]
+    
+    def factory():
+        async def cursor():
+            for source in sources:
+                yield source
+        return cursor()
+    
+    async def run(level):
+        data = b"".join([chunk async for chunk in server.iter_zip_export(factory, "all", level)])
+        writer = _CollectingWriter()
+        with tempfile.TemporaryFile() as handle:
+            handle.write(data)
+            handle.flush()
+            stats = await server.import_zip_archive(_Upload("yedek.zip", handle), writer)
+        return stats, writer.emails
+    
+    try:
+        for level in (0, 6):
+            stats, emails = asyncio.run(run(level))
+            assert (stats.messages, stats.errors) == (7, 0)
+            assert [email["subject"] for email in emails] == [f"Arşiv {i}" for i in range(7)]
+            assert [email["account_id"] for email in emails] == [f"acc-{i}" for i in range(7)]
+            assert [email["folder"] for email in emails] == [source["folder"] for source in sources]
+            assert [email["read"] for email in emails] == [source["read"] for source in sources]
+    finally:
+        server.shutdown_process_pools()
+
+
+def test_mbox_import_resumes_after_committed_position():
+    """Kontrol noktasından devam: yazılmış ilk mesajlar ayrıştırılmadan atlanır, sayaçlar korunur"""
+    data = b"".join(b"From x@example.com Mon Jan  1 00:00:00 2024\nSubject: Konu %d\n\ngovde\n\n" % i for i in range(10))
+    stats = server.ImportFileStats.restore("a.mbox", {"position": 6, "messages": 5, "errors": 1, "error_samples": ["eski"]})
+    writer = _CollectingWriter()
+    
+    try:
+        asyncio.run(server.import_mbox_file(server.UploadFile(file=io.BytesIO(data), filename="a.mbox"), writer, stats))
+    finally:
+        server.shutdown_process_pools()
+    assert [email["subject"] for email in writer.emails] == [f"Konu {i}" for i in range(6, 10)]
+    assert stats.snapshot() == {"position": 10, "offset": len(data), "messages": 9, "errors": 1, "error_samples": ["eski"],
+                                "summary_misses": 0}
+
+
+def test_json_array_items_are_decoded_incrementally():
+    """Özet JSON parça sınırlarından bağımsız, eleman eleman çözülür"""
+    text = json.dumps([{"id": "a", "n": 123}, {"id": "b", "s": "x]y"}], indent=2)
+    for size in (1, 5, len(text)):
+        chunks = (text[i:i + size] for i in range(0, len(text), size))
+        assert list(server.iter_json_array_items(chunks)) == [{"id": "a", "n": 123}, {"id": "b", "s": "x]y"}]
+    
+    merger = server.ZipSummaryMerger(iter([{"id": "a", "folder": "sent", "x": 1}, {"id": "b", "read": True}]))
+    assert merger.take("b") == {"read": True}
+    assert merger.take("a") == {"folder": "sent"}
+    assert merger.take("c") is None
+
+
+def test_zip_summary_miss_does_not_drain_summary(monkeypatch):
+    """Özette olmayan kimlik en fazla bekleme sınırı kadar okur; sonraki kayıtlar yine eşleşir"""
+    monkeypatch.setattr(server, "ZIP_SUMMARY_PENDING_LIMIT", 2)
+    merger = server.ZipSummaryMerger(iter([{"id": str(i), "folder": f"f{i}"} for i in range(5)]))
+    
+    assert merger.take("yok") is None
+    assert len(merger.pending) == 2
+    assert merger.take("yok2") is None
+    assert [merger.take(str(i)) for i in range(5)] == [{"folder": f"f{i}"} for i in range(5)]
+
+
+def test_upload_chunk_rejects_bad_checksum_and_offset():
+    """Sağlama toplamı tutmayan veya yanlış ofsetli parça ilerlemeyi değiştirmeden reddedilir"""
+    import hashlib
+    from fastapi import HTTPException
+    
+    async def body(data):
+        yield data
+    
+    with tempfile.TemporaryDirectory() as spool:
+        manager = server.UploadManager(server.Path(spool), 1, 1024, 16, 60)
+        upload = {"id": "up1", "host": server.HOST_ID, "node": server.NODE_ID, "size": 10, "received": 0, "status": "uploading"}
+        manager._allocate(manager.path(upload), 10)
+        
+        cases = [
+            (0, "00" * 32, b"abcd", 422),
+            (4, hashlib.sha256(b"abcd").hexdigest(), b"abcd", 409),
+            (0, hashlib.sha256(b"a" * 11).hexdigest(), b"a" * 11, 413),
+            (0, None, b"abcd", 400),
+        ]
+        for offset, checksum, data, status in cases:
+            try:
+                asyncio.run(manager.write_chunk(upload, offset, checksum, body(data)))
+            except HTTPException as e:
+                assert e.status_code == status
+            else:
+                raise AssertionError("HTTPException bekleniyordu")
+        assert upload["received"] == 0 and manager.stats["chunks_rejected"] == 1
+
+
+class _FakeUploads:
+    """Yalnızca UploadManager'ın kullandığı durum geçişlerini destekleyen bellek içi koleksiyon"""
+    
+    def __init__(self, upload):
+        self.doc = dict(upload)
+    
+    def _matches(self, query):
+        for key, value in query.items():
+            if key == "$or":
+                if not any(self._matches(option) for option in value):
+                    return False
+            elif isinstance(value, dict) and "$lte" in value:
+                if self.doc.get(key) is None or self.doc[key] > value["$lte"]:
+                    return False
+            elif self.doc.get(key) not in (value["$in"] if isinstance(value, dict) else [value]):
+                return False
+        return True
+    
+    async def find_one_and_update(self, query, update, **kwargs):
+        if not self._matches(query):
+            return None
+        before = dict(self.doc)
+        self.doc.update(update["$set"])
+        return before
+    
+    async def update_one(self, query, update):
+        if self._matches(query):
+            self.doc.update(update["$set"])
+
+
+def test_concurrent_chunks_for_same_offset_write_only_the_winner(monkeypatch):
+    """Aynı ofsete eşzamanlı iki PUT: yalnızca ofseti kiralayan parça diske yazılır ve ilerletir"""
+    import hashlib
+    from types import SimpleNamespace
+    from fastapi import HTTPException
+    
+    async def body(data):
+        await asyncio.sleep(0)
+        yield data
+    
+    async def put_both(manager, upload):
+        return await asyncio.gather(
+            *(manager.write_chunk(upload, 0, hashlib.sha256(data).hexdigest(), body(data)) for data in (b"aaaa", b"bbbb")),
+            return_exceptions=True
+        )
+    
+    with tempfile.TemporaryDirectory() as spool:
+        manager = server.UploadManager(server.Path(spool), 1, 1024, 16, 60)
+        upload = {"id": "up1", "host": server.HOST_ID, "node": server.NODE_ID, "size": 8, "received": 0,
+                  "status": "uploading"}
+        manager._allocate(manager.path(upload), 8)
+        uploads = _FakeUploads(upload)
+        monkeypatch.setattr(server, "db", SimpleNamespace(uploads=uploads))
+        
+        results = asyncio.run(put_both(manager, upload))
+        
+        rejected = [r for r in results if isinstance(r, HTTPException)]
+        assert len(rejected) == 1 and rejected[0].status_code == 409
+        winner = b"aaaa" if isinstance(results[1], HTTPException) else b"bbbb"
+        assert uploads.doc["received"] == 4 and uploads.doc["chunk_lease"] is None
+        assert manager.path(upload).read_bytes()[:4] == winner
+        assert not list(server.Path(spool).glob("*.chunk"))
+
+
+def test_upload_finalize_keeps_file_after_transient_failure(monkeypatch):
+    """Geçici hatada dosya silinmez ve yükleme 'complete'e döner; /complete yeniden denenebilir"""
+    from types import SimpleNamespace
+    from fastapi import HTTPException
+    
+    calls = []
+    
+    async def run_import(files, user_id):
+        calls.append(files[0].file.read())
+        if len(calls) == 1:
+            raise RuntimeError("connection pool paused")
+        return {"imported": 1}
+    
+    with tempfile.TemporaryDirectory() as spool:
+        manager = server.UploadManager(server.Path(spool), 1, 1024, 16, 60)
+        upload = {"id": "up1", "user_id": "u", "host": server.HOST_ID, "node": server.NODE_ID, "filename": "a.mbox",
+                  "size": 4, "received": 4, "status": "complete"}
+        manager.path(upload).write_bytes(b"data")
+        uploads = _FakeUploads(upload)
+        monkeypatch.setattr(server, "db", SimpleNamespace(uploads=uploads))
+        monkeypatch.setattr(server, "run_import", run_import)
+        
+        try:
+            asyncio.run(manager.finalize(upload))
+        except HTTPException as e:
+            assert e.status_code == 500
+        else:
+            raise AssertionError("HTTPException bekleniyordu")
+        assert manager.path(upload).exists()
+        assert uploads.doc["status"] == "complete"
+        
+        assert asyncio.run(manager.finalize(upload)) == {"imported": 1}
+        assert calls == [b"data", b"data"]
+        assert not manager.path(upload).exists() and uploads.doc["status"] == "imported"
+
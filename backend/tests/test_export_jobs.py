@@ -0,0 +1,124 @@
+"""
+Arka plan dışa aktarma işleri - Range başlığı ve dışa aktarma önbelleği testleri
+"""
+import sys
+import os
+import asyncio
+import tempfile
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+# Add parent directory to Python path to import server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+def test_parse_range_header_single_ranges():
+    """Tek aralık, açık uçlu aralık ve son N bayt biçimleri"""
+    assert server.parse_range_header("bytes=0-99", 1000) == (0, 99)
+    assert server.parse_range_header("bytes=500-", 1000) == (500, 999)
+    assert server.parse_range_header("bytes=-100", 1000) == (900, 999)
+    assert server.parse_range_header("bytes=900-5000", 1000) == (900, 999)
+
+
+def test_parse_range_header_falls_back_to_full_file():
+    """Başlık yoksa, bozuksa veya çok aralıklıysa dosyanın tamamı gönderilir"""
+    assert server.parse_range_header(None, 1000) is None
+    assert server.parse_range_header("items=0-1", 1000) is None
+    assert server.parse_range_header("bytes=0-1,5-9", 1000) is None
+    assert server.parse_range_header("bytes=abc", 1000) is None
+
+
+def test_parse_range_header_unsatisfiable():
+    """Dosya boyutunun ötesindeki aralık 416 ve Content-Range: bytes */boyut döndürür"""
+    with pytest.raises(HTTPException) as error:
+        server.parse_range_header("bytes=1000-", 1000)
+    assert error.value.status_code == 416
+    assert error.value.headers["Content-Range"] == "bytes */1000"
+
+
+def _store(cache, key, data):
+    async def body():
+        yield data
+    
+    async def run():
+        async for _ in cache.tee(key, body(), "application/mbox", f"{key}.mbox"):
+            pass
+    asyncio.run(run())
+
+
+def test_export_cache_lru_eviction():
+    """Önbellek toplam boyutu aşınca en eski kullanılan kayıt silinir"""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = server.ExportArtifactCache(Path(tmp), max_bytes=250)
+        cache.start()
+        _store(cache, "a", b"a" * 100)
+        _store(cache, "b", b"b" * 100)
+        assert cache.get("a")["path"].read_bytes() == b"a" * 100  # a en son kullanılan olur
+        _store(cache, "c", b"c" * 100)
+        
+        assert cache.get("b") is None
+        assert cache.get("a") is not None and cache.get("c") is not None
+        assert cache.total_bytes == 200
+        assert cache.metrics()["evictions"] == 1
+
+
+def test_export_cache_start_keeps_other_processes_files():
+    """Başlayan süreç yalnızca kendi alt dizinini ve bu düğümde ölmüş süreçlerin dizinlerini temizler"""
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        live = root / f"{server.HOST_ID}.{os.getppid()}"
+        other_node = root / "other-node.1"
+        dead = root / f"{server.HOST_ID}.999999999"
+        for directory in (live, other_node, dead):
+            directory.mkdir()
+            (directory / "key.part").write_bytes(b"x")
+        
+        cache = server.ExportArtifactCache(root, max_bytes=250)
+        cache.start()
+        _store(cache, "a", b"a" * 100)
+        
+        assert (live / "key.part").exists() and (other_node / "key.part").exists()
+        assert not dead.exists()
+        assert cache.get("a")["path"].parent == root / f"{server.HOST_ID}.{os.getpid()}"
+
+
+def test_export_cache_key_tracks_mailbox_version():
+    """Posta kutusu sürümü veya çıktı seçenekleri değişince anahtar değişir; anlık görüntüler önbelleğe alınmaz"""
+    key = server.ExportArtifactCache.make_key("u", "inbox", "mbox", {"compression": "gzip"}, 3)
+    assert key == server.ExportArtifactCache.make_key("u", "inbox", "mbox", {"compression": "gzip", "format": "mbox"}, 3)
+    assert key != server.ExportArtifactCache.make_key("u", "inbox", "mbox", {"compression": "gzip"}, 4)
+    assert key != server.ExportArtifactCache.make_key("u", "inbox", "mbox", {}, 3)
+    assert server.ExportArtifactCache.make_key("u", "inbox", "snapshot", {}, 3) is None
+
+
+def test_job_owner_is_a_process_not_a_host():
+    """Aynı makinedeki worker'lar ayrı sahiplerdir; yalnızca çalışmayan sürecin işi hemen devralınır"""
+    assert server.NODE_ID.startswith(f"{server.HOST_ID}:{os.getpid()}:")
+    assert not server.owner_is_gone(server.NODE_ID)
+    assert not server.owner_is_gone(f"{server.HOST_ID}:{os.getppid()}:abcd1234")
+    assert server.owner_is_gone(f"{server.HOST_ID}:999999999:abcd1234")
+    assert server.owner_is_gone(server.HOST_ID)
+    assert not server.owner_is_gone("other-host:999999999:abcd1234")
+
+
+def test_download_of_node_local_artifact_points_to_its_host(monkeypatch):
+    """Paylaşılan spool yoksa başka makinede üretilmiş dosya 404 değil 421 ve X-Export-Host ile döner"""
+    from types import SimpleNamespace
+    
+    job = {"id": "j1", "user_id": "u", "node": "other-host:1:abcd1234", "host": "other-host",
+           "status": "done", "media_type": "application/zip", "filename": "a.zip"}
+    
+    async def find_one(query, projection=None):
+        return dict(job) if query["id"] == job["id"] else None
+    
+    monkeypatch.setattr(server, "db", SimpleNamespace(export_jobs=SimpleNamespace(find_one=find_one)))
+    monkeypatch.setattr(server, "EXPORT_SPOOL_SHARED", False)
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.download_export_job("j1", None, {"id": "u"}))
+    assert error.value.status_code == 421
+    assert error.value.headers["X-Export-Host"] == "other-host"
+    assert server.export_job_view(job)["download_node_local"] is True
@@ -0,0 +1,159 @@
+"""
+Ortak tekilleştirme anahtarı ve sırasız upsert yazımı testleri
+"""
+import sys
+import os
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from pymongo.errors import BulkWriteError
+
+# Add parent directory to Python path to import server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+def test_dedup_key_prefers_message_id_and_normalizes_headers():
+    """Message-ID açılı parantezden, başlık hash'i tarih biçiminden bağımsızdır"""
+    assert server.email_dedup_key({"internet_message_id": "<a1@example.com>", "outlook_id": "AAMk1"}) == \
+        server.email_dedup_key({"internet_message_id": " a1@example.com ", "subject": "başka"})
+    assert server.email_dedup_key({"outlook_id": "AAMk1"}).startswith("graph:")
+
+    headers = {"sender": "X@Example.com", "recipient": "u@example.com", "subject": "Rapor", "content": "gövde"}
+    as_datetime = server.email_dedup_key({**headers, "date": datetime(2024, 3, 5, 10, 0, tzinfo=timezone.utc)})
+    as_text = server.email_dedup_key({**headers, "sender": "x@example.com", "date": "2024-03-05T13:00:00+03:00"})
+    assert as_datetime == as_text and as_datetime.startswith("hdr:")
+    assert as_datetime != server.email_dedup_key({**headers, "content": "farklı", "date": "2024-03-05T10:00:00Z"})
+
+
+class _FakeEmails:
+    def __init__(self, error_codes):
+        self.error_codes = error_codes
+        self.operations = None
+
+    async def bulk_write(self, operations, ordered=True):
+        assert ordered is False
+        self.operations = operations
+        errors = [{"index": index, "code": code, "errmsg": "hata"} for index, code in self.error_codes.items()]
+        upserted = [{"index": index, "_id": index} for index in range(len(operations)) if index not in self.error_codes]
+        raise BulkWriteError({"writeErrors": errors, "upserted": upserted, "nUpserted": len(upserted)})
+
+
+def test_bulk_upsert_counts_duplicate_key_errors_as_skips(monkeypatch):
+    """11000 hataları atlanmış, diğer yazım hataları başarısız sayılır"""
+    emails = _FakeEmails({1: 11000, 3: 121})
+    monkeypatch.setattr(server, "db", SimpleNamespace(emails=emails))
+    batch = [{"id": str(i), "user_id": "u", "internet_message_id": f"<m{i}@x>"} for i in range(5)]
+
+    result = asyncio.run(server.bulk_upsert_emails(batch))
+
+    assert (result["inserted"], result["skipped"], result["failed"]) == (3, 1, 1)
+    assert result["upserted"] == {0, 2, 4}
+    first = emails.operations[0]._filter
+    assert first == {"user_id": "u", "account_id": None, "dedup_key": batch[0]["dedup_key"]}
+
+
+class _MemoryCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction=1):
+        return _MemoryCursor(sorted(self.docs, key=lambda doc: doc[key], reverse=direction < 0))
+
+    def limit(self, count):
+        return _MemoryCursor(self.docs[:count])
+
+    async def to_list(self, length=None):
+        return list(self.docs)
+
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+
+
+class _MemoryEmails:
+    """Eşitlik, $in, $exists ve $gt filtreleri ile (user_id, account_id, dedup_key) tekil indeksi"""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    @staticmethod
+    def _match(doc, query):
+        for key, condition in query.items():
+            if isinstance(condition, dict):
+                if "$in" in condition and doc.get(key) not in condition["$in"]:
+                    return False
+                if "$exists" in condition and (key in doc) != condition["$exists"]:
+                    return False
+                if "$gt" in condition and not (key in doc and doc[key] > condition["$gt"]):
+                    return False
+            elif doc.get(key) != condition:
+                return False
+        return True
+
+    def find(self, query, projection=None):
+        return _MemoryCursor([doc for doc in self.docs if self._match(doc, query)])
+
+    def _check_unique(self, doc):
+        index = ("user_id", "account_id", "dedup_key")
+        if "dedup_key" in doc and any(other is not doc and all(other.get(f) == doc.get(f) for f in index)
+                                      for other in self.docs):
+            raise BulkWriteError({"writeErrors": [{"index": 0, "code": 11000}]})
+
+    async def bulk_write(self, operations, ordered=True):
+        upserted, modified = [], 0
+        for index, operation in enumerate(operations):
+            matches = [doc for doc in self.docs if self._match(doc, operation._filter)]
+            if matches:
+                matches[0].update(operation._doc.get("$set", {}))
+                self._check_unique(matches[0])
+                modified += 1
+            elif operation._upsert:
+                doc = {**operation._filter, **operation._doc.get("$setOnInsert", {}), **operation._doc.get("$set", {})}
+                self.docs.append(doc)
+                self._check_unique(doc)
+                upserted.append({"index": index, "_id": index})
+        return SimpleNamespace(bulk_api_result={"upserted": upserted, "nModified": modified, "nRemoved": 0})
+
+
+def test_resynced_graph_message_adopts_backfilled_legacy_row(monkeypatch):
+    """Message-ID'siz saklanmış eski kayıt geri doldurmadan sonra yeniden senkronizasyonda tek satır kalır"""
+    legacy = {"_id": 1, "id": "old", "user_id": "u", "account_id": "a1", "outlook_id": "AAMk1",
+              "subject": "Rapor", "read": False, "folder": "inbox"}
+    emails = _MemoryEmails([legacy])
+    monkeypatch.setattr(server, "db", SimpleNamespace(emails=emails))
+
+    async def run():
+        await server.backfill_dedup_keys()
+        assert legacy["dedup_key"].startswith("graph:")
+        return await server.apply_outlook_delta(
+            [{"id": "AAMk1", "internetMessageId": "<r1@example.com>", "subject": "Rapor", "isRead": True}],
+            {"id": "a1"}, {"id": "u", "email": "u@example.com"}, "inbox"
+        )
+
+    result = asyncio.run(run())
+    assert result["inserted"] == 0 and len(emails.docs) == 1
+    assert legacy["dedup_key"].startswith("mid:") and legacy["read"] is True
+    assert legacy["internet_message_id"] == "<r1@example.com>"
+
+
+def test_backfill_pages_by_id_and_resumes_from_checkpoint(monkeypatch):
+    """Geri doldurma _id sırasıyla bir kez tarar; kira kaybedilince durur, kalan yerden devam edilir"""
+    docs = [{"_id": i, "id": str(i), "user_id": "u", "account_id": None, "internet_message_id": f"<m{i}@x>"}
+            for i in (5, 1, 4, 2, 3)]
+    emails = _MemoryEmails(docs)
+    monkeypatch.setattr(server, "db", SimpleNamespace(emails=emails))
+    checkpoints = []
+
+    async def lose_after_first_batch(last_id):
+        checkpoints.append(last_id)
+        return False
+
+    assert asyncio.run(server.backfill_dedup_keys(batch_size=2, checkpoint=lose_after_first_batch)) == 2
+    assert checkpoints == [2]
+    assert sorted(doc["_id"] for doc in docs if "dedup_key" in doc) == [1, 2]
+
+    assert asyncio.run(server.backfill_dedup_keys(batch_size=2, after=checkpoints[-1])) == 3
+    assert all(doc["dedup_key"] == server.email_dedup_key(doc) for doc in docs)
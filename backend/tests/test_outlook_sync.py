@@ -0,0 +1,301 @@
+"""
+Outlook senkronizasyon testleri (Graph çağrıları olmadan)
+"""
+import sys
+import os
+import asyncio
+import json
+from collections import Counter
+from types import SimpleNamespace
+
+# Add parent directory to Python path to import server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+def test_sync_limiter_bounds_global_and_per_mailbox_concurrency():
+    """Klasörler eşzamanlı çalışır; genel ve posta kutusu başına sınır aşılmaz"""
+    limiter = server.SyncLimiter(max_total=4, per_mailbox=2)
+    running, peak = Counter(), Counter()
+
+    async def folder(mailbox, name):
+        async with limiter.slot(mailbox):
+            running[mailbox] += 1
+            running["total"] += 1
+            peak[mailbox] = max(peak[mailbox], running[mailbox])
+            peak["total"] = max(peak["total"], running["total"])
+            await asyncio.sleep(0.02)
+            running[mailbox] -= 1
+            running["total"] -= 1
+
+    async def run():
+        return await asyncio.gather(*(
+            folder(mailbox, name) for mailbox in ("a", "b", "c") for name in ("inbox", "sent", "drafts", "junk")
+        ))
+
+    asyncio.run(run())
+    assert peak["total"] == 4 and max(peak[mailbox] for mailbox in "abc") == 2
+    assert limiter.metrics()["active"] == 0 and limiter.metrics()["waiting"] == 0
+    assert limiter.metrics()["mailboxes"] == 0
+
+
+def test_outbound_http_client_is_shared_and_counts_requests():
+    """Tüm çağrılar tek istemciden geçer; istek, hata ve durum sınıfları sayılır"""
+    import httpx
+
+    def handler(request):
+        if request.url.path == "/down":
+            raise httpx.ConnectError("bağlantı reddedildi", request=request)
+        return httpx.Response(200 if request.url.path == "/me" else 404, json={"ok": True})
+
+    outbound = server.OutboundHTTP(
+        http2=True, limits=httpx.Limits(max_connections=4), timeout=httpx.Timeout(5.0),
+        transport=httpx.MockTransport(handler)
+    )
+
+    async def run():
+        first = outbound.client
+        assert (await outbound.get("https://graph.example/me")).json() == {"ok": True}
+        await outbound.post("https://graph.example/missing", data={"a": "b"})
+        try:
+            await outbound.get("https://graph.example/down")
+        except httpx.ConnectError:
+            pass
+        assert outbound.client is first
+        await outbound.stop()
+
+    asyncio.run(run())
+    metrics = outbound.metrics()
+    assert (metrics["requests"], metrics["failures"], metrics["in_flight"]) == (3, 1, 0)
+    assert metrics["status_classes"] == {"2xx": 1, "4xx": 1}
+    assert metrics["http2"] == server.H2_AVAILABLE
+
+
+class _FakeCollection:
+    def __init__(self):
+        self.writes = []
+        self.updates = []
+        self.keys = set()
+
+    async def find(self, query, projection):
+        for key in query.get("dedup_key", {}).get("$in", []):
+            if key in self.keys:
+                yield {"dedup_key": key}
+
+    async def bulk_write(self, operations, ordered=True):
+        self.writes.append(operations)
+        self.keys.update(operation._filter.get("dedup_key") for operation in operations if getattr(operation, "_upsert", False))
+        removed = sum(1 for operation in operations if isinstance(operation, server.DeleteOne))
+        upserted = [{"index": index, "_id": index} for index, operation in enumerate(operations)
+                    if isinstance(operation, server.UpdateOne)]
+        return SimpleNamespace(bulk_api_result={"upserted": upserted, "nModified": 0, "nRemoved": removed})
+
+    async def update_one(self, query, update):
+        self.updates.append((query, update))
+
+
+def test_delta_sync_persists_links_and_applies_changes_in_one_write(monkeypatch):
+    """İlk tur nextLink ile sayfalanır; sonraki tur tek istekle ekleme, güncelleme ve silmeyi uygular"""
+    import httpx
+
+    pages = {
+        "/v1.0/me/mailFolders/F1/messages/delta": {
+            "value": [{"id": "m1", "internetMessageId": "<1@x>", "subject": "bir"}],
+            "@odata.nextLink": "https://graph.microsoft.com/v1.0/next?page=2",
+        },
+        "/v1.0/next": {
+            "value": [{"id": "m2", "internetMessageId": "<2@x>", "subject": "iki"}],
+            "@odata.deltaLink": "https://graph.microsoft.com/v1.0/delta?token=a",
+        },
+        "/v1.0/delta": {
+            "value": [{"id": "m1", "internetMessageId": "<1@x>", "isRead": True}, {"id": "m2", "@removed": {"reason": "deleted"}}],
+            "@odata.deltaLink": "https://graph.microsoft.com/v1.0/delta?token=b",
+        },
+    }
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json=pages[request.url.path])
+
+    async def folder_id(headers, folder_name):
+        return "F1"
+
+    async def bump(user_id):
+        return None
+
+    db = SimpleNamespace(emails=_FakeCollection(), connected_accounts=_FakeCollection())
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "get_outlook_folder_id", folder_id)
+    monkeypatch.setattr(server, "bump_mailbox_version", bump)
+    monkeypatch.setattr(server, "outbound_http", server.OutboundHTTP(
+        http2=False, limits=httpx.Limits(), timeout=httpx.Timeout(5.0), transport=httpx.MockTransport(handler)
+    ))
+    account = {"id": "a1", "email": "a@x.com", "access_token": "t"}
+    user = {"id": "u", "email": "u@x.com"}
+
+    first = asyncio.run(server.sync_folder_emails(account, user, "inbox", "inbox"))
+    assert first["synced_count"] == 2 and first["error"] is None
+    assert requests[0].headers["Prefer"] == f"odata.maxpagesize={server.GRAPH_PAGE_SIZE}"
+    assert requests[0].url.params["$orderby"] == "receivedDateTime desc"
+    assert db.connected_accounts.updates[-1][1] == {"$set": {"sync_tokens.inbox": "https://graph.microsoft.com/v1.0/delta?token=a"}}
+
+    account["sync_tokens"] = {"inbox": "https://graph.microsoft.com/v1.0/delta?token=a"}
+    second = asyncio.run(server.sync_folder_emails(account, user, "inbox", "inbox"))
+    assert len(requests) == 3 and second["removed_count"] == 1
+    update, delete = db.emails.writes[-1]
+    # Bilinen mesaj için yalnızca değişebilen alanlar gönderilir
+    assert update._doc == {"$set": {"outlook_id": "m1", "folder": "inbox", "read": True, "important": False}}
+    assert not update._upsert
+    assert delete._filter == {"user_id": "u", "account_id": "a1", "outlook_id": "m2"}
+    assert db.connected_accounts.updates[-1][1]["$set"]["sync_tokens.inbox"].endswith("token=b")
+    assert server.sync_limiter.metrics()["pages"] >= 3
+
+
+def test_delta_link_is_not_advanced_past_a_failed_write(monkeypatch):
+    """Sayfada yazım hatası varsa bağlantı kaydedilmez; Graph o değişiklikleri bir daha göndermez"""
+    import httpx
+
+    class _FailingEmails(_FakeCollection):
+        async def bulk_write(self, operations, ordered=True):
+            raise server.BulkWriteError({"writeErrors": [{"index": 0, "code": 121, "errmsg": "doğrulama"}]})
+
+    def handler(request):
+        return httpx.Response(200, json={
+            "value": [{"id": "m1", "internetMessageId": "<1@x>"}],
+            "@odata.deltaLink": "https://graph.microsoft.com/v1.0/delta?token=a",
+        })
+
+    async def bump(user_id):
+        return None
+
+    db = SimpleNamespace(emails=_FailingEmails(), connected_accounts=_FakeCollection())
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "bump_mailbox_version", bump)
+    monkeypatch.setattr(server, "outbound_http", server.OutboundHTTP(
+        http2=False, limits=httpx.Limits(), timeout=httpx.Timeout(5.0), transport=httpx.MockTransport(handler)
+    ))
+    account = {"id": "a1", "email": "a@x.com", "access_token": "t",
+               "sync_tokens": {"inbox": "https://graph.microsoft.com/v1.0/delta?token=0"}}
+
+    result = asyncio.run(server.sync_folder_emails(account, {"id": "u", "email": "u@x.com"}, "inbox", "inbox"))
+    assert result["error"] and db.connected_accounts.updates == []
+
+
+def test_graph_pages_follow_next_link_without_skip(monkeypatch):
+    """Sorgu parametreleri yalnızca ilk istekte gider; sonrası nextLink, hata GraphAPIError olur"""
+    import httpx
+    seen = []
+
+    def handler(request):
+        seen.append(request)
+        if request.url.path == "/v1.0/gone":
+            return httpx.Response(410, json={"error": {"code": "SyncStateNotFound"}})
+        page = int(request.url.params.get("page", "1"))
+        body = {"value": [page]}
+        if page < 3:
+            body["@odata.nextLink"] = f"https://graph.microsoft.com/v1.0/items?page={page + 1}"
+        return httpx.Response(200, json=body)
+
+    outbound = server.OutboundHTTP(
+        http2=False, limits=httpx.Limits(), timeout=httpx.Timeout(5.0), transport=httpx.MockTransport(handler)
+    )
+    monkeypatch.setattr(server, "outbound_http", outbound)
+
+    async def run():
+        pages = [page async for page, _ in server.iter_graph_pages(
+            "https://graph.microsoft.com/v1.0/items", {"Authorization": "Bearer t"}, {"$orderby": "x"}, page_size=2
+        )]
+        try:
+            async for _ in server.iter_graph_pages("https://graph.microsoft.com/v1.0/gone", {}):
+                pass
+        except server.GraphAPIError as e:
+            return pages, e.status_code
+
+    pages, status = asyncio.run(run())
+    assert [page["value"] for page in pages] == [[1], [2], [3]] and status == 410
+    assert outbound.metrics()["requests"] == 4
+    assert seen[0].url.params["$orderby"] == "x" and "$orderby" not in seen[1].url.params
+    assert all(request.headers["Prefer"] == "odata.maxpagesize=2" for request in seen[:3])
+
+
+def test_body_hydration_batch_fills_bodies_and_counts_failures(monkeypatch):
+    """Tek $batch isteği: gelen gövde yazılır, silinmiş mesaj çıkar, yalnızca kalıcı hata deneme sayar"""
+    import httpx
+
+    def handler(request):
+        assert request.url.path == "/v1.0/$batch"
+        statuses = {"m1": 200, "m2": 404, "m3": 503, "m4": 400}
+        responses = []
+        for item in json.loads(request.content)["requests"]:
+            status = statuses[item["url"].split("/")[3].split("?")[0]]
+            body = {"body": {"contentType": "HTML", "content": "<p>tam</p>"}} if status == 200 else {}
+            headers = {"Retry-After": "30"} if status == 503 else {}
+            responses.append({"id": item["id"], "status": status, "headers": headers, "body": body})
+        return httpx.Response(200, json={"responses": responses})
+
+    async def bump(user_id):
+        bumped.append(user_id)
+
+    bumped = []
+    db = SimpleNamespace(emails=_FakeCollection())
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "bump_mailbox_version", bump)
+    monkeypatch.setattr(server, "outbound_http", server.OutboundHTTP(
+        http2=False, limits=httpx.Limits(), timeout=httpx.Timeout(5.0), transport=httpx.MockTransport(handler)
+    ))
+    hydrator = server.BodyHydrator(batch_size=20, interval=1, lease_seconds=60, max_attempts=3)
+    docs = [{"id": f"e{i}", "user_id": "u", "outlook_id": f"m{i}"} for i in (1, 2, 3, 4)]
+
+    async def run():
+        bodies, failed, retry_after = await server.fetch_message_bodies("t", [doc["outlook_id"] for doc in docs])
+        await hydrator.apply(docs, bodies, failed, retry_after)
+        return bodies, failed, retry_after
+
+    bodies, failed, retry_after = asyncio.run(run())
+    assert bodies == {"m1": {"contentType": "HTML", "content": "<p>tam</p>"}, "m2": None}
+    assert (failed, retry_after) == (["m4"], 30.0)
+    filled, gone, deferred, counted = db.emails.writes[-1]
+    assert filled._doc["$set"] == {"content": "<p>tam</p>", "content_type": "html", "size": 10}
+    assert "body_pending" in gone._doc["$unset"] and "$set" not in gone._doc
+    assert set(deferred._doc["$set"]) == {"body_lease_until"} and "$inc" not in deferred._doc
+    assert counted._doc == {"$inc": {"body_attempts": 1}}
+    assert bumped == ["u"]
+    assert (hydrator.stats["hydrated"], hydrator.stats["gone"], hydrator.stats["deferred"], hydrator.stats["failed"]) == (1, 1, 1, 1)
+
+
+def test_body_hydration_refreshes_rejected_token_once_then_parks_account(monkeypatch):
+    """401 geçici sayılmaz: jeton bir kez zorla yenilenir, yine reddedilirse hesap park edilir"""
+    import httpx
+
+    def handler(request):
+        if request.headers["Authorization"] != "Bearer fresh":
+            return httpx.Response(401, json={"error": {"code": "InvalidAuthenticationToken"}})
+        return httpx.Response(200, json={"responses": [
+            {"id": "0", "status": 200, "body": {"body": {"contentType": "text", "content": "tam"}}}
+        ]})
+
+    async def get_valid_access_token(account_id, force_refresh=False):
+        refreshes.append(force_refresh)
+        return tokens[force_refresh]
+
+    refreshes = []
+    accounts = _FakeCollection()
+    monkeypatch.setattr(server, "db", SimpleNamespace(connected_accounts=accounts))
+    monkeypatch.setattr(server, "get_valid_access_token", get_valid_access_token)
+    monkeypatch.setattr(server, "outbound_http", server.OutboundHTTP(
+        http2=False, limits=httpx.Limits(), timeout=httpx.Timeout(5.0), transport=httpx.MockTransport(handler)
+    ))
+    hydrator = server.BodyHydrator(batch_size=20, interval=1, lease_seconds=60, max_attempts=3)
+    assert not server.graph_error_is_transient(401)
+
+    tokens = {False: "expired", True: "fresh"}
+    bodies, failed, _ = asyncio.run(hydrator._fetch("a1", ["m1"]))
+    assert bodies == {"m1": {"contentType": "text", "content": "tam"}} and failed == []
+    assert refreshes == [False, True] and accounts.updates == []
+
+    tokens = {False: "expired", True: "revoked"}
+    assert asyncio.run(hydrator._fetch("a1", ["m1"])) is None
+    assert accounts.updates == [({"id": "a1"}, {"$set": {"body_hydration_parked": True}})]
+    assert hydrator.stats["accounts_parked"] == 1
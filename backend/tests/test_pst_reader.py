@@ -0,0 +1,263 @@
+"""
+PST/OST okuyucu testleri: küçük bir Unicode PST dosyası burada üretilip geri okunur
+"""
+import sys
+import os
+import struct
+import tempfile
+from datetime import datetime, timezone
+
+# Add parent directory to Python path to import server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+ROOT = server.PST_NID_ROOT_FOLDER
+INBOX = (0x401 << 5) | 0x02
+SENT = (0x402 << 5) | 0x02
+CALENDAR = (0x403 << 5) | 0x02
+MESSAGE = (0x10000 << 5) | 0x04
+ATTACHMENT = (0x1 << 5) | 0x05
+ATTACHMENT_DATA = (0x1 << 5) | 0x1F
+
+
+def _table_nid(folder_nid, nid_type):
+    return (folder_nid & ~0x1F) | nid_type
+
+
+def _utf16(text):
+    return text.encode("utf-16-le")
+
+
+def _entry_id(nid):
+    return b"\x00" * 20 + struct.pack("<I", nid)
+
+
+def _filetime(value):
+    delta = value - datetime(1601, 1, 1, tzinfo=timezone.utc)
+    return struct.pack("<Q", (delta.days * 86400 + delta.seconds) * 10 ** 7)
+
+
+def _heap(client_signature, allocations):
+    """Tek bloklu HN: allocations[0] kullanıcı köküdür (HID 0x20)"""
+    body = bytearray(12)
+    offsets = []
+    for allocation in allocations:
+        offsets.append(len(body))
+        body += allocation
+    offsets.append(len(body))
+    page_map = len(body)
+    body += struct.pack("<HH", len(allocations), 0) + b"".join(struct.pack("<H", o) for o in offsets)
+    struct.pack_into("<HBBI", body, 0, page_map, 0xEC, client_signature, 0x20)
+    return bytes(body)
+
+
+def _property_context(props):
+    """props: (id, tip, değer); değer int (satır içi), bytes (heap) ya da ("subnode", nid)"""
+    records, values = b"", []
+    for prop_id, ptype, value in sorted(props):
+        if isinstance(value, int):
+            reference = value
+        elif isinstance(value, tuple):
+            reference = value[1]
+        else:
+            values.append(value)
+            reference = (len(values) + 2) << 5
+        records += struct.pack("<HHI", prop_id, ptype, reference)
+    header = struct.pack("<BBBBI", 0xB5, 2, 6, 0, 0x40)
+    return _heap(0xBC, [header, records] + values)
+
+
+def _table_context(columns, rows):
+    """Yalnızca 4 baytlık sütunlar; ilk sütun PidTagLtpRowId. Metinler heap'e yazılır"""
+    columns = [(0x67F2, 0x0003)] + columns
+    row_size = 4 * len(columns) + (len(columns) + 7) // 8
+    values, matrix = [], b""
+    for row in rows:
+        cells, ceb = b"", bytearray((len(columns) + 7) // 8)
+        for index, (prop_id, ptype) in enumerate(columns):
+            value = row.get(prop_id)
+            if value is None:
+                cells += b"\x00" * 4
+                continue
+            ceb[index // 8] |= 0x80 >> (index % 8)
+            if isinstance(value, bytes):
+                values.append(value)
+                value = (len(values) + 3) << 5
+            cells += struct.pack("<I", value)
+        matrix += cells + bytes(ceb)
+    ends = (4 * len(columns),) * 3 + (row_size,)
+    info = struct.pack("<BB4HIII", 0x7C, len(columns), *ends, 0x40, 0x60 if rows else 0, 0)
+    for index, (prop_id, ptype) in enumerate(columns):
+        info += struct.pack("<IHBB", (prop_id << 16) | ptype, index * 4, 4, index)
+    row_index = struct.pack("<BBBBI", 0xB5, 4, 4, 0, 0)
+    return _heap(0x7C, [info, row_index, matrix] + values)
+
+
+class _PSTBuilder:
+    """NBT/BBT sayfaları ve şifrelenmiş (NDB_CRYPT_PERMUTE) veri bloklarıyla Unicode PST üretir"""
+
+    def __init__(self):
+        self.blocks = {}
+        self.nodes = {}
+        self.next_bid = 4
+
+    def block(self, data, internal=False):
+        bid = self.next_bid | (0x02 if internal else 0)
+        self.next_bid += 4
+        self.blocks[bid] = data if internal else data.translate(server._PST_CRYPT_R)
+        return bid
+
+    def subnodes(self, entries):
+        body = struct.pack("<BBHI", 0x02, 0, len(entries), 0)
+        for nid, bid_data, bid_sub in sorted(entries):
+            body += struct.pack("<QQQ", nid, bid_data, bid_sub)
+        return self.block(body, internal=True)
+
+    def node(self, nid, data, sub=0):
+        self.nodes[nid] = (self.block(data), sub)
+
+    def _page(self, entries, entry_size, level, ptype):
+        page = bytearray(512)
+        for index, entry in enumerate(entries):
+            page[index * entry_size:(index + 1) * entry_size] = entry
+        struct.pack_into("<BBBB", page, 488, len(entries), 488 // entry_size, entry_size, level)
+        struct.pack_into("<BB", page, 496, ptype, ptype)
+        return bytes(page)
+
+    def build(self):
+        output = bytearray(4096)
+        locations = {}
+        for bid, data in sorted(self.blocks.items()):
+            locations[bid] = (len(output), len(data))
+            output += data + b"\x00" * (-len(data) % 64 + 16)
+
+        def append_page(page):
+            offset = len(output)
+            output.extend(page)
+            return offset
+
+        # BBT: iki yaprak + bir ara sayfa (B-ağacı inişini sınamak için)
+        leaves = [struct.pack("<QQHHI", bid, ib, size, 1, 0) for bid, (ib, size) in sorted(locations.items())]
+        half = len(leaves) // 2
+        children = []
+        for part in (leaves[:half], leaves[half:]):
+            offset = append_page(self._page(part, 24, 0, 0x80))
+            children.append(struct.pack("<QQQ", struct.unpack_from("<Q", part[0])[0], 0, offset))
+        bbt_root = append_page(self._page(children, 24, 1, 0x80))
+        nbt_entries = [struct.pack("<QQQII", nid, bid, sub, 0, 0) for nid, (bid, sub) in sorted(self.nodes.items())]
+        nbt_root = append_page(self._page(nbt_entries, 32, 0, 0x81))
+
+        output[0:4] = b"!BDN"
+        output[8:10] = b"SM"
+        struct.pack_into("<H", output, 10, 23)
+        struct.pack_into("<Q", output, 224, nbt_root)
+        struct.pack_into("<Q", output, 240, bbt_root)
+        output[513] = server.PST_CRYPT_PERMUTE
+        return bytes(output)
+
+
+def _sample_pst():
+    builder = _PSTBuilder()
+    builder.node(server.PST_NID_MESSAGE_STORE, _property_context([
+        (0x35E0, 0x0102, _entry_id(ROOT)),
+        (0x35E4, 0x0102, _entry_id(SENT)),
+    ]))
+    builder.node(ROOT, _property_context([(0x3001, 0x001F, _utf16("Kişisel Klasörler"))]))
+    builder.node(_table_nid(ROOT, 0x0D), _table_context([], [{0x67F2: INBOX}, {0x67F2: SENT}, {0x67F2: CALENDAR}]))
+    builder.node(INBOX, _property_context([(0x3001, 0x001F, _utf16("Gelen Kutusu"))]))
+    builder.node(_table_nid(INBOX, 0x0E), _table_context([], [{0x67F2: MESSAGE}]))
+    builder.node(SENT, _property_context([(0x3001, 0x001F, _utf16("Giden"))]))
+    builder.node(CALENDAR, _property_context([
+        (0x3001, 0x001F, _utf16("Takvim")),
+        (0x3613, 0x001F, _utf16("IPF.Appointment")),
+    ]))
+    builder.node(_table_nid(CALENDAR, 0x0E), _table_context([], [{0x67F2: MESSAGE}]))
+
+    # İki veri bloğuna bölünmüş ek içeriği (XBLOCK) ek düğümünün alt düğümünde durur
+    payload = bytes(range(256)) * 40
+    parts = [builder.block(payload[:6000]), builder.block(payload[6000:])]
+    xblock = builder.block(struct.pack("<BBHI", 0x01, 1, 2, len(payload)) + struct.pack("<2Q", *parts), internal=True)
+    attachment_sub = builder.subnodes([(ATTACHMENT_DATA, xblock, 0)])
+    attachment = builder.block(_property_context([
+        (0x3705, 0x0003, 1),
+        (0x3707, 0x001F, _utf16("Rapor.pdf")),
+        (0x370E, 0x001F, _utf16("application/pdf")),
+        (0x3701, 0x0102, ("subnode", ATTACHMENT_DATA)),
+    ]))
+    recipients = builder.block(_table_context([(0x0C15, 0x0003), (0x39FE, 0x001F)], [
+        {0x67F2: 1, 0x0C15: 1, 0x39FE: _utf16("ali@example.com")},
+        {0x67F2: 2, 0x0C15: 2, 0x39FE: _utf16("veli@example.com")},
+    ]))
+    attachment_table = builder.block(_table_context([], [{0x67F2: ATTACHMENT}]))
+    message_sub = builder.subnodes([
+        (ATTACHMENT, attachment, attachment_sub),
+        (server.PST_NID_ATTACHMENT_TABLE, attachment_table, 0),
+        (server.PST_NID_RECIPIENT_TABLE, recipients, 0),
+    ])
+    builder.node(MESSAGE, _property_context([
+        (0x001A, 0x001F, _utf16("IPM.Note")),
+        (0x0037, 0x001F, _utf16("Çeyrek raporu")),
+        (0x0C1A, 0x001F, _utf16("Ayşe Yılmaz")),
+        (0x5D01, 0x001F, _utf16("ayse@example.com")),
+        (0x1000, 0x001F, _utf16("Merhaba,\r\nrapor ekte.")),
+        (0x0E06, 0x0040, _filetime(datetime(2024, 3, 5, 7, 0, tzinfo=timezone.utc))),
+        (0x0E07, 0x0003, 0x01),
+        (0x0017, 0x0003, 2),
+        (0x1035, 0x001F, _utf16("<q1@example.com>")),
+    ]), message_sub)
+    return builder.build(), payload
+
+
+def _read_pst(data):
+    with tempfile.TemporaryFile() as handle:
+        handle.write(data)
+        handle.flush()
+        pst = server.PSTFile(handle)
+        try:
+            return list(server.iter_pst_folders(pst)), list(server.iter_pst_messages(pst))
+        finally:
+            pst.close()
+
+
+def test_pst_reader_walks_folders_and_decodes_messages():
+    """Klasör ağacı, özel klasörler, mesaj özellikleri, alıcılar ve XBLOCK'lu ekler okunur"""
+    data, payload = _sample_pst()
+    folders, messages = _read_pst(data)
+
+    # Takvim klasörü atlanır; Sent, mesaj deposundaki kimliğinden tanınır
+    assert [(path, folder) for _, path, folder in folders] == [
+        ("Kişisel Klasörler", "inbox"),
+        ("Kişisel Klasörler/Gelen Kutusu", "inbox"),
+        ("Kişisel Klasörler/Giden", "sent"),
+    ]
+    assert len(messages) == 1
+    email = messages[0]["email"]
+    assert email["subject"] == "Çeyrek raporu"
+    assert email["sender"] == "ayse@example.com (Ayşe Yılmaz)"
+    assert email["recipients"] == ["ali@example.com"] and email["cc"] == ["veli@example.com"]
+    assert email["content"] == "Merhaba,\nrapor ekte." and email["content_type"] == "text"
+    assert email["date"] == "2024-03-05T07:00:00+00:00"
+    assert (email["folder"], email["read"], email["important"]) == ("inbox", True, True)
+    assert email["internet_message_id"] == "<q1@example.com>"
+
+    [(meta, content)] = messages[0]["attachments"]
+    assert meta == {"name": "Rapor.pdf", "type": "application/pdf", "size": len(payload)}
+    assert content == payload
+
+
+def test_pst_rejects_foreign_files():
+    with tempfile.TemporaryFile() as handle:
+        handle.write(b"PK\x03\x04" + b"\x00" * 1024)
+        handle.flush()
+        try:
+            server.PSTFile(handle)
+        except ValueError as e:
+            assert "PST" in str(e)
+        else:
+            raise AssertionError("ValueError bekleniyordu")
+
+
+def test_pst_cyclic_encryption_is_symmetric():
+    data = bytes(range(256)) * 3
+    assert server.pst_cyclic_decrypt(server.pst_cyclic_decrypt(data, 0x1234), 0x1234) == data
@@ -0,0 +1,375 @@
+"""
+Akış halinde üretilen arşiv (ZIP/JSON/EML) testleri
+"""
+import sys
+import os
+import io
+import json
+import gzip
+import base64
+import email
+from email import policy
+import asyncio
+import zipfile
+import tracemalloc
+import mailbox
+import tempfile
+import tarfile
+import struct
+import time
+
+import pytest
+
+# Add parent directory to Python path to import server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+def test_zip_stream_writer_roundtrip():
+    """Data descriptor'lı akış ZIP'i standart zipfile ile okunabilir"""
+    writer = server.ZipStreamWriter()
+    output = bytearray()
+    output += writer.start_entry("notlar.txt")
+    output += writer.write(b"PostaDepo " * 500)
+    output += writer.end_entry()
+    output += writer.add_entry("ekler/Ürün.jpg", b"\xff\xd8jpeg-data", compress=False)
+    output += writer.finish()
+    
+    with zipfile.ZipFile(io.BytesIO(bytes(output))) as zf:
+        assert zf.testzip() is None
+        infos = zf.infolist()
+        assert [info.filename for info in infos] == ["notlar.txt", "ekler/Ürün.jpg"]
+        assert infos[0].compress_type == zipfile.ZIP_DEFLATED
+        assert infos[1].compress_type == zipfile.ZIP_STORED
+        assert zf.read("notlar.txt") == b"PostaDepo " * 500
+    
+    # Akış kaydı: data descriptor bayrağı ve sıfır boyutlu ZIP64 extra alanı; bilinen boyutlu kayıt
+    # CRC ve boyutları local header'da taşır
+    version, flags, method = struct.unpack_from('<3H', output, 4)
+    name_length, extra_length = struct.unpack_from('<2H', output, 26)
+    assert (version, flags & 0x08, method) == (45, 0x08, zipfile.ZIP_DEFLATED)
+    assert struct.unpack_from('<2L', output, 18) == (0xFFFFFFFF, 0xFFFFFFFF)
+    assert struct.unpack_from('<2H2Q', output, 30 + name_length) == (0x0001, 16, 0, 0) and extra_length == 20
+    
+    stored_offset = infos[1].header_offset
+    assert struct.unpack_from('<4s2H', output, stored_offset)[2] & 0x08 == 0
+    assert struct.unpack_from('<3L', output, stored_offset + 14) == (infos[1].CRC, 11, 11)
+
+
+def test_unique_archive_names_are_deterministic():
+    """Aynı adlı ekler sırayla numaralandırılır"""
+    used = set()
+    names = [server.unique_archive_name(name, used) for name in ["Fatura.pdf", "fatura.pdf", "Fatura.pdf"]]
+    assert names == ["Fatura.pdf", "fatura (2).pdf", "Fatura (3).pdf"]
+    assert "/" not in server.safe_archive_name("../../etc/passwd")
+
+
+def _fake_cursor_factory(count, content_size=8 * 1024):
+    """MongoDB cursor yerine geçen, e-postaları tek tek üreten async iterator"""
+    def factory():
+        async def cursor():
+            for i in range(count):
+                yield {
+                    "id": f"email-{i}",
+                    "user_id": "test-user",
+                    "folder": "inbox",
+                    "sender": f"gonderen{i}@outlook.com",
+                    "recipient": "alici@postadepo.com",
+                    "subject": f"Test E-postası {i}",
+                    "content": ("Merhaba dünya %d " % i) * (content_size // 18),
+                    "date": "2024-01-01T10:00:00+00:00",
+                    "size": content_size
+                }
+        return cursor()
+    return factory
+
+
+def _consume(chunks):
+    async def run():
+        total = 0
+        async for chunk in chunks:
+            total += len(chunk)
+        return total
+    return asyncio.run(run())
+
+
+def _peak_memory_of_zip_export(count):
+    tracemalloc.start()
+    try:
+        total = _consume(server.coalesce_chunks(server.iter_zip_export(_fake_cursor_factory(count), "inbox")))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return total, peak
+
+
+def test_zip_export_is_valid_archive():
+    """Akış ZIP dışa aktarımı özet JSON ve .eml dosyalarını içerir"""
+    async def collect():
+        output = bytearray()
+        async for chunk in server.iter_zip_export(_fake_cursor_factory(3, 200), "inbox"):
+            output += chunk
+        return bytes(output)
+    
+    with zipfile.ZipFile(io.BytesIO(asyncio.run(collect()))) as zf:
+        names = zf.namelist()
+        assert names[0] == "emails-summary-inbox.json"
+        assert len(names) == 4
+        summary = json.loads(zf.read(names[0]))
+        assert [item["id"] for item in summary] == ["email-0", "email-1", "email-2"]
+
+
+def test_zip_export_memory_is_bounded():
+    """Tepe bellek kullanımı e-posta sayısıyla büyümez (tracemalloc)"""
+    small_total, small_peak = _peak_memory_of_zip_export(50)
+    large_total, large_peak = _peak_memory_of_zip_export(1000)
+    
+    assert large_total > small_total * 10
+    # Sabit bir üst sınır; central directory için kayıt başına ~100 bayt dışında büyüme olmamalı
+    assert large_peak < 4 * 1024 * 1024
+    assert large_peak < small_peak * 1.5 + 512 * 1024
+
+
+def _peak_memory_of_attachment_export(monkeypatch, attachment_size):
+    class _Stream:
+        def __init__(self):
+            self.remaining = attachment_size
+        
+        async def read(self, size):
+            size = min(size, self.remaining)
+            self.remaining -= size
+            return os.urandom(size)
+    
+    class _Bucket:
+        async def open_download_stream(self, blob_id):
+            return _Stream()
+    
+    def factory():
+        async def cursor():
+            for i in range(3):
+                yield {"id": f"email-{i}", "sender": "a@example.com", "recipient": "b@example.com",
+                       "subject": f"Ekli {i}", "content": "govde", "date": "2024-01-01T10:00:00+00:00",
+                       "attachments": [{"name": "veri.bin", "type": "application/octet-stream",
+                                        "size": attachment_size, "blob_id": f"blob-{i}"}]}
+        return cursor()
+    
+    monkeypatch.setattr(server, "attachment_bucket", _Bucket())
+    tracemalloc.start()
+    try:
+        total = _consume(server.iter_zip_export(factory, "inbox"))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert total > 3 * attachment_size
+    return peak
+
+
+def test_zip_export_memory_is_bounded_with_large_attachments(monkeypatch):
+    """Ekli büyük e-postalar tamamı bellekte tutulmadan akışla sıkıştırılır; tepe bellek ek boyutuyla büyümez"""
+    small_peak = _peak_memory_of_attachment_export(monkeypatch, 1024 * 1024)
+    large_peak = _peak_memory_of_attachment_export(monkeypatch, 8 * 1024 * 1024)
+    assert large_peak < small_peak + 1024 * 1024
+    assert large_peak < 8 * 1024 * 1024
+
+
+def test_json_array_and_ndjson_streams():
+    """JSON dizisi ve NDJSON eleman eleman üretilir, gzip ile sıkıştırılabilir"""
+    async def collect(chunks):
+        output = bytearray()
+        async for chunk in chunks:
+            output += chunk
+        return bytes(output)
+    
+    cursor = _fake_cursor_factory(3, 100)
+    array = json.loads(asyncio.run(collect(server.iter_json_array(cursor()))))
+    assert [item["id"] for item in array] == ["email-0", "email-1", "email-2"]
+    assert json.loads(asyncio.run(collect(server.iter_json_array(_fake_cursor_factory(0)())))) == []
+    
+    compressed = asyncio.run(collect(server.gzip_chunks(server.iter_ndjson(cursor()))))
+    lines = gzip.decompress(compressed).decode('utf-8').splitlines()
+    assert [json.loads(line)["subject"] for line in lines] == ["Test E-postası 0", "Test E-postası 1", "Test E-postası 2"]
+
+
+def test_export_fields_are_validated_before_streaming():
+    """MongoDB'nin akış sırasında reddedeceği alan yolları yanıt başlamadan 400 ile döner"""
+    assert server.build_export_projection(["subject", "from.name", "date"]) == \
+        {"subject": 1, "from.name": 1, "date": 1, "_id": 0}
+    for fields in (["a..b"], ["subject."], ["$where"], ["attachments.$name"], ["from", "from.name"], [""], "subject"):
+        with pytest.raises(server.HTTPException) as raised:
+            server.build_export_stream("json", {"user_id": "u"}, "all", {"fields": fields})
+        assert raised.value.status_code == 400
+
+
+def _collect(chunks):
+    async def run():
+        output = bytearray()
+        async for chunk in chunks:
+            output += chunk
+        return bytes(output)
+    return asyncio.run(run())
+
+
+def test_eml_export_is_valid_mime():
+    """Üretilen .eml RFC 5322/MIME olarak ayrıştırılır; Türkçe başlıklar ve ekler korunur"""
+    attachment = b"%PDF-1.4 " + bytes(range(256)) * 20
+    source = {
+        "id": "email-42",
+        "folder": "inbox",
+        "sender": "ali.kaya@outlook.com (Ali Kaya)",
+        "recipient": "alici@postadepo.com, ikinci@postadepo.com",
+        "subject": "Şubat faturası\nekte",
+        "content": "<p>Merhaba dünya</p>",
+        "content_type": "html",
+        "date": "2024-02-01T09:30:00+00:00",
+        "read": True,
+        "important": False,
+        "attachments": [{"id": "a1", "name": "Sözleşme.pdf", "type": "application/pdf",
+                         "content": base64.b64encode(attachment).decode()}]
+    }
+    raw = _collect(server.iter_email_mime(source))
+    assert all(len(line) <= 998 for line in raw.split(b"\r\n"))
+    
+    message = email.message_from_bytes(raw, policy=policy.default)
+    assert message["Subject"] == "Şubat faturası ekte"
+    assert message["From"].addresses[0].display_name == "Ali Kaya"
+    assert len(message["To"].addresses) == 2
+    assert message["X-PostaDepo-Id"] == "email-42"
+    assert message.get_body(("html",)).get_content().strip() == "<p>Merhaba dünya</p>"
+    parts = list(message.iter_attachments())
+    assert [part.get_filename() for part in parts] == ["Sözleşme.pdf"]
+    assert parts[0].get_content() == attachment
+    
+    async def cursor():
+        yield source
+        yield dict(source, id="email-43", attachments=[], content="düz metin", content_type="text")
+    digest = email.message_from_bytes(_collect(server.iter_eml_digest(cursor(), "inbox")), policy=policy.default)
+    assert digest.get_content_type() == "multipart/digest"
+    inner = [part.get_content() for part in digest.iter_parts()]
+    assert [item["X-PostaDepo-Id"] for item in inner] == ["email-42", "email-43"]
+    assert inner[1].get_content().strip() == "düz metin"
+
+
+def test_mbox_export_quotes_from_lines():
+    """mboxrd: gövdedeki 'From ' satırları tırnaklanır ve standart mbox okuyucusuyla açılır"""
+    async def cursor():
+        yield {"id": "m1", "sender": "ali@outlook.com (Ali)", "subject": "Bir", "content_type": "text",
+               "content": "Merhaba\nFrom here on\n>From quoted\n", "date": "2024-01-05T10:00:00+00:00"}
+        yield {"id": "m2", "sender": "", "subject": "İki", "content_type": "text",
+               "content": "ikinci", "date": "2024-01-06T10:00:00+00:00"}
+    
+    raw = _collect(server.iter_mbox_export(cursor()))
+    assert raw.startswith(b"From ali@outlook.com Fri Jan  5 10:00:00 2024\n")
+    assert b"\r\n" not in raw
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "export.mbox")
+        with open(path, "wb") as handle:
+            handle.write(raw)
+        messages = list(mailbox.mbox(path))
+    assert [message["X-PostaDepo-Id"] for message in messages] == ["m1", "m2"]
+    body = messages[0].get_payload(decode=True).decode("utf-8")
+    # mboxrd okuyucusu tırnakları bir seviye geri alır
+    assert ">From here on" in body and ">>From quoted" in body
+
+
+@pytest.mark.skipif(not os.environ.get("POSTADEPO_BENCH"), reason="POSTADEPO_BENCH=1 ile çalıştırın")
+def test_mbox_export_throughput_benchmark():
+    """100k e-postalık mbox dışa aktarım hızı (gzip dahil)"""
+    count = int(os.environ.get("POSTADEPO_BENCH_COUNT", "100000"))
+    for use_gzip in (False, True):
+        body = server.iter_mbox_export(_fake_cursor_factory(count, 2 * 1024)())
+        if use_gzip:
+            body = server.gzip_chunks(body)
+        started = time.perf_counter()
+        total = _consume(server.coalesce_chunks(body))
+        elapsed = time.perf_counter() - started
+        print(f"\nmbox gzip={use_gzip}: {count} e-posta, {total / 1e6:.1f} MB, "
+              f"{elapsed:.1f} sn, {count / elapsed:.0f} e-posta/sn")
+
+
+def test_maildir_tar_export():
+    """Maildir tar'ı klasör başına cur/new/tmp içerir, bayraklar dosya adlarında kodlanır"""
+    async def cursor():
+        yield {"id": "m1", "folder": "inbox", "sender": "a@outlook.com", "subject": "Okundu",
+               "content": "bir", "date": "2024-01-05T10:00:00+00:00", "read": True, "important": True}
+        yield {"id": "m2", "folder": "inbox", "sender": "b@outlook.com", "subject": "Yeni",
+               "content": "iki", "date": "2024-01-06T10:00:00+00:00", "read": False}
+        yield {"id": "m3", "folder": "sent", "sender": "c@outlook.com", "subject": "Gönderildi",
+               "content": "üç", "date": "2024-01-07T10:00:00+00:00", "read": True}
+    
+    compressed = _collect(server.gzip_chunks(server.iter_maildir_tar(cursor())))
+    with tempfile.TemporaryDirectory() as tmp:
+        with tarfile.open(fileobj=io.BytesIO(compressed), mode="r:gz") as archive:
+            assert "Maildir/.Sent/tmp" in archive.getnames()
+            archive.extractall(tmp, filter="data")
+        
+        inbox = mailbox.Maildir(os.path.join(tmp, "Maildir"), create=False)
+        flags = {message["X-PostaDepo-Id"]: (message.get_subdir(), message.get_flags()) for message in inbox}
+        assert flags == {"m1": ("cur", "FS"), "m2": ("new", "")}
+        
+        sent = inbox.get_folder("Sent")
+        assert [message["X-PostaDepo-Id"] for message in sent] == ["m3"]
+
+
+def test_zip_export_compression_levels():
+    """
+    store_only (seviye 0) .eml kayıtlarını STORED, diğer seviyeler process pool'da DEFLATE ile yazar.
+    Akışla yazılan özet her zaman DEFLATE'tir; seviye 0'da boyutu ham boyuta çok yakındır.
+    """
+    stored = _collect(server.iter_zip_export(_fake_cursor_factory(20, 2000), "inbox", compress_level=0))
+    deflated = _collect(server.iter_zip_export(_fake_cursor_factory(20, 2000), "inbox", compress_level=9))
+    
+    for archive_bytes, method in ((stored, zipfile.ZIP_STORED), (deflated, zipfile.ZIP_DEFLATED)):
+        with zipfile.ZipFile(io.BytesIO(archive_bytes)) as zf:
+            assert zf.testzip() is None
+            summary, *emails = zf.infolist()
+            assert summary.compress_type == zipfile.ZIP_DEFLATED
+            assert {info.compress_type for info in emails} == {method}
+            assert [name for name in zf.namelist() if name.endswith(".eml")][-1] == "emails/email-020.eml"
+    with zipfile.ZipFile(io.BytesIO(stored)) as zf:
+        summary = zf.infolist()[0]
+        assert summary.file_size <= summary.compress_size < summary.file_size * 1.01 + 16
+    assert len(deflated) < len(stored) / 3
+    
+    with pytest.raises(server.HTTPException):
+        server.parse_compression_level({"compression_level": 12})
+    assert server.parse_compression_level({"store_only": True}) == 0
+
+
+@pytest.mark.skipif(not os.environ.get("POSTADEPO_BENCH"), reason="POSTADEPO_BENCH=1 ile çalıştırın")
+def test_parallel_compression_benchmark():
+    """Paralel sıkıştırma hızı - çekirdek sayısına göre"""
+    count = int(os.environ.get("POSTADEPO_BENCH_COUNT", "20000"))
+    cores = os.cpu_count() or 1
+    worker_counts = sorted({1, 2, 4, cores} & set(range(1, cores + 1)))
+    for workers in worker_counts:
+        server.shutdown_process_pools()
+        async def entries():
+            async for message in _fake_cursor_factory(count, 8 * 1024)():
+                yield f"{message['id']}.eml", None, message["content"].encode("utf-8")
+        writer = server.ZipStreamWriter()
+        started = time.perf_counter()
+        total = _consume(server.iter_compressed_entries(writer, entries(), 6, workers=workers))
+        elapsed = time.perf_counter() - started
+        print(f"\nworkers={workers}/{cores}: {count} kayıt, {total / 1e6:.1f} MB çıktı, "
+              f"{elapsed:.1f} sn, {count / elapsed:.0f} kayıt/sn")
+    server.shutdown_process_pools()
+
+
+def test_system_log_csv_and_filters():
+    """Sistem logları CSV olarak satır satır üretilir; filtreler indeksli alanlara çevrilir"""
+    async def cursor():
+        yield {"id": "l1", "timestamp": "2024-03-01T12:00:00+00:00", "log_type": "USER_LOGIN",
+               "message": 'Giriş, "başarılı"', "user_email": "a@x.com", "additional_data": {"ip": "1.2.3.4"}}
+    
+    lines = _collect(server.iter_system_logs_csv(cursor())).decode("utf-8-sig").splitlines()
+    assert lines[0].split(",") == server.SYSTEM_LOG_CSV_FIELDS
+    assert lines[1] == 'l1,2024-03-01T12:00:00+00:00,USER_LOGIN,"Giriş, ""başarılı""",a@x.com,,"{""ip"": ""1.2.3.4""}"'
+    
+    query = server.build_system_log_query(server.SystemLogExportRequest(
+        start="2024-03-01T00:00:00Z", log_types=["USER_LOGIN"], user_email="a@x.com"
+    ))
+    assert set(query) == {"timestamp", "log_type", "user_email"}
+    assert query["timestamp"]["$gte"].year == 2024 and "$lte" not in query["timestamp"]
+    assert server.build_system_log_query(server.SystemLogExportRequest()) == {}
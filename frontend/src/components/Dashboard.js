@@ -53,6 +53,16 @@ import OutlookConnection from './OutlookConnection';
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Bu boyutun üzerindeki dosyalar devam ettirilebilir parçalı yüklemeyle gönderilir
+const CHUNKED_UPLOAD_THRESHOLD = 32 * 1024 * 1024;
+const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024;
+const UPLOAD_MAX_RETRIES = 5;
+
+const sha256Hex = async (buffer) => {
+  const digest = await window.crypto.subtle.digest('SHA-256', buffer);
+  return Array.from(new Uint8Array(digest)).map((byte) => byte.toString(16).padStart(2, '0')).join('');
+};
+
 const Dashboard = ({ user, onLogout }) => {
   const { theme, setTheme } = useTheme();
   const { language, setLanguage, t } = useLanguage();
@@ -255,12 +265,31 @@ const Dashboard = ({ user, onLogout }) => {
       setEmailThread([email]); // Single email, no thread
     }
     
+    // Gövdesi henüz senkronize edilmemiş e-posta: açılınca hemen çekilir
+    if (email.body_pending) {
+      loadEmailBody(email);
+    }
+    
     // Mark as read if unread
     if (!email.read) {
       markAsRead(email.id);
     }
   };
 
+  const loadEmailBody = async (email) => {
+    try {
+      const token = localStorage.getItem('token');
+      const response = await axios.get(`${API}/emails/${email.id}/body`, {
+        headers: { Authorization: `Bearer ${token}` }
+      });
+      const body = response.data;
+      setSelectedEmail(current => (current && current.id === email.id ? { ...current, ...body } : current));
+      setEmailThread(thread => thread.map(item => (item.id === email.id ? { ...item, ...body } : item)));
+    } catch (error) {
+      console.error('Email body load error:', error);
+    }
+  };
+
   const markAsRead = async (emailId) => {
     try {
       const token = localStorage.getItem('token');
@@ -292,25 +321,87 @@ const Dashboard = ({ user, onLogout }) => {
     }
   };
 
+  const uploadInChunks = async (file, headers) => {
+    let { data: upload } = await axios.post(`${API}/uploads`, { filename: file.name, size: file.size }, { headers });
+    let offset = upload.received;
+    let retries = 0;
+    while (offset < file.size) {
+      const chunk = await file.slice(offset, offset + UPLOAD_CHUNK_SIZE).arrayBuffer();
+      try {
+        const response = await axios.put(`${API}/uploads/${upload.id}?offset=${offset}`, chunk, {
+          headers: {
+            ...headers,
+            'Content-Type': 'application/octet-stream',
+            'X-Chunk-SHA256': await sha256Hex(chunk)
+          }
+        });
+        offset = response.data.received;
+        retries = 0;
+        toast.info(`${t('common.loading')}: %${Math.round(response.data.percent)}`);
+      } catch (error) {
+        retries += 1;
+        if (retries > UPLOAD_MAX_RETRIES || error.response?.status === 413) throw error;
+        // Bağlantı koptuysa sunucunun aldığı son ofsetten devam et
+        await new Promise((resolve) => setTimeout(resolve, 1000 * retries));
+        ({ data: upload } = await axios.get(`${API}/uploads/${upload.id}`, { headers }));
+        offset = upload.received;
+      }
+    }
+    // Büyük dosyalar arka plan işi olarak içe aktarılır; istek zaman aşımına uğramaz
+    const { data: job } = await axios.post(`${API}/uploads/${upload.id}/complete?background=true`, {}, { headers });
+    const finished = await followImportJob(job.id, headers);
+    if (finished?.status !== 'done') {
+      throw Object.assign(new Error(finished?.error || 'import failed'), { response: { data: { detail: finished?.error } } });
+    }
+    return { data: finished.result };
+  };
+
+  const followImportJob = async (jobId, headers) => {
+    // İlerleme SSE akışı; EventSource yetkilendirme başlığı gönderemediği için fetch ile okunur
+    const response = await fetch(`${API}/import-jobs/${jobId}/events`, { headers });
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let job = null;
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const events = buffer.split('\n\n');
+      buffer = events.pop();
+      for (const block of events) {
+        const data = block.split('\n').find((line) => line.startsWith('data: '));
+        if (!data) continue;
+        job = JSON.parse(data.slice(6));
+        toast.info(`${t('common.loading')}: %${Math.round(job.percent)}`, { id: `import-${jobId}` });
+      }
+    }
+    return job;
+  };
+
   const handleImport = async (file) => {
     if (!file) return;
     
-    const formData = new FormData();
-    formData.append('file', file);
-    
     setLoading(true);
     try {
       const token = localStorage.getItem('token');
-      const response = await axios.post(`${API}/import-emails`, formData, {
-        headers: { 
-          Authorization: `Bearer ${token}`,
-          'Content-Type': 'multipart/form-data'
-        },
-        onUploadProgress: (progressEvent) => {
-          const percentCompleted = Math.round((progressEvent.loaded * 100) / progressEvent.total);
-          toast.info(`${t('common.loading')}: %${percentCompleted}`);
-        }
-      });
+      let response;
+      if (file.size > CHUNKED_UPLOAD_THRESHOLD && window.crypto?.subtle) {
+        response = await uploadInChunks(file, { Authorization: `Bearer ${token}` });
+      } else {
+        const formData = new FormData();
+        formData.append('file', file);
+        response = await axios.post(`${API}/import-emails`, formData, {
+          headers: { 
+            Authorization: `Bearer ${token}`,
+            'Content-Type': 'multipart/form-data'
+          },
+          onUploadProgress: (progressEvent) => {
+            const percentCompleted = Math.round((progressEvent.loaded * 100) / progressEvent.total);
+            toast.info(`${t('common.loading')}: %${percentCompleted}`);
+          }
+        });
+      }
       
       toast.success(t('notifications.importSuccess').replace('{count}', response.data.count));
       setImportOpen(false);
@@ -1212,13 +1303,13 @@ const Dashboard = ({ user, onLogout }) => {
           </DialogHeader>
           <div className="space-y-4 pt-4">
             <p className="text-sm text-slate-600 text-center">
-              .pst, .ost {language === 'tr' ? 've' : 'or'} .eml {language === 'tr' ? 'dosyalarını seçin' : 'files'}
+              .pst, .ost, .mbox, .eml {language === 'tr' ? 've' : 'or'} .zip {language === 'tr' ? 'dosyalarını seçin' : 'files'}
             </p>
             <div className="border-2 border-dashed border-slate-300 rounded-lg p-6 text-center hover:border-[#2c5282] transition-colors">
               <Upload className="w-8 h-8 text-slate-400 mx-auto mb-2" />
               <input
                 type="file"
-                accept=".pst,.ost,.eml"
+                accept=".pst,.ost,.eml,.mbox,.zip"
                 onChange={(e) => handleImport(e.target.files[0])}
                 className="w-full"
                 disabled={loading}